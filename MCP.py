@@ -13,17 +13,21 @@
 ############################################################################################################
 
 # A whole bunch of setup and function definition happens here
-from MCPFunctions import getRain, checkSun, mlCloudDetect, getWeather, obsyOpen, obsyClose, ekos_dbus
+from MCPFunctions import getRain, checkSun, mlCloudDetect, getWeather, obsyOpen, obsyClose, ekos_dbus, cloudDetector, weatherReadings
+import time
+import obsyDB
+import skyHistory
+
+# Load the cloud model in the background while Ekos starts and the rain and Sun checks run, the first
+# mlCloudDetect() only waits for whatever is left of the load
+cloudDetector.start()
 
 ############################################################################################################
 # CONFIGURATION AND SETUP
 ############################################################################################################
 debug			=	True
 homedir			=	"/home/gtulloch/Projects/EKOSProcessingScripts/"
-long			=	-97.1385
-lat				=	 49.8954
 runMCP			=	True
-maxPending		=	5
 ekosProfile		=	"NTT8"
 
 # Suppress warnings
@@ -31,13 +35,18 @@ ekosProfile		=	"NTT8"
 
 # Set up database
 dbName = homedir+"obsy.db"
-con = sqlite3.connect(dbName)
+con = obsyDB.connectDB(dbName)
+obsyDB.createTables(con)
 cur = con.cursor()
 
+# Cloud, rain and weather samples, open/close decisions are made on their trends (see skyHistory.py)
+history = skyHistory.SkyHistory(con)
+obsyState = "Closed"
+
 # Set up logging
 import logging
 logger = logging.getLogger('MCP.py')
-logger.basicConfig(filename='MCP.log', filemode='w', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logging.basicConfig(filename='MCP.log', filemode='w', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger.info('MCP starting')
 
 # Ensure Ekos is running or exit
@@ -45,6 +54,7 @@ ekosStartCounter=0
 while not ekos_dbus.is_ekos_running():
 	ekos_dbus.start_ekos()
 	time.sleep(5)
+	ekosStartCounter+=1
 	if ekosStartCounter > 5:
 		logger.error('Unable to start Ekos')
 		exit(1)
@@ -54,39 +64,36 @@ while not ekos_dbus.is_ekos_running():
 ############################################################################################################
 while runMCP:
 	# If it's raining or daytime, immediate shut down and wait 5 mins
-	if getRain() or checkSun():
+	rain = getRain()
+	if rain or checkSun():
+		history.add(rain=rain)
 		obsyState = "Closed"
 		obsyClose()
 		time.sleep(300)
 		continue
 
-    # If weather looks unsuitable either stay closed or move to Close Pending if Open
-	if mlCloudDetect() or getWeather():
-		if obsyState == "Closed":
-			continue
-		# If Open give it PENDING minutes to change
+	# Record this minute's sky and weather, then open or close on the trend rather than the one sample:
+	# open after a spell of mostly clear sky that isn't clouding over, close when the last few minutes
+	# are mostly cloudy or cloud is building fast
+	try:
+		mlCloudDetect()
+		cloud = cloudDetector.cloud
+	except (RuntimeError, TimeoutError, OSError) as e:
+		logger.error('Cloud detection failed: '+str(e))
+		cloud = None
+	unsafe = getWeather()
+	history.add(cloud=cloud, rain=False, unsafe=unsafe, weather=weatherReadings)
+	decision = history.decide(obsyState)
+	if decision != obsyState:
+		obsyState = decision
 		if obsyState == "Open":
-			obsyState="Close Pending"
-			pendingCount=1
-		if obsyState == "Close Pending":
-			pendingCount+=1
-		if pendingCount == maxPending:
-			obsyState="Closed"
-			obsyClose()
-			pendingCount=0
-	else:
-		# Good weather so set to Open Pending or Open
-		if obsyState != "Open":
-			obsyState="Open Pending"
-			pendingCount=1
-		if obsyState == "Open Pending":
-			pendingCount=1
-		if pendingCount==maxPending: 
-			obsyState="Open"
 			obsyOpen()
-			pendingCount=0
-   
-	logger.info('Obsy state is '+obsyState)
+		else:
+			obsyClose()
+
+	trend = history.window(skyHistory.OPENMINUTES)
+	logger.info('Obsy state is '+obsyState+', '+str(trend["samples"])+' samples in '+str(skyHistory.OPENMINUTES)+
+				' min, '+str(round(trend["clear"]*100))+'% clear')
 	time.sleep(60)
 
 ############################################################################################################
@@ -3,10 +3,6 @@
 ############################################################################################################
 import PyIndi
 import sys
-import astropy.coordinates as coord
-from astropy.time import Time
-import astropy.units as u
-import astropy.io.fits as pyfits
 import warnings
 from datetime import datetime
 import pytz
@@ -15,15 +11,21 @@ import codecs
 import serial
 import PyIndi
 import numpy as np
-import skimage.io
 import time
 import threading
 import requests
 import dbus
 import os
-from pysolar.solar import *
-from keras.models import load_model  # TensorFlow is required for Keras to work
-from PIL import Image, ImageOps      # Install pillow instead of PIL
+import logging
+
+logger = logging.getLogger('MCP.py')
+
+# Ekos Scheduler status (the D-Bus "status" property) while it has a schedule under way
+SCHEDULERACTIVE=(1, 2, 3)   # startup, running, paused
+
+# Keras/TensorFlow and astropy take seconds to import, they are loaded when first needed (cloudModel.py,
+# checkSun) so MCP.py can start checking rain and the Sun straight away
+import cloudModel
 
 ############################################################################################################
 # Function to retrieve configuration (database lookup eventually so options can be changed during runtime)
@@ -40,15 +42,27 @@ def getConfig(keyword):
         return("/dev/ttyUSB0")
     elif keyword=="RAINPORT":
         return("/dev/ttyUSB1")
+    elif keyword=="LONGITUDE":
+        return(-97.1385)
+    elif keyword=="LATITUDE":
+        return(49.8954)
+    elif keyword=="CLOUDBACKEND":
+        return("keras")     # or "onnx"/"tflite" once converted with cloudModel.py convert
+    elif keyword=="CLOUDGRID":
+        return(None)        # (rows, cols) to classify sky sectors, None for the whole sky at once
+    elif keyword=="MAXWIND":
+        return(30)          # mph, unsafe if the current wind is above this
+    elif keyword=="MAXAVWIND":
+        return(20)          # mph, unsafe if the 1 minute average wind is above this
     else:
         logger.error("Unknown keyword passed to getConfig, exiting...")
         exit(1)
 
 ############################################################################################################
 # Setup for mlCloudDetect
-# Load the model and labels
-model = load_model(homedir+"mlCloudDetect/keras_model.h5", compile=False)
-class_names = open(homedir+"mlCloudDetect/labels.txt", "r").readlines()
+# The model and labels are loaded by cloudDetector.start() (on a background thread) or the first
+# mlCloudDetect(), whichever comes first. They are in mlCloudDetect/ next to this script.
+cloudDetector = cloudModel.CloudModel(cloudModel.MODELFILE, cloudModel.LABELFILE, getConfig("CLOUDBACKEND"))
 
 ############################################################################################################
 # INDI Client Definition
@@ -86,7 +100,7 @@ class IndiClient(PyIndi.BaseClient):
 #############################################################################################################
 # connect the server
 indiclient=IndiClient()
-indiclient.setServer(getConfig("INDISERVER",getConfig("INDIPORT"))
+indiclient.setServer(getConfig("INDISERVER"),getConfig("INDIPORT"))
 
 if (not(indiclient.connectServer())):
     logger.error("No indiserver running on "+indiclient.getHost()+":"+str(indiclient.getPort()))
@@ -96,7 +110,7 @@ if (not(indiclient.connectServer())):
 ## T E L E S C O P E  S E T U P                                                                            ##
 #############################################################################################################
 # connect the scope
-telescope=getConfig("INDITELESCOPE)
+telescope=getConfig("INDITELESCOPE")
 device_telescope=None
 telescope_connect=None
 
@@ -193,40 +207,27 @@ def obsyClose():
 ############################################################################################################
 # Get cloud status from AllSkyCam
 def mlCloudDetect():
-    # Create the array of the right shape to feed into the keras model
-    # The 'length' or number of images you can put into the array is
-    # determined by the first position in the shape tuple, in this case 1
-    data = np.ndarray(shape=(1, 224, 224, 3), dtype=np.float32)
-
-	# Find the latest image in the allsky cam (created by external task) 
-    image = Image.open(homedir+"mlCloudDetect/latest.jpg").convert("RGB")
-
-	# resizing the image to be at least 224x224 and then cropping from the center
-    size = (224, 224)
-    image = ImageOps.fit(image, size, Image.Resampling.LANCZOS)
-
-	# turn the image into a numpy array
-    image_array = np.asarray(image)
-
-	# Normalize the image
-    normalized_image_array = (image_array.astype(np.float32) / 127.5) - 1
-
-	# Load the image into the array
-    data[0] = normalized_image_array
-
-    # Predicts the model
-    prediction = model.predict(data)
-    index = np.argmax(prediction)
-    class_name = class_names[index]
-    confidence_score = prediction[0][index]
+    # Find the latest image in the allsky cam (created by external task), classify it. Waits for the
+    # model if it is still loading.
+    if getConfig("CLOUDGRID") is None:
+        class_name, confidence_score = cloudDetector.classify(cloudModel.LATESTIMAGE)
+    else:
+        # All sectors in one batch, the verdict weighted towards the zenith. The cloud map stays in
+        # cloudDetector.sky for choosing targets in the clear sectors.
+        sky = cloudDetector.classifySectors(cloudModel.LATESTIMAGE, getConfig("CLOUDGRID"))
+        class_name = sky["verdict"]
+        logger.info("Cloud map "+str(sky["sectors"].round(2).tolist()))
     
-    logger.info("Cloud Detect returns ",class_name)
+    logger.info("Cloud Detect returns "+class_name)
     return class_name
 
 ############################################################################################################
 # Check if the Sun is up
 def checkSun():
-    loc = coord.EarthLocation(long * u.deg, lat * u.deg)
+    import astropy.coordinates as coord
+    from astropy.time import Time
+    import astropy.units as u
+    loc = coord.EarthLocation(getConfig("LONGITUDE") * u.deg, getConfig("LATITUDE") * u.deg)
     now = Time.now()
     altaz = coord.AltAz(location=loc, obstime=now)
     sun = coord.get_sun(now).transform_to(altaz)
@@ -244,13 +245,13 @@ def checkSun():
 # https://www.cloudynights.com/topic/792701-arduino-based-rg-11-safety-monitor-for-nina-64bit/
 def getRain():
     try:
-        ser = serial.Serial(getConfig(RAINPORT),2400,timeout=1)
+        ser = serial.Serial(getConfig("RAINPORT"),2400,timeout=1)
         ser.flush()
         packet=ser.readline()
     except Exception as msg:
         logger.error("getRain error: "+msg)
 
-    if (packet != b"safe#")::
+    if (packet != b"safe#"):
         logger.info("Rain detected by Hydreon RG-11!")
         return True
     else:
@@ -259,10 +260,14 @@ def getRain():
     return
 
 ############################################################################################################
-# Get local weather data from ADS-WS1
+# Get local weather data from ADS-WS1. The readings are left in weatherReadings (wind in mph, temperature
+# in C, humidity in %) for the sky history, empty if there was no good packet.
+weatherReadings = {}
+
 def getWeather():
+    weatherReadings.clear()
     try:
-        ser = serial.Serial(getConfig(WEATHERPORT),2400,timeout=1)
+        ser = serial.Serial(getConfig("WEATHERPORT"),2400,timeout=1)
         ser.flush()
         packet=ser.readline()
     except Exception as msg:
@@ -272,7 +277,7 @@ def getWeather():
     header = packet[0:2]
     eom = packet[50:55]
     if header == b"!!" and eom == b"\r\n":
-        if (debug):
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug("===================================")
             logger.debug("Packet:")
             logger.debug(packet)
@@ -364,6 +369,8 @@ def getWeather():
         wx_today_rain = today_rain
         wx_today_rain_mm = today_rain / 24.5
 		    
+        weatherReadings.update({"wind": wx_wind_speed, "temperature": wx_temperature_celsius, "humidity": wx_humidity})
+
         # Determine whether we should open dome
         if (wx_average_wind_speed > getConfig("MAXAVWIND")) or (wx_wind_speed > getConfig("MAXWIND")):
             return True
@@ -385,7 +392,6 @@ class EkosDbus():
 		self.ekos_iface = None
 		self.scheduler_proxy = None
 		self.scheduler_iface = None
-		self.is_ekos_running = None
 
 	def setup_start_ekos_iface(self):
 		try:
@@ -435,11 +441,14 @@ class EkosDbus():
 			self.setup_ekos_iface()
 		self.ekos_iface.stop()
 
-	# is_ekos_running does not work
+	# Ekos is running once its manager is on the session bus and answers for its status
 	def is_ekos_running(self):
-		if self.ekos_iface is None:
-			self.setup_ekos_iface(verbose=False)
-		sys.exit(0)
+		try:
+			proxy = self.session_bus.get_object("org.kde.kstars", "/KStars/Ekos")
+			dbus.Interface(proxy, "org.freedesktop.DBus.Properties").Get("org.kde.kstars.Ekos", "ekosStatus")
+		except dbus.DBusException:
+			return False
+		return True
 
 	def load_and_start_profile(self, profile):
 		logger.info("Load {} profile".format(profile))
@@ -476,8 +485,12 @@ class EkosDbus():
 			self.setup_scheduler_iface()
 		self.scheduler_iface.resetAllJobs()
 
-	# is_scheduler_running does not work
 	def is_scheduler_running(self):
-		if self.scheduler_iface is None:
-			self.setup_scheduler_iface(verbose=False)
-		sys.exit(0)
\ No newline at end of file
+		try:
+			proxy = self.session_bus.get_object("org.kde.kstars", "/KStars/Ekos/Scheduler")
+			status = dbus.Interface(proxy, "org.freedesktop.DBus.Properties").Get("org.kde.kstars.Ekos.Scheduler", "status")
+		except dbus.DBusException:
+			return False
+		return int(status) in SCHEDULERACTIVE
+
+ekos_dbus = EkosDbus()
@@ -14,95 +14,83 @@
 #
 ############################################################################################################ 
 import os
-from astropy.io import fits
 import logging
-import sqlite3
-import shutil
-import uuid
+import obsyDB
+import fitsScan
+import thumbnailCache
 from pathlib import Path
 from datetime import datetime
 
 DEBUG=True
 
-# Function definitions
-def submitFile(fileName, hdr):
-    if "DATE-OBS" in hdr:
-        uuidStr=uuid.uuid4()
-        sqlStmt="INSERT INTO fitsFile (unid, date, filename) VALUES ('{0}','{1}','{2}')".format(uuidStr,hdr["DATE-OBS"],fileName)
-        print(sqlStmt)
-        try:
-            cur.execute(sqlStmt)
-            con.commit()
-        except sqlite3.Error as er:
-            logging.error('SQLite error: %s' % (' '.join(er.args)))
-            logging.error("Exception class is: ", er.__class__)
-            logging.error('SQLite traceback: ')
-            exc_type, exc_value, exc_tb = sys.exc_info()
-            logging.error(traceback.format_exception(exc_type, exc_value, exc_tb))
-            
-        for card in hdr:
-            if type(hdr[card]) not in [bool,int,float]:
-                keywordValue=str(hdr[card]).replace('\'',' ')
-            else:
-                keywordValue = hdr[card]
-            sqlStmt="INSERT INTO fitsHeader (thisUNID, parentUNID, keyword, value) VALUES ('{0}','{1}','{2}','{3}')".format(uuid.uuid4(),uuidStr,card,keywordValue)
-            print(sqlStmt)
-            try:
-                cur.execute(sqlStmt)
-                con.commit()
-            except sqlite3.Error as er:
-                logging.error('SQLite error: %s' % (' '.join(er.args)))
-                logging.error("Exception class is: ", er.__class__)
-                logging.error('SQLite traceback: ')
-                exc_type, exc_value, exc_tb = sys.exc_info()
-                logging.error(traceback.format_exception(exc_type, exc_value, exc_tb))
-    else:
-        logging.error("Error: File not added to repo due to missing date is "+fileName)
-        return 0
-    
-    return 1
-
-def createTables():
-    if DEBUG:
-        cur.execute("DROP TABLE if exists fitsFile")
-        cur.execute("DROP TABLE if exists fitsHeader")
-    cur.execute("CREATE TABLE if not exists fitsFile(unid, date, filename)")
-    cur.execute("CREATE TABLE if not exists fitsHeader(thisUNID, parentUNID, keyword, value)")
-    return
-
 # Variable Declarations
 sourceFolder="E:/00 Data Repository New/"
 repoFolder="E:/00 Data Repository New/"
 dbName = repoFolder+"obsy.db"
+batchSize = obsyDB.BATCHSIZE
+scanWorkers = None              # Header scanning processes, None for one per CPU
+INCREMENTAL = True              # Only parse new or changed files, keep the existing index
+CHECKSUMS = False               # Hash the content of every scanned file (reads whole files, slower)
+SKIPDUPLICATES = False          # With CHECKSUMS, don't index files whose content is already indexed
+QUALITY = False                 # Measure background, noise, stars, FWHM and eccentricity of every frame (frameQuality.py)
+THUMBNAILS = False              # Make a small preview of every frame in thumbnailFolder (thumbnailCache.py, hashes every file)
+thumbnailFolder = repoFolder+"Thumbnails/"
+thumbnailMB = thumbnailCache.CACHEMB    # Size cap of thumbnailFolder, least recently used thumbnails go first
 
-# Set up Database
-con = sqlite3.connect(dbName)
-cur = con.cursor()
-createTables()
+if __name__ == "__main__":
+    # Set up Database
+    con = obsyDB.connectDB(dbName)
+    obsyDB.createTables(con, drop=(DEBUG and not INCREMENTAL))
+    ingest = obsyDB.FitsIngest(con, batchSize, skipDuplicates=SKIPDUPLICATES)
 
-# Set up logging
-logging.basicConfig(filename='batchRename.log', filemode='w', format='%(name)s - %(levelname)s - %(message)s')
+    # Set up logging
+    logging.basicConfig(filename='batchRename.log', filemode='w', format='%(name)s - %(levelname)s - %(message)s')
 
-# Scan the pictures folder
-for root, dirs, files in os.walk(os.path.abspath(sourceFolder)):
-    for file in files:
-        file_name, file_extension = os.path.splitext(os.path.join(root, file))
-        
-        if (file_extension ==".db"):
-            print("Processing: ",file_name, file_extension)
+    # Work out which files are new or have changed since the last run by comparing size, mtime and inode
+    # against the manifest. Anything in the manifest that is no longer on disk is removed from the index.
+    manifest = obsyDB.loadManifest(con) if INCREMENTAL else {}
+    if INCREMENTAL and not manifest:
+        obsyDB.removeUnmanifested(con, os.path.abspath(sourceFolder))
+    signatures = {}
+    seen = set()
+    for fileName in fitsScan.findFitsFiles(sourceFolder, fitsScan.REPOEXTENSIONS):
+        try:
+            signature = obsyDB.statSignature(fileName)
+        except OSError:
             continue
-        else:
-            print("Processing: ",file_name, file_extension)
+        seen.add(fileName)
+        if fileName in manifest and manifest[fileName][0] == signature:
+            continue
+        signatures[fileName] = signature
+    vanished = [fileName for fileName in manifest if fileName not in seen]
+    if vanished:
+        print("Removing {0} files no longer on disk".format(len(vanished)))
+        obsyDB.removeFiles(con, vanished, [manifest[fileName][1] for fileName in vanished])
 
-        try:
-            hdul = fits.open(os.path.join(root, file))
-        except ValueError as e:
-            logging.warning("Invalid FITS file. File not processed is "+str(os.path.join(root, file)))
-            continue   
-        hdr = hdul[0].header
+    # Scan the new and changed files, headers are read in parallel and written to the database here
+    for result in fitsScan.scanFiles(list(signatures), scanWorkers, checksum=CHECKSUMS, quality=QUALITY,
+                                     thumbnails=thumbnailFolder if THUMBNAILS else None):
+        fileName, hdr = result[:2]
+        checksum, quality, thumbnail = result[2:] if len(result) > 2 else (None, None, None)
+        print("Processing: ",fileName)
+        manifestRow = (fileName,)+signatures[fileName] if INCREMENTAL else None
+        replaces = manifest[fileName][1] if fileName in manifest else None
+        if hdr is None:
+            logging.warning("Invalid FITS file. File not processed is "+str(fileName))
+            ingest.recordFile(manifestRow, replaces=replaces)
+            continue
         if "FRAME" in hdr:
-            print(os.path.join(root, file.replace(" ", "")))
-            submitFile(os.path.join(root, file.replace(" ", "")),hdr)
+            root, file = os.path.split(fileName)
+            ingest.submitFile(os.path.join(root, file.replace(" ", "")),hdr,manifest=manifestRow,replaces=replaces,checksum=checksum,quality=quality,thumbnail=thumbnail)
         else:
-            logging.warning("File not added to repo - no FRAME card - "+str(os.path.join(root, file)))
-            
\ No newline at end of file
+            logging.warning("File not added to repo - no FRAME card - "+str(fileName))
+            ingest.recordFile(manifestRow, replaces=replaces)
+
+    # Write the last partial batch
+    ingest.close()
+    print("Added {0} files and {1} header cards".format(ingest.fileCount,ingest.cardCount))
+    if CHECKSUMS:
+        obsyDB.printDuplicates(con, ingest.duplicates)
+    if THUMBNAILS:
+        thumbnailCache.pruneCache(con, thumbnailFolder, thumbnailMB)
+    con.close()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+############################################################################################################
+#
+# Name        : benchChecksum.py
+# Purpose     : Benchmark content checksums (fitsScan.fileChecksum) in MB/s, one file at a time and across
+#               the scan worker pool
+# Author      : Gord Tulloch
+# Date        : March 14 2024
+# License     : GPL v3
+# Dependencies: numpy, astropy. xxhash to include xxh3 (which the repository only uses if CHECKSUMHASH
+#               in fitsScan.py is set to it, the default is blake2b)
+# Usage       : python benchChecksum.py --files 16 --mb 50 --workers 4
+#
+# The files are written just before they are hashed so they come from the page cache; on a real repository
+# a cold read from disk or the NAS is usually the limit, so read the figures as the hashing ceiling.
+#
+############################################################################################################
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+
+import fitsScan
+from benchIngest import makeSyntheticRepo
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark FITS content checksums')
+    parser.add_argument('--files', type=int, default=16, help='synthetic files')
+    parser.add_argument('--mb', type=int, default=50, help='size of each file in MB')
+    parser.add_argument('--workers', type=int, default=None, help='scan worker processes, default one per CPU')
+    args = parser.parse_args()
+
+    side = int(np.sqrt(args.mb*1024*1024/2))
+    hashes = ["blake2b", "md5", "sha256"]+(["xxh3"] if fitsScan.xxhash is not None else [])
+    with tempfile.TemporaryDirectory() as folder:
+        makeSyntheticRepo(folder, args.files, nCards=50, shape=(side, side))
+        fileNames = sorted(fitsScan.findFitsFiles(folder))
+        totalMB = sum(os.path.getsize(fileName) for fileName in fileNames)/1024/1024
+        print("{0} files, {1:.0f} MB".format(len(fileNames), totalMB))
+
+        for hashName in hashes:
+            for chunkSize in (1024*1024, fitsScan.CHUNKSIZE):
+                start = time.perf_counter()
+                for fileName in fileNames:
+                    fitsScan.fileChecksum(fileName, hashName, chunkSize)
+                elapsed = time.perf_counter()-start
+                print("{0:<8} {1:2d} MB chunks  {2:8.0f} MB/s".format(hashName, chunkSize//(1024*1024), totalMB/elapsed))
+
+        for checksum in (False, True):
+            start = time.perf_counter()
+            for result in fitsScan.scanFiles(fileNames, args.workers, chunkSize=1, checksum=checksum):
+                pass
+            elapsed = time.perf_counter()-start
+            print("scan {0:<14} {1:8.0f} MB/s  {2:6.1f} files/s".format("with checksums" if checksum else "headers only",
+                  totalMB/elapsed, len(fileNames)/elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+############################################################################################################
+#
+# Name        : benchInference.py
+# Purpose     : Benchmark the cloud model backends (cloudModel.py): load time, per inference latency and
+#               resident memory of Keras, ONNX Runtime and TensorFlow Lite on the allsky image
+# Author      : Gord Tulloch
+# Date        : March 25 2024
+# License     : GPL v3
+# Dependencies: numpy, Pillow and the runtimes of the backends benchmarked
+# Usage       : python cloudModel.py convert --backend onnx   (and tflite) first, then
+#               python benchInference.py --runs 50
+#
+# Each backend runs in its own process so its memory isn't shared with, or left behind by, another. RSS is
+# the peak resident size of that process (Linux/macOS), which includes the runtime itself as well as the
+# model, so it is what the backend costs the observatory computer. Backends whose runtime or converted
+# model is missing are reported and skipped. With --grid the sector mode is timed as well: preprocessing of
+# the whole grid and one batched inference of all its sectors, next to the single image figures.
+#
+############################################################################################################
+import argparse
+import os
+import sys
+import json
+import time
+import subprocess
+import statistics
+
+import cloudModel
+
+def peakRssMB():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/1024/1024 if sys.platform == "darwin" else rss/1024
+
+############################################################################################################
+# One backend in this process, results printed as JSON for the parent
+def child(backend, modelFile, imageFile, runs, grid=None):
+    result = {}
+    try:
+        data = cloudModel.preprocess(imageFile)
+        start = time.perf_counter()
+        detector = cloudModel.CloudModel(modelFile, backend=backend)
+        detector.wait()
+        result["load"] = time.perf_counter()-start
+        start = time.perf_counter()
+        detector.predict(data)
+        result["first"] = time.perf_counter()-start
+        times = []
+        for i in range(runs):
+            start = time.perf_counter()
+            detector.predict(data)
+            times.append(time.perf_counter()-start)
+        times.sort()
+        result["median"] = statistics.median(times)
+        result["p95"] = times[min(len(times)-1, int(0.95*len(times)))]
+        if grid:
+            start = time.perf_counter()
+            sectors = cloudModel.preprocessSectors(imageFile, grid)
+            result["gridPreprocess"] = time.perf_counter()-start
+            detector.predict(sectors)
+            times = []
+            for i in range(runs):
+                start = time.perf_counter()
+                detector.predict(sectors)
+                times.append(time.perf_counter()-start)
+            result["grid"] = statistics.median(times)
+        result["rss"] = peakRssMB()
+    except Exception as e:
+        result["error"] = "{0}: {1}".format(type(e).__name__, e)
+    print(json.dumps(result))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cloud model inference backends')
+    parser.add_argument('--backends', nargs='+', choices=list(cloudModel.BACKENDEXTENSIONS), default=list(cloudModel.BACKENDEXTENSIONS))
+    parser.add_argument('--model', type=str, default=cloudModel.MODELFILE, help='Keras model, converted models next to it')
+    parser.add_argument('--image', type=str, default=cloudModel.LATESTIMAGE, help='allsky image to classify')
+    parser.add_argument('--runs', type=int, default=50, help='timed inferences per backend')
+    parser.add_argument('--grid', type=int, nargs=2, metavar=('ROWS', 'COLS'), help='also time a batch of sky sectors')
+    parser.add_argument('--child', choices=list(cloudModel.BACKENDEXTENSIONS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.model, args.image, args.runs, args.grid)
+        return
+
+    print("{0:<7} {1:>8} {2:>10} {3:>10} {4:>10} {5:>9}".format("backend", "load", "first", "median", "p95", "peak RSS"))
+    for backend in args.backends:
+        if not os.path.isfile(cloudModel.backendFile(args.model, backend)):
+            print("{0:<7} no {1}, run cloudModel.py convert --backend {0}".format(backend, cloudModel.backendFile(args.model, backend)))
+            continue
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", backend, "--model", args.model,
+                                  "--image", args.image, "--runs", str(args.runs)]+(["--grid"]+[str(n) for n in args.grid] if args.grid else []),
+                                 capture_output=True, text=True)
+        lines = process.stdout.strip().splitlines()
+        result = json.loads(lines[-1]) if lines else {"error": process.stderr.strip()[-200:]}
+        if "error" in result:
+            print("{0:<7} failed: {1}".format(backend, result["error"]))
+            continue
+        print("{0:<7} {1:7.2f}s {2:8.1f}ms {3:8.1f}ms {4:8.1f}ms {5:6.0f} MB".format(backend, result["load"],
+              result["first"]*1000, result["median"]*1000, result["p95"]*1000, result["rss"]))
+        if "grid" in result:
+            print("        {0}x{1} sectors: preprocess {2:.1f}ms, batched inference {3:.1f}ms".format(args.grid[0], args.grid[1],
+                  result["gridPreprocess"]*1000, result["grid"]*1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+############################################################################################################
+#
+# Name        : benchIngest.py
+# Purpose     : Benchmark header ingest into obsy.db on a synthetic repository, comparing the old one commit
+#               per card path with the batched obsyDB.FitsIngest path
+# Author      : Gord Tulloch
+# Date        : February 20 2024
+# License     : GPL v3
+# Dependencies: astropy, numpy
+# Usage       : python benchIngest.py --files 2000 --cards 300 --batch 250
+#
+############################################################################################################
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+
+import numpy as np
+from astropy.io import fits
+
+import obsyDB
+
+############################################################################################################
+# Create a folder of small FITS files with realistic EKOS headers padded out to nCards cards
+def makeSyntheticRepo(folder, nFiles, nCards=300, shape=(16,16)):
+    filters=["L","R","G","B","Ha","OIII","SII"]
+    data=np.zeros(shape, dtype=np.uint16)
+    for i in range(nFiles):
+        hdr=fits.Header()
+        hdr["FRAME"]="Light"
+        hdr["OBJECT"]="NGC 7635"
+        hdr["FILTER"]=filters[i % len(filters)]
+        hdr["EXPTIME"]=300.0
+        hdr["XBINNING"]=1
+        hdr["YBINNING"]=1
+        hdr["CCD-TEMP"]=-10.0
+        hdr["DATE-OBS"]="2024-01-{0:02d}T{1:02d}:{2:02d}:{3:02d}.000".format(1+i//86400 % 28,i//3600 % 24,i//60 % 60,i % 60)
+        for j in range(len(hdr),nCards):
+            hdr["KEY{0}".format(j)]=("value {0}".format(j),"synthetic card")
+        fits.writeto(os.path.join(folder,"Light_{0:05d}.fits".format(i)), data, hdr, overwrite=True)
+    return
+
+############################################################################################################
+# Read back every header in the synthetic repository
+def readHeaders(folder):
+    headers=[]
+    for file in sorted(os.listdir(folder)):
+        with fits.open(os.path.join(folder,file)) as hdul:
+            headers.append((os.path.join(folder,file),hdul[0].header.copy()))
+    return headers
+
+############################################################################################################
+# The original postProcess.py submitFile, one formatted INSERT and one commit per card
+def legacyIngest(con, headers):
+    cur=con.cursor()
+    for fileName, hdr in headers:
+        uuidStr=uuid.uuid4()
+        cur.execute("INSERT INTO fitsFile (unid, date, filename) VALUES ('{0}','{1}','{2}')".format(uuidStr,hdr["DATE-OBS"],fileName))
+        con.commit()
+        for card in hdr:
+            keywordValue=str(hdr[card]).replace('\'',' ')
+            cur.execute("INSERT INTO fitsHeader (thisUNID, parentUNID, keyword, value) VALUES ('{0}','{1}','{2}','{3}')".format(uuid.uuid4(),uuidStr,card,keywordValue))
+            con.commit()
+    return
+
+def batchIngest(con, headers, batchSize):
+    ingest=obsyDB.FitsIngest(con, batchSize)
+    for fileName, hdr in headers:
+        ingest.submitFile(fileName, hdr)
+    ingest.close()
+    return
+
+def report(label, seconds, nFiles, nCards):
+    print("{0:<10} {1:8.2f} s {2:10.1f} files/s {3:12.1f} cards/s".format(label,seconds,nFiles/seconds,nCards/seconds))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark obsy.db header ingest')
+    parser.add_argument('--files', type=int, default=500, help='number of synthetic FITS files')
+    parser.add_argument('--cards', type=int, default=300, help='header cards per file')
+    parser.add_argument('--batch', type=int, default=obsyDB.BATCHSIZE, help='files per committed batch')
+    parser.add_argument('--skip_legacy', action='store_true', help='do not time the one commit per card path')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        repo=os.path.join(folder,"repo")
+        os.makedirs(repo)
+        print("Creating {0} synthetic files with {1} cards".format(args.files,args.cards))
+        makeSyntheticRepo(repo, args.files, args.cards)
+        headers=readHeaders(repo)
+        nCards=sum(len(hdr) for fileName, hdr in headers)
+
+        if not args.skip_legacy:
+            con=sqlite3.connect(os.path.join(folder,"legacy.db"))
+            obsyDB.createTables(con)
+            start=time.perf_counter()
+            legacyIngest(con, headers)
+            report("legacy", time.perf_counter()-start, len(headers), nCards)
+            con.close()
+
+        con=obsyDB.connectDB(os.path.join(folder,"batched.db"))
+        obsyDB.createTables(con)
+        start=time.perf_counter()
+        batchIngest(con, headers, args.batch)
+        report("batched", time.perf_counter()-start, len(headers), nCards)
+        con.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+############################################################################################################
+#
+# Name        : benchPreview.py
+# Purpose     : Benchmark per-update render time of the live stack web preview (previewRender.py)
+# Author      : Gord Tulloch
+# Date        : March 8 2024
+# License     : GPL v3
+# Dependencies: numpy, Pillow, astropy. Imagemagick only for --convert
+# Usage       : python benchPreview.py --updates 10 --width 6224 --height 4168 --convert
+#
+############################################################################################################
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+import numpy as np
+from astropy.io import fits
+
+import previewRender
+import stackEngine
+
+# A sky background with noise and some stars, a little different every update like a growing stack
+def syntheticStack(rng, height, width, nStars=300):
+    data = rng.normal(1000, 30, size=(height, width)).astype(np.float32)
+    y = rng.integers(5, height-5, nStars)
+    x = rng.integers(5, width-5, nStars)
+    for dy in range(-2, 3):
+        for dx in range(-2, 3):
+            data[y+dy, x+dx] += 20000*np.exp(-(dx*dx+dy*dy)/2.0)
+    return data
+
+# Rendering must leave the image alone: LiveStack.image() is the stack's own accumulator (its memmapped
+# state in mean and sigma mode), so check a stack that fits the preview without binning is unchanged
+def checkUnchanged(folder, rng, size):
+    stack = stackEngine.LiveStack(mode="sigma")
+    for i in range(3):
+        stack.addFrame(syntheticStack(rng, size//2, size//2, 20))
+    before = stack.image().copy()
+    previewRender.PreviewRenderer(maxSize=size).render(stack.image(), os.path.join(folder, "check.png"))
+    return np.array_equal(before, stack.image())
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark live stack preview rendering')
+    parser.add_argument('--updates', type=int, default=10, help='renders per format')
+    parser.add_argument('--width', type=int, default=6224, help='frame width, default 26MP sensor')
+    parser.add_argument('--height', type=int, default=4168, help='frame height')
+    parser.add_argument('--size', type=int, default=previewRender.WEBSIZE, help='web image size')
+    parser.add_argument('--convert', action='store_true', help='also time /usr/bin/convert -flatten on the FITS')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    data = syntheticStack(rng, args.height, args.width)
+    print("Frame {0}x{1} ({2:.1f} MP), preview {3}px".format(args.width, args.height, args.width*args.height/1e6, args.size))
+    with tempfile.TemporaryDirectory() as folder:
+        if not checkUnchanged(folder, rng, args.size):
+            raise SystemExit("Rendering changed the stack image")
+        for mode in previewRender.STRETCHMODES:
+            for extension in (".png", ".jpg"):
+                renderer = previewRender.PreviewRenderer(maxSize=args.size, mode=mode)
+                times = []
+                for i in range(args.updates):
+                    update = data+np.float32(0.2*i)     # slow drift of the sky background
+                    start = time.perf_counter()
+                    renderer.render(update, os.path.join(folder, "LiveStack"+extension))
+                    times.append(time.perf_counter()-start)
+                print("{0:<5} {1:<4} first {2:7.1f} ms  median {3:7.1f} ms/update  stretch recomputed {4}/{5}".format(
+                    mode, extension, times[0]*1000, np.median(times[1:] or times)*1000, renderer.recomputed, args.updates))
+
+        if args.convert and os.path.isfile("/usr/bin/convert"):
+            fitsName = os.path.join(folder, "LiveStack.fits")
+            fits.writeto(fitsName, data, overwrite=True)
+            start = time.perf_counter()
+            subprocess.run(["/usr/bin/convert", "-flatten", fitsName, os.path.join(folder, "convert.png")], check=False)
+            print("convert     {0:7.1f} ms".format((time.perf_counter()-start)*1000))
+
+
+if __name__ == "__main__":
+    main()
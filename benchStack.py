@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+############################################################################################################
+#
+# Name        : benchStack.py
+# Purpose     : Benchmark per-frame latency of the in-process live stack (stackEngine.LiveStack)
+# Author      : Gord Tulloch
+# Date        : February 26 2024
+# License     : GPL v3
+# Dependencies: numpy, astropy
+# Usage       : python benchStack.py --frames 10 --width 6224 --height 4168
+#
+############################################################################################################
+import argparse
+import time
+import numpy as np
+
+import stackEngine
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark live stack update latency')
+    parser.add_argument('--frames', type=int, default=10, help='frames to stack per mode')
+    parser.add_argument('--width', type=int, default=6224, help='frame width, default 26MP sensor')
+    parser.add_argument('--height', type=int, default=4168, help='frame height')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    frame = rng.normal(1000, 30, size=(args.height, args.width)).astype(np.float32)
+    print("Frame {0}x{1} ({2:.1f} MP)".format(args.width, args.height, args.width*args.height/1e6))
+    for mode in stackEngine.STACKMODES:
+        stack = stackEngine.LiveStack(mode=mode, minFrames=3)
+        times = []
+        for i in range(args.frames):
+            start = time.perf_counter()
+            stack.addFrame(frame)
+            times.append(time.perf_counter()-start)
+        print("{0:<6} first {1:7.1f} ms  median {2:7.1f} ms/frame".format(mode, times[0]*1000, np.median(times[1:] or times)*1000))
+
+
+if __name__ == "__main__":
+    main()
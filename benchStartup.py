@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+############################################################################################################
+#
+# Name        : benchStartup.py
+# Purpose     : Benchmark MCP start up: import time, time to the first safety decision (the Sun check) and
+#               to the first cloud decision, with the cloud model loaded eagerly at import as MCPFunctions
+#               used to and lazily in the background by cloudModel.py
+# Author      : Gord Tulloch
+# Date        : March 24 2024
+# License     : GPL v3
+# Dependencies: numpy, astropy, Pillow, keras (with TensorFlow)
+# Usage       : python benchStartup.py --runs 3
+#
+# Each run is a fresh Python process so imports are timed cold (apart from the OS file cache, which is
+# warm after the first run). Times are seconds from the start of the process.
+#
+# The "mcp" row is the real thing: it imports MCPFunctions, starts the cloud model load as MCP.py does and
+# calls checkSun() and mlCloudDetect(). MCPFunctions connects to the INDI server and D-Bus when it is
+# imported, so that row only works on the observatory computer with the INDI server running; elsewhere it
+# reports why it failed. The "eager" and "lazy" rows are a simulation that runs anywhere: they repeat what
+# the import and the first pass of the main loop do with astropy and the cloud model (eager as MCPFunctions
+# did before, loading the model at import) without the INDI and D-Bus parts.
+#
+############################################################################################################
+import argparse
+import os
+import sys
+import json
+import time
+import subprocess
+import statistics
+
+START = time.perf_counter()
+
+LONGITUDE=-97.1385
+LATITUDE=49.8954
+MODES=("mcp", "eager", "lazy")
+
+# The Sun check of MCPFunctions.checkSun
+def sunUp(longitude=LONGITUDE, latitude=LATITUDE):
+    import astropy.coordinates as coord
+    from astropy.time import Time
+    import astropy.units as u
+    loc = coord.EarthLocation(longitude * u.deg, latitude * u.deg)
+    now = Time.now()
+    sun = coord.get_sun(now).transform_to(coord.AltAz(location=loc, obstime=now))
+    return sun.alt.degree > -6.0
+
+############################################################################################################
+# One start up in this process, timings printed as JSON for the parent
+def child(mode, imageFile):
+    timings = {}
+    try:
+        if mode == "mcp":
+            # The real start up of MCP.py
+            import MCPFunctions
+            MCPFunctions.cloudDetector.start()
+            safety, cloud = MCPFunctions.checkSun, MCPFunctions.mlCloudDetect
+        elif mode == "eager":
+            # MCPFunctions before: astropy and Keras imported and the model loaded at import
+            import astropy.coordinates, astropy.time, astropy.units
+            from keras.models import load_model
+            import cloudModel
+            detector = cloudModel.CloudModel()
+            detector.load()
+            safety, cloud = sunUp, lambda: detector.classify(imageFile)
+        else:
+            import cloudModel
+            detector = cloudModel.CloudModel().start()
+            safety, cloud = sunUp, lambda: detector.classify(imageFile)
+        timings["import"] = time.perf_counter()-START
+        safety()
+        timings["safety"] = time.perf_counter()-START
+        cloud()
+        timings["cloud"] = time.perf_counter()-START
+    except Exception as e:
+        timings["error"] = "{0}: {1}".format(type(e).__name__, e)
+    print(json.dumps(timings))
+
+def runChild(mode, imageFile):
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode, "--image", imageFile],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    lines = result.stdout.strip().splitlines()
+    if result.returncode != 0 or not lines:
+        return {"error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "exit {0}".format(result.returncode)}
+    return json.loads(lines[-1])
+
+def main():
+    import cloudModel
+    parser = argparse.ArgumentParser(description='Benchmark MCP start up with the cloud model loaded eagerly and lazily')
+    parser.add_argument('--runs', type=int, default=3, help='start ups per mode')
+    parser.add_argument('--image', type=str, default=cloudModel.LATESTIMAGE, help='allsky image to classify')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.image)
+        return
+
+    print("{0:<6} {1:>8} {2:>15} {3:>15}".format("mode", "import", "first safety", "first cloud"))
+    for mode in MODES:
+        runs = [runChild(mode, args.image) for i in range(args.runs)]
+        errors = [run["error"] for run in runs if "error" in run]
+        row = []
+        for key in ("import", "safety", "cloud"):
+            values = [run[key] for run in runs if key in run]
+            row.append("{0:.2f}s".format(statistics.median(values)) if values else "-")
+        print("{0:<6} {1:>8} {2:>15} {3:>15}".format(mode, *row))
+        if errors:
+            print("       {0} of {1} runs failed: {2}".format(len(errors), args.runs, errors[0]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+############################################################################################################
+#
+# Name        : buildMasters.py
+# Purpose     : Build master dark, flat and bias frames from the calibration frames in the repository
+# Author      : Gord Tulloch
+# Date        : March 6 2024
+# License     : GPL v3
+# Dependencies: numpy, astropy
+# Usage       : python buildMasters.py --db "E:/00 Data Repository/obsy.db" --repo "E:/00 Data Repository/"
+#
+# Calibration frames are grouped from the fitsFrame table the same way calibration.py matches masters to
+# lights: darks by exposure, flats by filter, all by binning and (darks/biases) CCD temperature bucket.
+# Each group is combined a band of rows at a time: every worker reads the same rows from all the frames in
+# the group through a memmap and takes the median or sigma clipped mean, so 100 full frame darks never
+# need to be in memory together. Flats have the master bias taken off and are scaled to a common median
+# before combining. The master is written to Calibrate/{FRAME}/.../Master/ and recorded in fitsMaster
+# along with its source frames. Groups whose sources haven't changed since their master was built are
+# skipped. With --reject, darks and biases whose background or noise (fitsQuality, measured at ingest) is
+# more than that many MADs from the rest of their group, a light leak or a bad readout, are left out first.
+#
+############################################################################################################
+import argparse
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
+from astropy.io import fits
+
+import obsyDB
+import calibration
+import stackEngine
+
+COMBINEMETHODS=("median","sigma")
+MINFRAMES=3
+MEMORYMB=512            # memory for tiles across all workers
+
+############################################################################################################
+# Calibration frame groups from the index: {masterKey: [(unid, filename, ccdtemp), ...]}
+def calibrationGroups(con, frames=("Dark","Flat","Bias"), since=None):
+    sqlStmt = ("SELECT r.unid, f.filename, r.frame, r.exptime, r.filter, r.xbinning, r.ybinning, r.ccdtemp "
+               "FROM fitsFrame r JOIN fitsFile f ON f.unid=r.unid WHERE r.frame IN ({0})".format(",".join("?"*len(frames))))
+    params = list(frames)
+    if since is not None:
+        sqlStmt += " AND r.dateobs>=?"
+        params.append(since)
+    groups = {}
+    for unid, fileName, frame, exptime, filterName, xbinning, ybinning, ccdtemp in con.execute(sqlStmt, params):
+        hdr = {"EXPTIME": exptime or 0, "FILTER": filterName or "", "XBINNING": xbinning or 1,
+               "YBINNING": ybinning or 1, "CCD-TEMP": ccdtemp}
+        groups.setdefault(calibration.masterKey(frame, hdr), []).append((unid, fileName, ccdtemp))
+    return groups
+
+############################################################################################################
+# Split a dark or bias group into the frames to combine and those whose background or noise is an outlier
+# in the group. Frames without quality metrics are kept. Returns (kept, rejected).
+def rejectOutliers(con, members, kappa):
+    unids = [unid for unid, fileName, ccdtemp in members]
+    metrics = {unid: (background, noise) for unid, background, noise in con.execute(
+               "SELECT unid, background, noise FROM fitsQuality WHERE unid IN ({0})".format(",".join("?"*len(unids))), unids)}
+    if len(metrics) < MINFRAMES:
+        return members, []
+    values = np.array([metrics[unid] for unid in unids if unid in metrics], dtype=np.float64)
+    median = np.median(values, axis=0)
+    # A floor of 1% on the spread so a group of near identical frames doesn't reject on noise
+    mad = np.maximum(1.4826*np.median(np.abs(values-median), axis=0), 0.01*np.abs(median)+1e-6)
+    kept, rejected = [], []
+    for member in members:
+        if member[0] in metrics and (np.abs(np.array(metrics[member[0]])-median) > kappa*mad).any():
+            rejected.append(member)
+        else:
+            kept.append(member)
+    return kept, rejected
+
+############################################################################################################
+# True if a master already exists built from exactly these source frames
+def masterIsCurrent(con, unids):
+    rows = con.execute("SELECT s.master, count(*) FROM fitsMasterSource s JOIN fitsMaster m ON m.filename=s.master "
+                       "WHERE s.unid IN ({0}) GROUP BY s.master".format(",".join("?"*len(unids))), unids).fetchall()
+    for master, count in rows:
+        total = con.execute("SELECT nframes FROM fitsMaster WHERE filename=?", (master,)).fetchone()[0]
+        if count == len(unids) and total == len(unids) and os.path.isfile(master):
+            return True
+    return False
+
+############################################################################################################
+# Read rows start:stop of a frame (all planes of a colour cube) as float32
+def readBand(fileName, start, stop):
+    hdul, data, bscale, bzero = stackEngine.openFrame(fileName, section=True)
+    try:
+        band = np.multiply(data[..., start:stop, :], np.float32(bscale), dtype=np.float32)
+        if bzero:
+            band += np.float32(bzero)
+    finally:
+        del data
+        hdul.close()
+    return band
+
+# Median of a frame (less the bias) from a subsample, used to normalize flats. Worker function.
+def frameMedian(fileName, biasFile=None, step=8):
+    hdul, data, bscale, bzero = stackEngine.openFrame(fileName)
+    try:
+        sample = np.asarray(data[..., ::step, ::step], dtype=np.float32)*np.float32(bscale)+np.float32(bzero)
+    finally:
+        del data
+        hdul.close()
+    if biasFile is not None:
+        with fits.open(biasFile, memmap=True) as hdul:
+            sample -= stackEngine.imageHDU(hdul).data[..., ::step, ::step].astype(np.float32)
+    return float(np.median(sample))
+
+############################################################################################################
+# Combine a stack of bands along the first axis
+def combineBands(bands, method="median", kappa=3.0, iterations=2):
+    if method == "median":
+        return np.median(bands, axis=0).astype(np.float32)
+    keep = np.ones(bands.shape, dtype=bool)
+    for i in range(iterations):
+        masked = np.where(keep, bands, np.nan)
+        center = np.nanmedian(masked, axis=0)
+        spread = 1.4826*np.nanmedian(np.abs(masked-center), axis=0)
+        keep &= np.abs(bands-center) <= kappa*np.maximum(spread, 1e-6)
+    count = keep.sum(axis=0)
+    total = np.where(keep, bands, 0).sum(axis=0)
+    # Pixels where everything was rejected fall back to the median
+    return np.where(count > 0, total/np.maximum(count, 1), np.median(bands, axis=0)).astype(np.float32)
+
+# Combine one tile of rows across all frames of a group. Worker function.
+def combineTile(fileNames, start, stop, method, kappa, scales=None, biasFile=None):
+    bands = np.stack([readBand(fileName, start, stop) for fileName in fileNames])
+    if biasFile is not None:
+        bands -= readBand(biasFile, start, stop)
+    if scales is not None:
+        bands *= np.asarray(scales, dtype=np.float32).reshape((-1,)+(1,)*(bands.ndim-1))
+    return start, combineBands(bands, method, kappa)
+
+############################################################################################################
+# Where the master for a group goes, following the folders postProcess.py files calibration frames into
+def masterPath(repoFolder, key, nFrames):
+    frame, exptime, filterName, binning, temp = key
+    stamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    tempStr = "" if temp is None else "-t{0}".format(temp)
+    if frame == "Dark":
+        folder = repoFolder+"Calibrate/{0}/{1}/Master/".format(frame, exptime)
+        name = "Master{0}-{1}s-{2}x{3}{4}-n{5}-{6}.fits".format(frame, exptime, binning[0], binning[1], tempStr, nFrames, stamp)
+    elif frame == "Flat":
+        folder = repoFolder+"Calibrate/{0}/{1}/Master/".format(frame, filterName)
+        name = "Master{0}-{1}-{2}x{3}-n{4}-{5}.fits".format(frame, filterName, binning[0], binning[1], nFrames, stamp)
+    else:
+        folder = repoFolder+"Calibrate/{0}/Master/".format(frame)
+        name = "Master{0}-{1}x{2}{3}-n{4}-{5}.fits".format(frame, binning[0], binning[1], tempStr, nFrames, stamp)
+    return folder, name.replace(" ", "")
+
+############################################################################################################
+# Build the master for one group across the pool, returns the master file name
+def buildMaster(con, pool, workers, repoFolder, key, members, method="sigma", kappa=3.0, memoryMB=MEMORYMB):
+    frame, exptime, filterName, binning, temp = key
+    fileNames = [fileName for unid, fileName, ccdtemp in members]
+    with fits.open(fileNames[0], memmap=True) as hdul:
+        shape = stackEngine.imageHDU(hdul).shape
+    planes = int(np.prod(shape[:-2])) if len(shape) > 2 else 1
+
+    # Flats are bias subtracted and scaled to the median of the group before combining
+    biasFile, scales = None, None
+    if frame == "Flat":
+        biasFile = calibration.findMaster(con, calibration.masterKey("Bias", {"XBINNING": binning[0], "YBINNING": binning[1]}))
+        if biasFile is None:
+            logging.warning("No master bias for {0}, flats combined without bias subtraction".format(key))
+        medians = list(pool.map(frameMedian, fileNames, [biasFile]*len(fileNames)))
+        if min(medians) <= 0:
+            logging.error("Flat with zero or negative median in group {0}, skipped".format(key))
+            return None
+        target = float(np.median(medians))
+        scales = [target/median for median in medians]
+
+    # Rows per tile so that all workers' tiles together fit in the memory budget (with room for the
+    # working copies the combine makes)
+    bytesPerRow = len(fileNames)*shape[-1]*planes*4*4
+    rowsPerTile = max(1, int(memoryMB*1024*1024/(bytesPerRow*max(workers, 1))))
+    result = np.empty(shape, dtype=np.float32)
+    starts = list(range(0, shape[-2], rowsPerTile))
+    futures = [pool.submit(combineTile, fileNames, start, min(start+rowsPerTile, shape[-2]), method, kappa, scales, biasFile)
+               for start in starts]
+    try:
+        for future in futures:
+            start, band = future.result()
+            result[..., start:start+band.shape[-2], :] = band
+    except Exception:
+        # Don't leave the rest of this group's tiles queued ahead of the next group
+        for future in futures:
+            future.cancel()
+        raise
+
+    temps = [ccdtemp for unid, fileName, ccdtemp in members if ccdtemp is not None]
+    ccdtemp = round(float(np.mean(temps)), 1) if temps else None
+    hdr = fits.Header()
+    hdr["FRAME"] = ("Master "+frame, "Master calibration frame")
+    hdr["IMAGETYP"] = "Master "+frame
+    if exptime is not None:
+        hdr["EXPTIME"] = exptime
+    if filterName is not None:
+        hdr["FILTER"] = filterName
+    hdr["XBINNING"] = binning[0]
+    hdr["YBINNING"] = binning[1]
+    if ccdtemp is not None:
+        hdr["CCD-TEMP"] = ccdtemp
+    hdr["NCOMBINE"] = (len(fileNames), "Number of frames combined")
+    hdr["COMBTYPE"] = (method, "Combine method")
+    hdr["DATE"] = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+    folder, name = masterPath(repoFolder, key, len(fileNames))
+    os.makedirs(folder, exist_ok=True)
+    fits.writeto(folder+name, result, hdr, overwrite=True)
+    obsyDB.recordMaster(con, folder+name, {"frame": frame, "exptime": exptime, "filter": filterName,
+                        "xbinning": binning[0], "ybinning": binning[1], "ccdtemp": ccdtemp},
+                        [unid for unid, fileName, ccdtemp in members])
+    return folder+name
+
+def main():
+    parser = argparse.ArgumentParser(description='Build master calibration frames from the repository')
+    parser.add_argument('--db', required=True, type=str, help='obsy.db of the repository')
+    parser.add_argument('--repo', required=True, type=str, help='repository folder, masters go under Calibrate/')
+    parser.add_argument('--frames', nargs='+', default=["Bias","Dark","Flat"], help='frame types to build')
+    parser.add_argument('--method', choices=COMBINEMETHODS, default="sigma", help='combine method')
+    parser.add_argument('--kappa', type=float, default=3.0, help='sigma clipping threshold')
+    parser.add_argument('--since', type=str, default=None, help='only frames with DATE-OBS on or after, fi 2024-01-01')
+    parser.add_argument('--min_frames', type=int, default=MINFRAMES, help='smallest group to combine')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, default one per CPU')
+    parser.add_argument('--memory', type=int, default=MEMORYMB, help='MB of tiles held across all workers')
+    parser.add_argument('--force', action='store_true', help='rebuild masters that are up to date')
+    parser.add_argument('--reject', type=float, default=None, help='leave out darks and biases whose background or noise is this many MADs off the group')
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='buildMasters.log', filemode='w', format='%(name)s - %(levelname)s - %(message)s')
+    repoFolder = args.repo if args.repo.endswith("/") else args.repo+"/"
+    con = obsyDB.connectDB(args.db)
+    obsyDB.createTables(con)
+    workers = args.workers or os.cpu_count()
+
+    groups = calibrationGroups(con, args.frames, args.since)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Biases first so flats can use them
+        for frame in [f for f in ("Bias","Dark","Flat") if f in args.frames]:
+            for key, members in groups.items():
+                if key[0] != frame:
+                    continue
+                if args.reject is not None and frame != "Flat":
+                    members, rejected = rejectOutliers(con, members, args.reject)
+                    for unid, fileName, ccdtemp in rejected:
+                        print("Leaving out {0}, background or noise is off".format(fileName))
+                if len(members) < args.min_frames:
+                    print("Skipping {0}, only {1} frames".format(key, len(members)))
+                    continue
+                if not args.force and masterIsCurrent(con, [unid for unid, fileName, ccdtemp in members]):
+                    print("Master for {0} is up to date".format(key))
+                    continue
+                print("Combining {0} frames for {1}".format(len(members), key))
+                try:
+                    master = buildMaster(con, pool, workers, repoFolder, key, members, args.method, args.kappa, args.memory)
+                except Exception as e:
+                    # A missing or unreadable frame, or one of another size, loses this master only
+                    logging.error("Unable to build the master for {0}: {1}: {2}".format(key, type(e).__name__, e))
+                    print("    failed: {0}: {1}".format(type(e).__name__, e))
+                    continue
+                if master is not None:
+                    print("    wrote "+master)
+    con.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+############################################################################################################
+#
+# Name        : calibration.py
+# Purpose     : Find master dark/flat/bias frames for a light through obsy.db and calibrate it with them
+# Author      : Gord Tulloch
+# Date        : March 4 2024
+# License     : GPL v3
+# Dependencies: numpy, astropy
+# Usage       : cache=calibration.MasterCache(con)
+#               calibrated=cache.calibrate(data, hdr)
+#
+# Masters are listed in the fitsMaster table of obsy.db (they sit in the Calibrate/Dark/{EXPTIME},
+# Calibrate/Flat/{FILTER} and Calibrate/Bias folders postProcess.py files calibration frames into).
+# Loaded masters are kept in an LRU cache keyed by (frame type, exptime, filter, binning, temperature
+# bucket) so calibrating a light is an in-memory subtract and multiply, the masters are read from disk once.
+# Every RECHECK seconds an entry is looked up again, so a master buildMasters.py records or rebuilds while
+# liveStack.py is running (a new file, or the same file with a new mtime) is picked up, and a light that had
+# no master gets one.
+#
+############################################################################################################
+import os
+import time
+import logging
+from collections import OrderedDict
+import numpy as np
+import stackEngine
+
+TEMPBUCKET=2.0          # degrees C, lights within a bucket share masters
+TEMPTOLERANCE=3.0       # degrees C, how far a master's CCD-TEMP may be from the light's
+MAXMASTERS=8            # masters held in memory
+RECHECK=300             # seconds before a cached master (or a missing one) is looked up in fitsMaster again
+
+############################################################################################################
+# Round a CCD temperature to its bucket, None stays None
+def tempBucket(ccdTemp, bucketSize=TEMPBUCKET):
+    if ccdTemp is None:
+        return None
+    return round(float(ccdTemp)/bucketSize)*bucketSize
+
+############################################################################################################
+# Cache key for the master of a given type that matches a light header
+def masterKey(frame, hdr):
+    binning = (int(hdr.get("XBINNING", 1)), int(hdr.get("YBINNING", 1)))
+    temp = tempBucket(hdr.get("CCD-TEMP"))
+    if frame == "Dark":
+        return (frame, float(hdr.get("EXPTIME", 0)), None, binning, temp)
+    if frame == "Flat":
+        return (frame, None, str(hdr.get("FILTER", "")).strip(), binning, None)
+    return (frame, None, None, binning, temp)
+
+############################################################################################################
+# Look up the best master for a key in fitsMaster: exact binning (and exposure for darks, filter for
+# flats), closest temperature within tolerance, newest first on a tie
+def findMaster(con, key, tolerance=TEMPTOLERANCE):
+    frame, exptime, filterName, binning, temp = key
+    sqlStmt = "SELECT filename FROM fitsMaster WHERE frame=? AND xbinning=? AND ybinning=?"
+    params = [frame, binning[0], binning[1]]
+    if exptime is not None:
+        sqlStmt += " AND exptime=?"
+        params.append(exptime)
+    if filterName is not None:
+        sqlStmt += " AND filter=?"
+        params.append(filterName)
+    if temp is not None:
+        sqlStmt += " AND (ccdtemp IS NULL OR abs(ccdtemp-?)<=?) ORDER BY abs(coalesce(ccdtemp,?)-?), created DESC"
+        params += [temp, tolerance, temp, temp]
+    else:
+        sqlStmt += " ORDER BY created DESC"
+    row = con.execute(sqlStmt+" LIMIT 1", params).fetchone()
+    return None if row is None else row[0]
+
+############################################################################################################
+# MasterCache - LRU cache of master arrays ready to apply. Darks and biases are stored as they are to be
+# subtracted, flats as the reciprocal of the normalized flat so applying one is a multiply.
+class MasterCache():
+    def __init__(self, con, maxMasters=MAXMASTERS, recheck=RECHECK):
+        self.con = con
+        self.maxMasters = maxMasters
+        self.recheck = recheck
+        self.masters = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def loadMaster(self, fileName, frame):
+        data, header = stackEngine.readFrame(fileName)
+        if frame == "Flat":
+            median = np.median(data[::4,::4]) if data.ndim == 2 else np.median(data[...,::4,::4])
+            data /= np.float32(median)
+            np.clip(data, 1e-3, None, out=data)
+            np.reciprocal(data, out=data)
+        return data
+
+    # The master array for a key, None if there is no matching master. Entries are (time checked, file
+    # name, mtime, array); misses are cached too so a light without a master doesn't query the database
+    # every time, and both are checked again after recheck seconds.
+    def get(self, key):
+        now = time.monotonic()
+        entry = self.masters.get(key)
+        if entry is not None:
+            self.masters.move_to_end(key)
+            if now-entry[0] < self.recheck:
+                self.hits += 1
+                return entry[3]
+        fileName = findMaster(self.con, key)
+        mtime = None
+        if fileName is not None:
+            try:
+                mtime = os.stat(fileName).st_mtime_ns
+            except OSError:
+                pass
+        if entry is not None and (entry[1], entry[2]) == (fileName, mtime):
+            # Still the best master and unchanged on disk
+            self.hits += 1
+            self.masters[key] = (now,)+entry[1:]
+            return entry[3]
+        self.misses += 1
+        master = None
+        if fileName is not None:
+            try:
+                master = self.loadMaster(fileName, key[0])
+                logging.info("Loaded master {0} for {1}".format(fileName, key))
+            except (OSError, ValueError) as e:
+                logging.error("Unable to read master {0}: {1}".format(fileName, e))
+        self.masters[key] = (now, fileName, mtime, master)
+        self.masters.move_to_end(key)
+        if len(self.masters) > self.maxMasters:
+            self.masters.popitem(last=False)
+        return master
+
+    def clear(self):
+        self.masters.clear()
+
+    # Calibrate a light: subtract the dark (or the bias if there is no dark) and flat field it. data is
+    # calibrated in place when it is already float32.
+    def calibrate(self, data, hdr):
+        data = np.asarray(data, dtype=np.float32)
+        dark = self.get(masterKey("Dark", hdr))
+        offset = dark if dark is not None else self.get(masterKey("Bias", hdr))
+        if offset is not None:
+            if offset.shape != data.shape:
+                logging.warning("Master shape {0} does not match light {1}, not subtracted".format(offset.shape, data.shape))
+            else:
+                data -= offset
+        flat = self.get(masterKey("Flat", hdr))
+        if flat is not None:
+            if flat.shape != data.shape:
+                logging.warning("Master flat shape {0} does not match light {1}, not applied".format(flat.shape, data.shape))
+            else:
+                data *= flat
+        return data
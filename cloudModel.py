@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+############################################################################################################
+#
+# Name        : cloudModel.py
+# Purpose     : The allsky cloud classifier used by MCPFunctions.mlCloudDetect, loaded on first use or in
+#               the background instead of when MCPFunctions is imported, run by Keras, ONNX Runtime or
+#               TensorFlow Lite
+# Author      : Gord Tulloch
+# Date        : March 24 2024
+# License     : GPL v3
+# Dependencies: numpy, Pillow, and for the backend in use keras (with TensorFlow), onnxruntime, or
+#               tflite_runtime (or TensorFlow). Converting needs TensorFlow, and tf2onnx for ONNX.
+# Usage       : detector = cloudModel.CloudModel(backend="onnx")
+#               detector.start()                            # begin loading, returns straight away
+#               className, confidence = detector.classify() # waits for the model if it is still loading
+#               python cloudModel.py convert --backend onnx # keras_model.h5 -> keras_model.onnx
+#               python cloudModel.py parity --backend onnx  # compare with Keras on latest.jpg
+#
+# Importing Keras pulls in TensorFlow and, with loading keras_model.h5, takes several seconds on the
+# observatory computer. MCPFunctions used to do both at import, so MCP.py couldn't check rain or the Sun
+# until the model was in memory. This module imports nothing heavier than numpy and Pillow; start() loads
+# the model on a daemon thread while MCP.py gets on with the safety checks, and the first classification
+# waits for it only if it isn't done yet. Without start() the model is loaded by the first classification.
+#
+# The backend only changes what runs the network. "keras" runs keras_model.h5 as trained; "onnx" and
+# "tflite" run the same network converted once with the convert command (to keras_model.onnx and
+# keras_model.tflite next to the .h5, float32, no quantization) on the CPU, without TensorFlow's start up
+# time, per call overhead or memory. The parity command checks a converted model against Keras on the
+# latest allsky image before it is put into use, benchInference.py reports latency and memory of each.
+#
+# MCP.py asks for a classification every minute but the allsky camera writes latest.jpg every few minutes,
+# so classify() keeps its last result with the mtime and size of the image and returns it while they are
+# unchanged. With perceptual set an image that did change on disk is first compared with the last one by a
+# 64 bit difference hash of a thumbnail (the JPEG decoded at 1/8 scale); one within HASHDISTANCE bits, such
+# as the same sky written again with a new timestamp, keeps the result too. Either way a result older than
+# maxAge seconds is worked out again.
+#
+# classify() makes one verdict for the whole sky from a centre crop. classifySectors() cuts the image into a
+# grid of sectors (the square around the allsky circle, in image orientation) and classifies them all in
+# one batched call, which costs little more than one image as the fixed per call cost dominates on a CPU.
+# The image is decoded and resized once for the whole grid and the tiles are cut from it with one reshape,
+# so preprocessing is one resize and one normalization whatever the grid. It returns the cloud probability
+# of every sector (one minus the probability of the CLEARCLASSES) as a map, and a verdict for the sky
+# from the class probabilities averaged with weights that favour the sectors nearest the zenith.
+#
+############################################################################################################
+import argparse
+import os
+import sys
+import time
+import logging
+import threading
+import numpy as np
+from PIL import Image, ImageOps
+
+MODELFOLDER=os.path.join(os.path.dirname(os.path.abspath(__file__)), "mlCloudDetect")
+MODELFILE=os.path.join(MODELFOLDER, "keras_model.h5")
+LABELFILE=os.path.join(MODELFOLDER, "labels.txt")
+LATESTIMAGE=os.path.join(MODELFOLDER, "latest.jpg")   # written by the allsky camera task
+INPUTSIZE=(224, 224)
+LOADTIMEOUT=300         # seconds a classification waits for the model before giving up
+BACKEND="keras"         # "keras", "onnx" or "tflite"
+BACKENDEXTENSIONS={"keras": ".h5", "onnx": ".onnx", "tflite": ".tflite"}
+ONNXOPSET=13
+PARITYTOLERANCE=1e-3    # largest difference in class probability from Keras that passes the parity check
+CACHETTL=600            # seconds a classification of an unchanged image is reused before it is redone
+PERCEPTUALHASH=False    # also reuse it for a rewritten image that looks the same
+HASHDISTANCE=4          # differing bits (of 64) for two images to look the same
+GRID=(3, 3)             # sector rows and columns for classifySectors
+CLEARCLASSES=("Clear", "Aurora", "AuroraMoon")     # labels where the sky is clear
+HORIZONWEIGHT=0.5       # verdict weight of a corner sector relative to the centre (zenith) one
+
+logger = logging.getLogger(__name__)
+
+############################################################################################################
+# Class names in model output order. labels.txt lines are "<index> <name>".
+def readLabels(labelFile=LABELFILE):
+    with open(labelFile, "r") as f:
+        return [line.strip().split(" ", 1)[-1] for line in f if line.strip()]
+
+# Model input for an image: centre crop resized to the model's input size, scaled to -1..1, with a leading
+# batch axis
+def preprocess(imageFile=LATESTIMAGE, size=INPUTSIZE):
+    with Image.open(imageFile) as image:
+        image = ImageOps.fit(image.convert("RGB"), size, Image.Resampling.LANCZOS)
+    return (np.asarray(image, dtype=np.float32)/127.5-1)[np.newaxis]
+
+# Model input for a grid of sectors of an image, (rows*cols, 224, 224, 3) in row major order. The square
+# around the centre is resized once to the size of the whole grid and cut into tiles by a reshape.
+def preprocessSectors(imageFile=LATESTIMAGE, grid=GRID, size=INPUTSIZE):
+    rows, cols = grid
+    with Image.open(imageFile) as image:
+        image = ImageOps.fit(image.convert("RGB"), (cols*size[0], rows*size[1]), Image.Resampling.LANCZOS)
+    pixels = np.asarray(image, dtype=np.float32).reshape(rows, size[1], cols, size[0], 3)
+    return (pixels.transpose(0, 2, 1, 3, 4).reshape(rows*cols, size[1], size[0], 3))/127.5-1
+
+# Verdict weight of each sector, 1 at the centre of the image down to horizonWeight at the corners
+def sectorWeights(grid=GRID, horizonWeight=HORIZONWEIGHT):
+    rows, cols = grid
+    y, x = np.mgrid[0:rows, 0:cols]
+    distance = np.hypot((y+0.5)/rows-0.5, (x+0.5)/cols-0.5)
+    return 1-(1-horizonWeight)*(distance/distance.max() if distance.max() > 0 else distance)
+
+# 64 bit difference hash of an image: each bit is whether a pixel of a 9x8 grey thumbnail is brighter than
+# its right hand neighbour. draft() lets the JPEG decoder skip most of the work.
+def imageHash(imageFile):
+    with Image.open(imageFile) as image:
+        image.draft("L", (64, 64))
+        pixels = np.asarray(image.convert("L").resize((9, 8), Image.Resampling.BILINEAR), dtype=np.int16)
+    return int.from_bytes(np.packbits(pixels[:,1:] > pixels[:,:-1]).tobytes(), "big")
+
+# The model file a backend runs: the Keras model itself, or the converted copy next to it
+def backendFile(modelFile=MODELFILE, backend=BACKEND):
+    if backend not in BACKENDEXTENSIONS:
+        raise ValueError("unknown cloud model backend {0}, use one of {1}".format(backend, ", ".join(BACKENDEXTENSIONS)))
+    return os.path.splitext(modelFile)[0]+BACKENDEXTENSIONS[backend]
+
+############################################################################################################
+# Backend loaders. Each imports its runtime and returns a function taking a float32 (n, 224, 224, 3) batch
+# and returning the (n, classes) probabilities.
+def loadKeras(fileName):
+    from keras.models import load_model  # TensorFlow is required for Keras to work
+    model = load_model(fileName, compile=False)
+    # Calling the model skips the batching and callback machinery of predict(), which is most of its cost
+    # for one image
+    return lambda data: np.asarray(model(data, training=False))
+
+def loadOnnx(fileName):
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = os.cpu_count() or 1
+    session = onnxruntime.InferenceSession(fileName, options, providers=["CPUExecutionProvider"])
+    inputName = session.get_inputs()[0].name
+    return lambda data: session.run(None, {inputName: np.ascontiguousarray(data, dtype=np.float32)})[0]
+
+def loadTflite(fileName):
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        from tensorflow.lite import Interpreter
+    interpreter = Interpreter(model_path=fileName, num_threads=os.cpu_count() or 1)
+    interpreter.allocate_tensors()
+    inputDetail = interpreter.get_input_details()[0]
+    outputIndex = interpreter.get_output_details()[0]["index"]
+    lock = threading.Lock()
+    def infer(data):
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        # The interpreter holds one set of tensors, resized when the batch size changes
+        with lock:
+            if tuple(interpreter.get_input_details()[0]["shape"]) != data.shape:
+                interpreter.resize_tensor_input(inputDetail["index"], data.shape)
+                interpreter.allocate_tensors()
+            interpreter.set_tensor(inputDetail["index"], data)
+            interpreter.invoke()
+            return interpreter.get_tensor(outputIndex).copy()
+    return infer
+
+LOADERS={"keras": loadKeras, "onnx": loadOnnx, "tflite": loadTflite}
+
+############################################################################################################
+class CloudModel:
+    # modelFile is the Keras model, the other backends run the converted copy next to it
+    def __init__(self, modelFile=MODELFILE, labelFile=LABELFILE, backend=BACKEND, maxAge=CACHETTL, perceptual=PERCEPTUALHASH):
+        self.modelFile = backendFile(modelFile, backend)
+        self.labelFile = labelFile
+        self.backend = backend
+        self.infer = None
+        self.labels = None
+        self.error = None
+        self.loadSeconds = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+        self.maxAge = maxAge
+        self.perceptual = perceptual
+        self.cached = {}        # (image file, mode): ((mtime, size), hash, time classified, result)
+        self.cacheHits = 0
+        self.sky = None         # last classifySectors() result
+        self.cloud = None       # cloud probability of the last classification, 1-P(CLEARCLASSES)
+
+    # Start loading on a background thread, once; returns straight away
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.load, name="cloudModel", daemon=True)
+                self.thread.start()
+        return self
+
+    def load(self):
+        start = time.perf_counter()
+        try:
+            self.labels = readLabels(self.labelFile)
+            self.infer = LOADERS[self.backend](self.modelFile)
+            self.loadSeconds = time.perf_counter()-start
+            logger.info("Cloud model {0} loaded in {1:.1f}s".format(self.modelFile, self.loadSeconds))
+        except Exception as e:
+            self.error = e
+            logger.error("Unable to load cloud model {0}: {1}".format(self.modelFile, e))
+        finally:
+            self.loaded.set()
+
+    def ready(self):
+        return self.loaded.is_set() and self.error is None
+
+    # Block until the model is loaded, loading it here if start() was never called
+    def wait(self, timeout=LOADTIMEOUT):
+        self.start()
+        if not self.loaded.wait(timeout):
+            raise TimeoutError("cloud model still loading after {0}s".format(timeout))
+        if self.error is not None:
+            raise RuntimeError("cloud model failed to load: {0}".format(self.error))
+        return self.infer
+
+    # Class probabilities for a batch of preprocessed images
+    def predict(self, data, timeout=LOADTIMEOUT):
+        return np.asarray(self.wait(timeout)(data))
+
+    # The last result of mode for an image if the image hasn't changed since and it is less than maxAge
+    # seconds old, otherwise compute() and keep that
+    def cachedResult(self, imageFile, mode, compute):
+        st = os.stat(imageFile)
+        key = (st.st_mtime_ns, st.st_size)
+        now = time.monotonic()
+        imageDigest = None
+        cached = self.cached.get((imageFile, mode))
+        if cached is not None and now-cached[2] < self.maxAge:
+            if cached[0] == key:
+                self.cacheHits += 1
+                return cached[3]
+            if self.perceptual:
+                imageDigest = imageHash(imageFile)
+                if cached[1] is not None and bin(imageDigest ^ cached[1]).count("1") <= HASHDISTANCE:
+                    self.cached[(imageFile, mode)] = (key,)+cached[1:]
+                    self.cacheHits += 1
+                    return cached[3]
+        result = compute()
+        if self.perceptual and imageDigest is None:
+            imageDigest = imageHash(imageFile)
+        self.cached[(imageFile, mode)] = (key, imageDigest, now, result)
+        return result
+
+    # (class name, confidence) for an image
+    def classify(self, imageFile=LATESTIMAGE, timeout=LOADTIMEOUT):
+        def compute():
+            prediction = self.predict(preprocess(imageFile), timeout)[0]
+            index = int(np.argmax(prediction))
+            cloud = 1-float(prediction[np.isin(np.array(self.labels), CLEARCLASSES)].sum())
+            return self.labels[index], float(prediction[index]), cloud
+        className, confidence, self.cloud = self.cachedResult(imageFile, "whole", compute)
+        return className, confidence
+
+    # Sector by sector classification of an image in one batch. Returns a dict with "verdict" and
+    # "confidence" (class and probability of the weighted mean of the sectors), "cloud" (weighted cloud
+    # probability), "sectors" (rows x cols cloud probabilities) and "classes" (rows x cols class names).
+    def classifySectors(self, imageFile=LATESTIMAGE, grid=GRID, horizonWeight=HORIZONWEIGHT, timeout=LOADTIMEOUT):
+        def compute():
+            prediction = self.predict(preprocessSectors(imageFile, grid), timeout)
+            labels = np.array(self.labels)
+            clear = np.isin(labels, CLEARCLASSES)
+            weights = sectorWeights(grid, horizonWeight).ravel()
+            mean = (prediction*weights[:,np.newaxis]).sum(axis=0)/weights.sum()
+            cloud = 1-prediction[:,clear].sum(axis=1)
+            index = int(np.argmax(mean))
+            return {"verdict": self.labels[index], "confidence": float(mean[index]),
+                    "cloud": float((cloud*weights).sum()/weights.sum()), "sectors": cloud.reshape(grid),
+                    "classes": labels[np.argmax(prediction, axis=1)].reshape(grid)}
+        self.sky = self.cachedResult(imageFile, ("sectors", tuple(grid), horizonWeight), compute)
+        self.cloud = self.sky["cloud"]
+        return self.sky
+
+############################################################################################################
+# Convert the Keras model for a backend, written next to it. Returns the converted file name.
+def convertModel(modelFile=MODELFILE, backend="onnx"):
+    if backend == "keras":
+        raise ValueError("the Keras model is the source, convert to onnx or tflite")
+    import tensorflow as tf
+    from keras.models import load_model
+    model = load_model(modelFile, compile=False)
+    outFile = backendFile(modelFile, backend)
+    tempName = outFile+".tmp"
+    if backend == "onnx":
+        import tf2onnx
+        # Batch size left open so several crops can go through in one call
+        signature = (tf.TensorSpec((None,)+tuple(model.input_shape[1:]), tf.float32, name="input"),)
+        tf2onnx.convert.from_keras(model, input_signature=signature, opset=ONNXOPSET, output_path=tempName)
+    else:
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        with open(tempName, "wb") as f:
+            f.write(converter.convert())
+    os.replace(tempName, outFile)
+    return outFile
+
+# Compare a backend with Keras on an image. Returns (largest probability difference, Keras class,
+# backend class).
+def parity(modelFile=MODELFILE, backend="onnx", imageFile=LATESTIMAGE, labelFile=LABELFILE):
+    data = preprocess(imageFile)
+    reference = CloudModel(modelFile, labelFile, "keras").predict(data)
+    candidate = CloudModel(modelFile, labelFile, backend).predict(data)
+    labels = readLabels(labelFile)
+    return float(np.abs(reference-candidate).max()), labels[int(np.argmax(reference))], labels[int(np.argmax(candidate))]
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert, check and run the allsky cloud model')
+    parser.add_argument('--model', type=str, default=MODELFILE, help='Keras model (.h5), converted models sit next to it')
+    parser.add_argument('--labels', type=str, default=LABELFILE, help='class labels')
+    commands = parser.add_subparsers(dest='command', required=True)
+    convert = commands.add_parser('convert', help='convert the Keras model for a backend')
+    convert.add_argument('--backend', choices=["onnx", "tflite"], default="onnx")
+    check = commands.add_parser('parity', help='compare a converted model with Keras on an image')
+    check.add_argument('--backend', choices=["onnx", "tflite"], default="onnx")
+    check.add_argument('--image', type=str, default=LATESTIMAGE)
+    check.add_argument('--tolerance', type=float, default=PARITYTOLERANCE, help='largest probability difference allowed')
+    classify = commands.add_parser('classify', help='classify an image')
+    classify.add_argument('--backend', choices=list(BACKENDEXTENSIONS), default=BACKEND)
+    classify.add_argument('--image', type=str, default=LATESTIMAGE)
+    classify.add_argument('--grid', type=int, nargs=2, metavar=('ROWS', 'COLS'), help='classify a grid of sky sectors')
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        start = time.perf_counter()
+        outFile = convertModel(args.model, args.backend)
+        print("Wrote {0} in {1:.1f}s".format(outFile, time.perf_counter()-start))
+    elif args.command == "parity":
+        difference, reference, candidate = parity(args.model, args.backend, args.image, args.labels)
+        passed = difference <= args.tolerance and reference == candidate
+        print("keras: {0}  {1}: {2}  largest probability difference {3:.2e}  {4}".format(
+              reference, args.backend, candidate, difference, "PASS" if passed else "FAIL"))
+        sys.exit(0 if passed else 1)
+    elif args.grid:
+        sky = CloudModel(args.model, args.labels, args.backend).classifySectors(args.image, tuple(args.grid))
+        print("{0} ({1:.3f}), cloud {2:.2f}".format(sky["verdict"], sky["confidence"], sky["cloud"]))
+        for cloud, classes in zip(sky["sectors"], sky["classes"]):
+            print("  ".join("{0:4.2f} {1:<13}".format(c, n) for c, n in zip(cloud, classes)))
+    else:
+        className, confidence = CloudModel(args.model, args.labels, args.backend).classify(args.image)
+        print("{0} ({1:.3f})".format(className, confidence))
+
+
+if __name__ == "__main__":
+    main()
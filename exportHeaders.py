@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+############################################################################################################
+#
+# Name        : exportHeaders.py
+# Purpose     : Export the header index as a typed, wide, columnar table (Parquet or Arrow IPC) for analysis
+# Author      : Gord Tulloch
+# Date        : March 18 2024
+# License     : GPL v3
+# Dependencies: pyarrow
+# Usage       : python exportHeaders.py --db "E:/00 Data Repository/obsy.db" --out "E:/Analysis/headers"
+#               then exportHeaders.readExport("E:/Analysis/headers").to_pandas()
+#
+# fitsHeader holds one row per card. The export pivots it into one row per file with a column per
+# keyword: numeric keywords become int64/float64 columns and the rest dictionary encoded strings, so
+# OBJECT, FILTER and friends cost a few bytes a row. Files are read a chunk at a time (by fitsFile rowid,
+# with the cards found through the fitsHeaderParent index) and each chunk is written as a row group /
+# record batch, so memory stays at one chunk whatever the size of the index.
+#
+# The output is a folder of parts (headers-00000.parquet, ...) with _export.json recording the columns and
+# the last fitsFile rowid exported. Running again only exports files added since then, as a new part with
+# the same column types (plus any new keywords), so the folder reads back as one dataset. A file re-indexed
+# after a change gets a new row in a later part; --full starts the export over. Later parts can have
+# keywords the first one hasn't, readExport reads the parts with their schemas merged.
+#
+############################################################################################################
+import argparse
+import os
+import json
+import time
+import glob
+import sqlite3
+import logging
+
+import obsyDB
+
+CHUNKFILES=2000         # files pivoted and written at a time
+STATEFILE="_export.json"     # leading _ so dataset readers skip it
+FORMATS={"parquet": ".parquet", "arrow": ".arrows"}
+
+############################################################################################################
+COLUMNTYPES=["int", "float", "string"]      # narrowest first, a column takes the widest type of its values
+
+# Type rank of one value: -1 for nothing (NULL or blank text), then the index of its COLUMNTYPES entry.
+# Values are stored with their Python type (obsyDB.cardValue) but older databases hold text, so text is
+# parsed: "12" is an int and "1.5e3" a float, while "2024-01-01" or "1-2" are strings.
+def valueRank(value):
+    if value is None:
+        return -1
+    if isinstance(value, int):
+        return 0
+    if isinstance(value, float):
+        return 1
+    text = str(value).strip()
+    if not text:
+        return -1
+    if "_" in text:
+        return 2    # int() and float() accept digit separators, FITS values don't have them
+    for rank, parse in ((0, int), (1, float)):
+        try:
+            parse(text)
+            return rank
+        except ValueError:
+            pass
+    return 2
+
+# Column type of every keyword of the files after rowid afterRowid: "int", "float" or "string", the widest
+# type of its values. An incremental export only looks at the files it is about to export and widens the
+# types already recorded with these.
+def keywordTypes(con, afterRowid=0):
+    con.create_function("valueRank", 1, valueRank, deterministic=True)
+    return {keyword: COLUMNTYPES[max(rank, 0)] for keyword, rank in
+            # CROSS JOIN keeps SQLite to the new fitsFile rows first and their cards through fitsHeaderParent,
+            # rather than scanning fitsHeader by keyword for the GROUP BY
+            con.execute("SELECT h.keyword, max(valueRank(h.value)) FROM fitsFile f CROSS JOIN fitsHeader h ON h.parentUNID=f.unid "
+                        "WHERE f.rowid>? GROUP BY h.keyword", (afterRowid,))}
+
+# The type a column exported as oldType has to take for values of newType. Numbers widen (int to float);
+# a column already exported as a number can't become a string in the same dataset, so it stays a number
+# (text values are null) until the export is started over with --full.
+def widenType(keyword, oldType, newType):
+    if oldType is None:
+        return newType
+    if newType == "string" and oldType != "string":
+        logging.warning("{0} now holds text but was exported as {1}, run with --full to export it as text".format(keyword, oldType))
+        return oldType
+    return COLUMNTYPES[max(COLUMNTYPES.index(oldType), COLUMNTYPES.index(newType))]
+
+# Convert one value to its column type, None if it doesn't fit. An int column never truncates, a value
+# with a fraction is None (keywordTypes makes such a column a float one).
+def convertValue(value, columnType):
+    if value is None:
+        return None
+    try:
+        if columnType == "string":
+            return str(value)
+        if columnType == "float":
+            return float(value)
+        if isinstance(value, float):
+            return int(value) if value.is_integer() else None
+        return int(str(value).strip()) if isinstance(value, str) else int(value)
+    except (TypeError, ValueError):
+        return None
+
+############################################################################################################
+# Pivot the files after rowid afterRowid, a chunk at a time. Yields (lastRowid, {column: [values]}).
+def pivotChunks(con, columns, afterRowid=0, chunkFiles=CHUNKFILES):
+    while True:
+        files = con.execute("SELECT rowid, unid, filename, date FROM fitsFile WHERE rowid>? ORDER BY rowid LIMIT ?",
+                            (afterRowid, chunkFiles)).fetchall()
+        if not files:
+            return
+        row = {unid: i for i, (rowid, unid, fileName, date) in enumerate(files)}
+        data = {"unid": [f[1] for f in files], "filename": [f[2] for f in files], "date": [f[3] for f in files]}
+        for keyword in columns:
+            data[keyword] = [None]*len(files)
+        for unid, keyword, value in con.execute(
+                "SELECT h.parentUNID, h.keyword, h.value FROM fitsFile f JOIN fitsHeader h ON h.parentUNID=f.unid "
+                "WHERE f.rowid BETWEEN ? AND ?", (files[0][0], files[-1][0])):
+            if keyword in data and unid in row:
+                data[keyword][row[unid]] = convertValue(value, columns[keyword])
+        afterRowid = files[-1][0]
+        yield afterRowid, data
+
+############################################################################################################
+# Arrow schema for the columns, strings dictionary encoded
+def arrowSchema(pa, columns):
+    arrowTypes = {"int": pa.int64(), "float": pa.float64(), "string": pa.dictionary(pa.int32(), pa.string())}
+    fields = [pa.field("unid", pa.string()), pa.field("filename", pa.string()), pa.field("date", pa.string())]
+    fields += [pa.field(keyword, arrowTypes[columnType]) for keyword, columnType in columns.items()]
+    return pa.schema(fields)
+
+def recordBatch(pa, schema, data):
+    arrays = []
+    for field in schema:
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(data[field.name], type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(data[field.name], type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+############################################################################################################
+# Export to a folder, incrementally unless full. Returns the number of files exported.
+def exportHeaders(con, outFolder, fileFormat="parquet", full=False, chunkFiles=CHUNKFILES):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    os.makedirs(outFolder, exist_ok=True)
+    stateName = os.path.join(outFolder, STATEFILE)
+    state = {"lastRowid": 0, "parts": 0, "columns": {}, "format": fileFormat}
+    if full:
+        for fileName in glob.glob(os.path.join(outFolder, "headers-*")):
+            os.remove(fileName)
+    elif os.path.isfile(stateName):
+        with open(stateName) as f:
+            state = json.load(f)
+        if state["format"] != fileFormat:
+            raise ValueError("{0} holds a {1} export, use --full to start a {2} one".format(outFolder, state["format"], fileFormat))
+
+    # Keep the columns already exported in order so the parts agree, widening int ones that now hold
+    # floats (readExport promotes the older parts), and add new keywords at the end
+    columns = dict(state["columns"])
+    for keyword, columnType in keywordTypes(con, state["lastRowid"]).items():
+        columns[keyword] = widenType(keyword, columns.get(keyword), columnType)
+    schema = arrowSchema(pa, columns)
+
+    partName = os.path.join(outFolder, "headers-{0:05d}{1}".format(state["parts"], FORMATS[fileFormat]))
+    tempName = os.path.join(outFolder, "_writing"+FORMATS[fileFormat])
+    writer = None
+    exported = 0
+    lastRowid = state["lastRowid"]
+    try:
+        for lastRowid, data in pivotChunks(con, columns, state["lastRowid"], chunkFiles):
+            batch = recordBatch(pa, schema, data)
+            if writer is None:
+                if fileFormat == "parquet":
+                    writer = pq.ParquetWriter(tempName, schema, use_dictionary=True, compression="zstd")
+                else:
+                    writer = pa.ipc.new_stream(tempName, schema)
+            if fileFormat == "parquet":
+                writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+            exported += batch.num_rows
+            print("Exported {0} files".format(exported))
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        return 0
+
+    # The part only counts once it is complete and the state says so
+    os.replace(tempName, partName)
+    state.update({"lastRowid": lastRowid, "parts": state["parts"]+1, "columns": columns,
+                  "exported": time.strftime("%Y-%m-%dT%H:%M:%S")})
+    with open(stateName+".tmp", "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(stateName+".tmp", stateName)
+    return exported
+
+# Read an export back as one pyarrow Table, columns missing from older parts are null
+def readExport(outFolder):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    with open(os.path.join(outFolder, STATEFILE)) as f:
+        fileFormat = json.load(f)["format"]
+    parts = sorted(glob.glob(os.path.join(outFolder, "headers-*"+FORMATS[fileFormat])))
+    if fileFormat == "arrow":
+        tables = []
+        for part in parts:
+            with pa.ipc.open_stream(part) as reader:
+                tables.append(reader.read_all())
+        return pa.concat_tables(tables, promote_options="permissive")
+    schema = pa.unify_schemas([ds.dataset(part, format="parquet").schema for part in parts], promote_options="permissive")
+    return ds.dataset(parts, format="parquet", schema=schema).to_table()
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the obsy.db header index to Parquet or Arrow')
+    parser.add_argument('--db', required=True, type=str, help='obsy.db to export')
+    parser.add_argument('--out', required=True, type=str, help='folder for the export')
+    parser.add_argument('--format', choices=list(FORMATS), default="parquet", help='output format')
+    parser.add_argument('--full', action='store_true', help='export everything again instead of only new files')
+    parser.add_argument('--chunk', type=int, default=CHUNKFILES, help='files per chunk')
+    args = parser.parse_args()
+
+    con = obsyDB.connectDB(args.db)
+    obsyDB.createTables(con)
+    start = time.perf_counter()
+    try:
+        exported = exportHeaders(con, args.out, args.format, args.full, args.chunk)
+    except (sqlite3.Error, ValueError) as e:
+        print("Export failed: {0}".format(e))
+        exported = 0
+    print("{0} files exported in {1:.1f}s".format(exported, time.perf_counter()-start))
+    con.close()
+
+
+if __name__ == "__main__":
+    main()
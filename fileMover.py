@@ -0,0 +1,243 @@
+############################################################################################################
+#
+# Name        : fileMover.py
+# Purpose     : Crash safe, concurrent moves of frames into the repository, journalled in obsy.db
+# Author      : Gord Tulloch
+# Date        : March 12 2024
+# License     : GPL v3
+# Dependencies: numpy, astropy
+# Usage       : mover=fileMover.FileMover(con)
+#               fileMover.recoverMoves(con, mover)        # finish anything a crash left half done
+#               mover.submit(source, destination)          # once the pending journal row is committed
+#               mover.close()
+#
+# Every move goes through the fileMove table in three states:
+#   pending   - written in the same transaction as the file's index rows (obsyDB.FitsIngest move=...)
+#   moved     - the destination is complete and verified, the source may still exist
+#   committed - the source is gone, nothing left to do
+#   lost      - found by recovery with neither file there, the index rows have been removed
+# On the same filesystem a move is a single os.replace, which is atomic, so it goes straight from
+# pending to committed. Across filesystems (onto the NAS) the file is copied to destination.part in large
+# chunks while it is hashed, read back and hashed again, renamed into place and only then marked moved;
+# the source is removed after that is committed. Copies run in a pool of threads so several files are on
+# the wire at once. Workers only touch files, the journal is written by the thread that owns the
+# connection.
+#
+# A destination ending in .fz (postProcess.py ARCHIVE) is written tile compressed instead of copied, on
+# any filesystem: Rice for integer data, lossless GZIP for floating point. The compressed .part file is read
+# back and its image and header compared with the source before it is renamed into place and marked moved,
+# so archiving never loses a bit. The raw and compressed sizes go into fitsArchive. Compressing is CPU
+# bound, so with processes=True the moves run in a pool of processes rather than threads.
+#
+# recoverMoves looks at every pending or moved row when a script starts and carries the move on from
+# wherever it stopped, so a crash never leaves the index naming a file that isn't there.
+#
+############################################################################################################
+import os
+import logging
+import sqlite3
+import numpy as np
+from astropy.io import fits
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import obsyDB
+import fitsScan
+import stackEngine
+
+MOVEWORKERS=4           # files copied at once across filesystems
+CHUNKSIZE=fitsScan.CHUNKSIZE   # bytes per read/write when copying
+PARTSUFFIX=".part"
+COMPRESSEDSUFFIX=".fz"
+INTCOMPRESSION="RICE_1"         # tile compression of integer images, lossless
+FLOATCOMPRESSION="GZIP_2"       # floating point images, with quantization off so it is lossless
+STRUCTURALCARDS=("SIMPLE","XTENSION","BITPIX","NAXIS","NAXIS1","NAXIS2","NAXIS3","EXTEND","PCOUNT","GCOUNT",
+                 "BZERO","BSCALE","CHECKSUM","DATASUM")
+
+############################################################################################################
+# True if source and the folder destination will go into are on the same filesystem
+def sameFilesystem(source, destination):
+    folder = os.path.dirname(os.path.abspath(destination))
+    while not os.path.exists(folder):
+        folder = os.path.dirname(folder)
+    return os.stat(source).st_dev == os.stat(folder).st_dev
+
+# Copy source to destination through a .part file, hashing as it goes (the same content checksum as
+# fitsScan), then check the copy by reading it back. Returns the checksum, raises OSError if the copy does
+# not match.
+def copyVerified(source, destination, chunkSize=CHUNKSIZE):
+    partName = destination+PARTSUFFIX
+    digest = fitsScan.newHash()
+    with open(source, "rb") as fin, open(partName, "wb") as fout:
+        for chunk in iter(lambda: fin.read(chunkSize), b""):
+            digest.update(chunk)
+            fout.write(chunk)
+        fout.flush()
+        os.fsync(fout.fileno())
+    checksum = fitsScan.checksumString(digest)
+    if fitsScan.fileChecksum(partName, chunkSize=chunkSize) != checksum:
+        os.remove(partName)
+        raise OSError("Checksum mismatch copying {0} to {1}".format(source, destination))
+    os.replace(partName, destination)
+    return checksum
+
+# Header cards that describe the data rather than the frame, which compression is allowed to change
+def frameCards(hdr):
+    return [(card.keyword, card.value) for card in hdr.cards if card.keyword not in STRUCTURALCARDS]
+
+# Write source to destination tile compressed through a .part file, read it back and check the image and
+# header are exactly the source's. Returns (checksum of the compressed file, (raw size, compressed size,
+# compression)), raises OSError if the round trip isn't lossless.
+def compressVerified(source, destination):
+    partName = destination+PARTSUFFIX
+    # Scaled, so 16 bit frames come back as uint16 and astropy writes them with BZERO 32768 again
+    with fits.open(source) as hdul:
+        hdu = stackEngine.imageHDU(hdul)
+        data, header = hdu.data, hdu.header
+        if data is None:
+            raise OSError("{0} has no image to compress".format(source))
+        isFloat = data.dtype.kind == "f"
+        if isFloat:
+            compressed = fits.CompImageHDU(data, header, compression_type=FLOATCOMPRESSION, quantize_level=0.0)
+        else:
+            compressed = fits.CompImageHDU(data, header, compression_type=INTCOMPRESSION)
+        fits.HDUList([fits.PrimaryHDU(), compressed]).writeto(partName, overwrite=True)
+        with open(partName, "rb") as f:
+            os.fsync(f.fileno())
+        with fits.open(partName) as check:
+            lossless = (np.array_equal(check[1].data, data, equal_nan=isFloat) and
+                        frameCards(check[1].header) == frameCards(header))
+    if not lossless:
+        os.remove(partName)
+        raise OSError("Compressing {0} was not lossless, left uncompressed".format(source))
+    checksum = fitsScan.fileChecksum(partName)
+    os.replace(partName, destination)
+    return checksum, (os.path.getsize(source), os.path.getsize(destination), FLOATCOMPRESSION if isFloat else INTCOMPRESSION)
+
+############################################################################################################
+# Worker function: get source to destination. Returns (source, state, checksum, archive), state is
+# "committed" for a rename (nothing left to do) or "moved" for a verified copy or compressed file whose
+# source still has to be removed. archive is (raw size, compressed size, compression) for a compressed
+# move, otherwise None.
+def moveFile(source, destination):
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    if destination.endswith(COMPRESSEDSUFFIX):
+        checksum, archive = compressVerified(source, destination)
+        return source, "moved", checksum, archive
+    if sameFilesystem(source, destination):
+        os.replace(source, destination)
+        return source, "committed", None, None
+    return source, "moved", copyVerified(source, destination), None
+
+############################################################################################################
+# FileMover - runs moves on a thread pool (a process pool with processes, for compressing) and keeps the
+# journal up to date from the calling thread
+class FileMover():
+    def __init__(self, con, workers=MOVEWORKERS, processes=False):
+        self.con = con
+        self.pool = ProcessPoolExecutor(max_workers=workers) if processes else ThreadPoolExecutor(max_workers=workers)
+        self.maxOutstanding = workers*4
+        self.futures = {}
+        self.moved = 0
+        self.failed = 0
+
+    # Start moving a file whose pending journal row is committed. Waits for earlier moves if too many
+    # are outstanding, so a big night doesn't queue every file at once.
+    def submit(self, source, destination):
+        self.collect()
+        while len(self.futures) >= self.maxOutstanding:
+            self.collect(block=True)
+        self.futures[self.pool.submit(moveFile, source, destination)] = (source, destination)
+        return
+
+    # Record finished moves in the journal. With block, wait until at least one has finished.
+    def collect(self, block=False):
+        if not self.futures:
+            return 0
+        done, notDone = wait(list(self.futures), timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        states = []
+        for future in done:
+            source, destination = self.futures.pop(future)
+            try:
+                states.append(future.result())
+            except Exception as e:
+                # Left pending in the journal for recoverMoves, the other moves carry on
+                logging.error("Unable to move {0} to {1}: {2}: {3}".format(source, destination, type(e).__name__, e))
+                self.failed += 1
+        self.record(states)
+        # Copies are in place and journalled as moved, the sources can go
+        removed = []
+        for source, state, checksum, archive in states:
+            if state == "moved":
+                try:
+                    os.remove(source)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logging.error("Unable to remove {0} after copying it: {1}".format(source, e))
+                    continue
+                removed.append((source, "committed", checksum, None))
+        self.record(removed)
+        self.moved += sum(1 for source, state, checksum, archive in states if state == "committed")+len(removed)
+        return len(done)
+
+    # Journal (source, state, checksum, archive) results, with the sizes of compressed files
+    def record(self, states):
+        if not states:
+            return
+        try:
+            with self.con:
+                self.con.executemany("UPDATE fileMove SET state=?, checksum=coalesce(?, checksum), updated=datetime('now') WHERE source=?",
+                                     [(state, checksum, source) for source, state, checksum, archive in states])
+                self.con.executemany("INSERT OR REPLACE INTO fitsArchive (unid, rawsize, size, ratio, compression, created) "
+                                     "SELECT unid, ?, ?, ?, ?, datetime('now') FROM fileMove WHERE source=? AND unid IS NOT NULL",
+                                     [(archive[0], archive[1], archive[0]/max(archive[1], 1), archive[2], source)
+                                      for source, state, checksum, archive in states if archive is not None])
+        except sqlite3.Error as er:
+            logging.error('SQLite error: %s' % (' '.join(er.args)))
+
+    # Wait for every outstanding move
+    def drain(self):
+        while self.futures:
+            self.collect(block=True)
+
+    def close(self):
+        self.drain()
+        self.pool.shutdown()
+
+############################################################################################################
+# Finish the moves a crash interrupted. Returns the number of journal rows looked at.
+def recoverMoves(con, mover):
+    rows = con.execute("SELECT source, destination, unid, state, checksum FROM fileMove WHERE state IN ('pending','moved')").fetchall()
+    lost = []
+    for source, destination, unid, state, checksum in rows:
+        if os.path.isfile(destination+PARTSUFFIX):
+            os.remove(destination+PARTSUFFIX)
+        sourceExists, destinationExists = os.path.isfile(source), os.path.isfile(destination)
+        if state == "pending":
+            if sourceExists:
+                # Never started, or a copy was interrupted: do it again
+                logging.info("Recovering move of {0}".format(source))
+                mover.submit(source, destination)
+            elif destinationExists:
+                # The rename happened but was not recorded
+                mover.record([(source, "committed", None, None)])
+            else:
+                logging.error("{0} and {1} are both missing, removed from the index".format(source, destination))
+                lost.append((source, unid))
+        elif state == "moved":
+            if sourceExists and destinationExists and (checksum is None or fitsScan.fileChecksum(destination) == checksum):
+                # Copied and verified, only the source was left
+                os.remove(source)
+                mover.record([(source, "committed", None, None)])
+            elif sourceExists:
+                mover.submit(source, destination)
+            elif destinationExists:
+                mover.record([(source, "committed", None, None)])
+            else:
+                logging.error("{0} and {1} are both missing, removed from the index".format(source, destination))
+                lost.append((source, unid))
+    if lost:
+        with con:
+            obsyDB.deleteUnids(con, [(unid,) for source, unid in lost if unid is not None])
+        mover.record([(source, "lost", None, None) for source, unid in lost])
+    mover.drain()
+    return len(rows)
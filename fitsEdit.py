@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+############################################################################################################
+#
+# Name        : fitsEdit.py
+# Purpose     : Bulk edit the primary header of FITS files in place without rewriting the image data
+# Author      : Gord Tulloch
+# Date        : February 22 2024
+# License     : GPL v3
+# Dependencies: astropy
+# Usage       : fitsEdit.patchHeader(fileName, {"OBJECT": "NGC7635"}) from a script, or from the command line
+#               python fitsEdit.py FOLDER --set OBJECT=NGC7635 --where FRAME=Light --db obsy.db --dry_run
+#
+# The header is a whole number of 2880 byte blocks ending with the END card and its padding. As long as
+# the edited header still fits in the same number of blocks it is written straight over the old one through
+# an mmap and the data is never touched. Only when the header has to grow is the file rewritten.
+#
+############################################################################################################
+import argparse
+import fnmatch
+import os
+import mmap
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from astropy.io import fits
+
+import fitsScan
+import obsyDB
+
+BLOCKSIZE=2880
+CARDSIZE=80
+
+############################################################################################################
+# Length in bytes of the primary header (including padding) in a buffer holding the start of the file,
+# None if there is no END card
+def headerLength(buffer):
+    for offset in range(0, len(buffer)-BLOCKSIZE+1, BLOCKSIZE):
+        for i in range(offset, offset+BLOCKSIZE, CARDSIZE):
+            if buffer[i:i+8] == b"END     ":
+                return offset+BLOCKSIZE
+    return None
+
+############################################################################################################
+# Apply card changes to a header object: renames first, then deletes, then sets. Returns a list of
+# (keyword, old value, new value) describing what changed, None standing for a missing card.
+def applyCards(hdr, cards=None, deleteCards=(), renameCards=None):
+    changes=[]
+    for oldKeyword, newKeyword in (renameCards or {}).items():
+        if oldKeyword in hdr and newKeyword not in hdr:
+            hdr.rename_keyword(oldKeyword, newKeyword)
+            changes.append((oldKeyword+" -> "+newKeyword, hdr[newKeyword], hdr[newKeyword]))
+    for keyword in deleteCards:
+        if keyword in hdr:
+            changes.append((keyword, hdr[keyword], None))
+            del hdr[keyword]
+    for keyword, value in (cards or {}).items():
+        oldValue=hdr.get(keyword)
+        if keyword not in hdr or oldValue != value:
+            hdr.set(keyword, value)
+            changes.append((keyword, oldValue, value))
+    return changes
+
+############################################################################################################
+# True if the header matches every KEYWORD=value in where (compared as strings)
+def headerMatches(hdr, where):
+    for keyword, value in (where or {}).items():
+        if keyword not in hdr or str(hdr[keyword]).strip() != str(value):
+            return False
+    return True
+
+############################################################################################################
+# Rewrite the whole file through astropy, used when the header no longer fits in its blocks
+def rewriteHeader(fileName, cards=None, deleteCards=(), renameCards=None):
+    with fits.open(fileName) as hdul:
+        changes=applyCards(hdul[0].header, cards, deleteCards, renameCards)
+        hdr=hdul[0].header.copy()
+        hdul.writeto(fileName, overwrite=True)
+    return "rewritten", changes, hdr
+
+############################################################################################################
+# Edit the primary header of one file. Returns (fileName, result, changes, header) where result is one of
+# "patched" (written in place), "rewritten" (header grew, whole file written), "dry run", "unchanged",
+# "skipped" (where did not match) or None if the file is not a FITS file. header is the edited header.
+# This is also the worker function for editFiles so it has to return everything the writer needs.
+def editFile(fileName, cards=None, deleteCards=(), renameCards=None, where=None, inPlace=True, dryRun=False):
+    if dryRun or where:
+        hdr=fitsScan.readPrimaryHeader(fileName)
+        if hdr is None:
+            return fileName, None, [], None
+        if not headerMatches(hdr, where):
+            return fileName, "skipped", [], None
+        if dryRun:
+            changes=applyCards(hdr, cards, deleteCards, renameCards)
+            return fileName, "dry run" if changes else "unchanged", changes, hdr
+
+    if not inPlace:
+        return (fileName,)+rewriteHeader(fileName, cards, deleteCards, renameCards)
+
+    with open(fileName, "r+b") as f:
+        if os.fstat(f.fileno()).st_size < BLOCKSIZE:
+            return fileName, None, [], None
+        with mmap.mmap(f.fileno(), 0) as mm:
+            if not mm[:9] == b"SIMPLE  =":
+                return fileName, None, [], None
+            length = headerLength(mm)
+            if length is None:
+                logging.warning("No END card in header of "+fileName)
+                return fileName, None, [], None
+            hdr = fits.Header.fromstring(mm[:length].decode("ascii", errors="replace"))
+            changes = applyCards(hdr, cards, deleteCards, renameCards)
+            if not changes:
+                return fileName, "unchanged", changes, hdr
+            newHeader = hdr.tostring().encode("ascii")
+            if len(newHeader) == length:
+                mm[:length] = newHeader
+                mm.flush()
+                return fileName, "patched", changes, hdr
+
+    # Header grew into another block, fall back to a full rewrite
+    return (fileName,)+rewriteHeader(fileName, cards, deleteCards, renameCards)
+
+############################################################################################################
+# Change cards in the primary header of one file, returns the result string from editFile
+def patchHeader(fileName, cards, inPlace=True):
+    return editFile(fileName, cards, inPlace=inPlace)[1]
+
+############################################################################################################
+# Edit many files across a pool of worker processes. The calling process is the only writer to the
+# database: with a connection given, the index rows of every edited file are replaced as results come in
+# so obsy.db stays consistent without a rescan. Yields the editFile result of each file.
+def editFiles(fileNames, cards=None, deleteCards=(), renameCards=None, where=None, inPlace=True, dryRun=False,
+              con=None, workers=None, batchSize=obsyDB.BATCHSIZE):
+    worker=partial(editFile, cards=cards, deleteCards=deleteCards, renameCards=renameCards, where=where,
+                   inPlace=inPlace, dryRun=dryRun)
+    edited=[]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(worker, fileNames, chunksize=8):
+            fileName, status, changes, hdr = result
+            if con is not None and status in ("patched", "rewritten"):
+                edited.append((fileName, hdr))
+                if len(edited) >= batchSize:
+                    obsyDB.updateHeaders(con, edited)
+                    edited=[]
+            yield result
+    if con is not None and edited:
+        obsyDB.updateHeaders(con, edited)
+
+############################################################################################################
+# Command line helpers
+def parseValue(value):
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    if value in ("T", "F"):
+        return value == "T"
+    return value
+
+def parsePairs(pairs, convert=parseValue):
+    result={}
+    for pair in pairs or []:
+        if "=" not in pair:
+            raise argparse.ArgumentTypeError("Expected KEYWORD=VALUE, got "+pair)
+        keyword, value = pair.split("=", 1)
+        result[keyword.strip().upper()]=convert(value)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk edit FITS headers')
+    parser.add_argument('folder', type=str, help='folder to search for FITS files')
+    parser.add_argument('--glob', type=str, default=None, help='only edit files whose name matches, fi "*Ha*.fits"')
+    parser.add_argument('--where', nargs='+', metavar='KEYWORD=VALUE', help='only edit files with these card values')
+    parser.add_argument('--set', nargs='+', metavar='KEYWORD=VALUE', help='cards to set')
+    parser.add_argument('--delete', nargs='+', metavar='KEYWORD', default=[], help='cards to delete')
+    parser.add_argument('--rename', nargs='+', metavar='OLD=NEW', help='cards to rename')
+    parser.add_argument('--db', type=str, default=None, help='obsy.db to keep in step with the edits')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, default one per CPU')
+    parser.add_argument('--rewrite', action='store_true', help='always rewrite the whole file')
+    parser.add_argument('--dry_run', action='store_true', help='report what would change without writing')
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='fitsEdit.log', filemode='w', format='%(name)s - %(levelname)s - %(message)s')
+
+    cards=parsePairs(args.set)
+    renameCards=parsePairs(args.rename, convert=lambda value: value.strip().upper())
+    deleteCards=[keyword.upper() for keyword in args.delete]
+    where=parsePairs(args.where, convert=str)
+    fileNames=[fileName for fileName in fitsScan.findFitsFiles(args.folder)
+               if args.glob is None or fnmatch.fnmatch(os.path.basename(fileName), args.glob)]
+
+    con=None
+    if args.db and not args.dry_run:
+        con=obsyDB.connectDB(args.db)
+        obsyDB.createTables(con)
+
+    counts={}
+    for fileName, status, changes, hdr in editFiles(fileNames, cards, deleteCards, renameCards, where,
+                                                    not args.rewrite, args.dry_run, con, args.workers):
+        status=status or "not FITS"
+        counts[status]=counts.get(status, 0)+1
+        if changes:
+            print(fileName, status)
+            for keyword, oldValue, newValue in changes:
+                print("    {0}: {1} -> {2}".format(keyword, oldValue, newValue))
+    print(", ".join("{0} {1}".format(count, status) for status, count in counts.items()))
+
+    if con is not None:
+        con.close()
+
+
+if __name__ == "__main__":
+    main()
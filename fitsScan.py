@@ -0,0 +1,162 @@
+############################################################################################################
+#
+# Name        : fitsScan.py
+# Purpose     : Fast scanning of a folder tree of FITS files, reading only the primary header of each file
+#               across a pool of worker processes
+# Author      : Gord Tulloch
+# Date        : February 20 2024
+# License     : GPL v3
+# Dependencies: astropy
+# Usage       : for fileName, hdr in fitsScan.scanFolder(sourceFolder):
+#                   ...
+#               The caller is the single writer, workers never touch the database. Scripts using this
+#               must guard their mainline with if __name__ == "__main__": so workers can be spawned.
+#
+# With checksum=True the workers also hash the whole file (CHECKSUMHASH, read in CHUNKSIZE pieces) and
+# with quality=True they measure the frame (frameQuality.py, needs numpy and scipy). thumbnails is a cache
+# folder to make each frame's thumbnail in (thumbnailCache.py), which needs the checksum so implies it.
+# With any of these the scan yields (fileName, header, checksum, quality, thumbnail), None for what wasn't
+# asked for. The hash name is stored with the digest so checksums made with different hashes never
+# compare equal. The default is blake2b, which is always there. xxh3 is faster but needs the xxhash
+# package and is only used if CHECKSUMHASH is set to it; it isn't picked automatically because switching
+# hash on a repository makes every file look new to the duplicate check.
+#
+############################################################################################################
+import os
+import logging
+import hashlib
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from astropy.io import fits
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+FITSEXTENSIONS=(".fits",".fit",".fts")
+COMPRESSEDEXTENSIONS=(".fz",)   # tile compressed (fpack), written by the repository's archival mode
+REPOEXTENSIONS=FITSEXTENSIONS+COMPRESSEDEXTENSIONS
+BLOCKSIZE=2880
+CARDSIZE=80
+CHECKSUMHASH="blake2b"          # "blake2b" (default) or "xxh3" (needs xxhash, set it before the first checksum run)
+CHUNKSIZE=8*1024*1024           # bytes per read when hashing
+
+############################################################################################################
+# Read the header blocks starting at the current position of f up to the END card, None at end of file
+def readHeaderBlocks(f, first=b"SIMPLE  ="):
+    blocks=[]
+    while True:
+        block=f.read(BLOCKSIZE)
+        if len(block) < BLOCKSIZE:
+            return None
+        if not blocks and not block.startswith(first):
+            return None
+        blocks.append(block)
+        for i in range(0, BLOCKSIZE, CARDSIZE):
+            if block[i:i+8] == b"END     ":
+                return b"".join(blocks)
+
+# Read the primary header of a FITS file one 2880 byte block at a time, stopping at the END card so the
+# data is never read. Returns None if the file is not a FITS file. A tile compressed file has an empty
+# primary HDU followed by the compressed image as a binary table; for those the header of the image is
+# returned, as astropy rebuilds it from the table header, still without decompressing anything.
+def readPrimaryHeader(fileName):
+    try:
+        with open(fileName, "rb") as f:
+            buffer=readHeaderBlocks(f)
+            if buffer is None:
+                return None
+            hdr=fits.Header.fromstring(buffer.decode("ascii", errors="replace"))
+            if hdr.get("NAXIS", 0) == 0 and hdr.get("EXTEND", False):
+                extension=readHeaderBlocks(f, b"XTENSION=")
+                if extension is not None and b"ZIMAGE  =                    T" in extension:
+                    with fits.open(fileName) as hdul:
+                        return hdul[1].header.copy()
+            return hdr
+    except (OSError, ValueError) as e:
+        logging.warning("Unable to read header of {0}: {1}".format(fileName, e))
+        return None
+
+############################################################################################################
+# A new hash object for content checksums
+def newHash(hashName=CHECKSUMHASH):
+    if hashName == "xxh3":
+        if xxhash is None:
+            raise ValueError("xxh3 checksums need the xxhash package")
+        return xxhash.xxh3_128()
+    if hashName == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.new(hashName)
+
+# Checksum string for a finished hash, "name:hexdigest"
+def checksumString(digest, hashName=CHECKSUMHASH):
+    return hashName+":"+digest.hexdigest()
+
+# Checksum of a file's whole content, read in large chunks. None if the file can't be read.
+def fileChecksum(fileName, hashName=CHECKSUMHASH, chunkSize=CHUNKSIZE):
+    digest = newHash(hashName)
+    try:
+        with open(fileName, "rb") as f:
+            for chunk in iter(lambda: f.read(chunkSize), b""):
+                digest.update(chunk)
+    except OSError as e:
+        logging.warning("Unable to checksum {0}: {1}".format(fileName, e))
+        return None
+    return checksumString(digest, hashName)
+
+############################################################################################################
+# Worker function, returns the file name with its header so results can be matched up by the writer, and
+# the content checksum, quality metrics and thumbnail when asked for. A file that can't be read or
+# processed comes back with a None header.
+def scanFile(fileName, checksum=False, quality=False, thumbnails=None):
+    try:
+        return scanOne(fileName, checksum, quality, thumbnails)
+    except Exception as e:
+        # One bad frame mustn't take the rest of the batch (the whole pool.map) down with it
+        logging.error("Unable to scan {0}: {1}: {2}".format(fileName, type(e).__name__, e))
+        if not (checksum or quality or thumbnails):
+            return fileName, None
+        return fileName, None, None, None, None
+
+def scanOne(fileName, checksum, quality, thumbnails):
+    if not (checksum or quality or thumbnails):
+        return fileName, readPrimaryHeader(fileName)
+    hdr = readPrimaryHeader(fileName)
+    if hdr is None:
+        return fileName, None, None, None, None
+    digest = fileChecksum(fileName) if (checksum or thumbnails) else None
+    metrics = thumbName = None
+    if quality:
+        import frameQuality
+        metrics = frameQuality.measureFrame(fileName)
+    if thumbnails and digest is not None:
+        import thumbnailCache
+        digest, thumbName = thumbnailCache.makeThumbnail(fileName, thumbnails, digest)
+    return fileName, hdr, digest, metrics, thumbName
+
+############################################################################################################
+# List every FITS file below a folder
+def findFitsFiles(folder, extensions=FITSEXTENSIONS):
+    for root, dirs, files in os.walk(os.path.abspath(folder)):
+        for file in files:
+            if os.path.splitext(file)[1].lower() in extensions:
+                yield os.path.join(root, file)
+
+############################################################################################################
+# Scan a folder (or a list of files) and yield (fileName, header) in the order the files were found.
+# Files that are not valid FITS come back with a header of None. workers=1 scans in this process, which
+# is useful for debugging and for tiny folders where starting a pool costs more than it saves.
+def scanFiles(fileNames, workers=None, chunkSize=16, checksum=False, quality=False, thumbnails=None):
+    if workers == 1:
+        for fileName in fileNames:
+            yield scanFile(fileName, checksum, quality, thumbnails)
+        return
+    if quality or thumbnails:
+        # Measuring and thumbnails read the whole frame, smaller chunks keep the workers evenly loaded
+        chunkSize = min(chunkSize, 2)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(partial(scanFile, checksum=checksum, quality=quality, thumbnails=thumbnails), fileNames, chunksize=chunkSize):
+            yield result
+
+def scanFolder(folder, workers=None, extensions=FITSEXTENSIONS, checksum=False, quality=False, thumbnails=None):
+    return scanFiles(list(findFitsFiles(folder, extensions)), workers, checksum=checksum, quality=quality, thumbnails=thumbnails)
@@ -5,19 +5,22 @@
 # Author      : Gord Tulloch
 # Date        : January 25 2024
 # License     : GPL v3
-# Dependencies: None
+# Dependencies: astropy
+# Usage       : Set picturesFolder and objectName below. With INPLACE set only the header block of each
+#               file is rewritten, the image data is left alone unless the header has to grow.
 #
 ############################################################################################################ 
 # # 
 import os
-from astropy.io import fits
 import logging
+import fitsEdit
 
 DEBUG=True
 
 # Variable Declarations
 picturesFolder="/home/gtulloch/Dropbox/Astronomy/00 Telescope Data/SPAO/20231216/NGC7635"
 objectName = "NGC7635"
+INPLACE = True
 
 # Set up logging
 logging.basicConfig(filename='fixFitsName.log', filemode='w', format='%(name)s - %(levelname)s - %(message)s')
@@ -28,8 +31,7 @@ for root, dirs, files in os.walk(os.path.abspath(picturesFolder)):
         file_name, file_extension = os.path.splitext(os.path.join(root, file))
         if file_extension !=".fits":
             continue
-        print(os.path.join(root, file))
-        hdul = fits.open(os.path.join(root, file))
-        hdr = hdul[0].header
-        hdr.set('OBJECT', objectName)
-        hdul.writeto(os.path.join(root, file),overwrite=True)
+        result = fitsEdit.patchHeader(os.path.join(root, file), {'OBJECT': objectName}, inPlace=INPLACE)
+        print(os.path.join(root, file), result)
+        if result is None:
+            logging.warning("Invalid FITS file. File not processed is "+str(os.path.join(root, file)))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+############################################################################################################
+#
+# Name        : frameQuality.py
+# Purpose     : Per-frame quality metrics (background, noise, star count, FWHM, eccentricity) measured as
+#               frames are indexed, for filtering frames before stacking or combining
+# Author      : Gord Tulloch
+# Date        : March 20 2024
+# License     : GPL v3
+# Dependencies: numpy, scipy, astropy
+# Usage       : quality=frameQuality.measureFrame(fileName)     # dict with the fitsQuality columns
+#               frameQuality.acceptable(quality, maxFwhm=4.0, minStars=50)
+#               or scan with fitsScan.scanFolder(folder, quality=True) and pass the result to
+#               obsyDB.FitsIngest.submitFile(..., quality=...)
+#               python frameQuality.py --db "E:/00 Data Repository/obsy.db"   # measure frames indexed before
+#
+# The frame is read through a memmap and binned (starAlign.binImage) so the whole frame is only touched
+# once. Background and noise come from a sparse sample of each TILE x TILE tile of the binned image: the
+# background is the median of the tile medians (a gradient or a bright corner doesn't pull it) and the
+# noise the clipped deviation of the sample about its own tile, as a sigma per full resolution pixel. Stars are the
+# smoothed local maxima above DETECTSIGMA noise, found much as starAlign.py does. FWHM and eccentricity
+# come from the second moments of a small full resolution cutout around up to MEASURESTARS of the
+# brightest unsaturated stars, taken straight from the memmap, and are the medians over those stars.
+# FWHM is in full resolution pixels.
+#
+# Calibration frames get a background and noise, their star count is ~0 and FWHM/eccentricity are None.
+#
+############################################################################################################
+import argparse
+import os
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import ndimage
+
+import obsyDB
+import starAlign
+import stackEngine
+
+BINNING=2               # binning of the image used for background, noise and detection
+TILE=64                 # background tile size in binned pixels
+TILESTEP=4              # sample every 4th pixel of a tile in each direction
+DETECTSIGMA=starAlign.DETECTSIGMA
+MEASURESTARS=100        # brightest unsaturated stars measured for FWHM and eccentricity
+MINSTARS=5              # stars needed to report FWHM and eccentricity
+BOXRADIUS=8             # largest half size of the full resolution cutout around each star
+SATURATION=0.95         # fraction of the integer full scale treated as saturated
+SIGMATOFWHM=2.3548
+
+QUALITYCOLUMNS=("background","noise","stars","fwhm","eccentricity")
+
+############################################################################################################
+# Background map and noise of a binned image. Returns (background per tile, background, noise).
+def tileBackground(image, tile=TILE, step=TILESTEP):
+    ny, nx = max(image.shape[0]//tile, 1), max(image.shape[1]//tile, 1)
+    th, tw = image.shape[0]//ny//step*step, image.shape[1]//nx//step*step
+    sample = image[:ny*th:step, :nx*tw:step]
+    sample = sample.reshape(ny, sample.shape[0]//ny, nx, sample.shape[1]//nx).transpose(0, 2, 1, 3).reshape(ny, nx, -1)
+    tiles = np.median(sample, axis=2)
+    # The MAD of integer data comes in steps, so refine it with the mean absolute deviation of the pixels
+    # within 5 sigma of their tile (1.2533 scales that to sigma for Gaussian noise)
+    deviation = np.abs(sample-tiles[..., None])
+    noise = 1.4826*float(np.median(deviation))
+    clipped = deviation[deviation < 5*noise]
+    if clipped.size:
+        noise = 1.2533*float(clipped.mean())
+    return tiles, float(np.median(tiles)), noise
+
+# Expand the tile background map to the full binned image, nearest tile
+def backgroundMap(tiles, shape):
+    rows = np.minimum(np.arange(shape[0])*tiles.shape[0]//shape[0], tiles.shape[0]-1)
+    cols = np.minimum(np.arange(shape[1])*tiles.shape[1]//shape[1], tiles.shape[1]-1)
+    return tiles[rows[:, None], cols[None, :]]
+
+############################################################################################################
+# Local maxima of a smoothed image above threshold, at least edge pixels in from the border, as (y, x).
+# Only the pixels above threshold are compared with their 5x5 neighbourhood, which on a star field is a
+# small fraction of the image; a maximum filter over the whole image is only used when most of it is
+# above threshold (a nebula filling the frame, or a bad background).
+def localMaxima(smooth, threshold, edge):
+    above = smooth > threshold
+    above[:edge,:] = above[-edge:,:] = above[:,:edge] = above[:,-edge:] = False
+    y, x = np.nonzero(above)
+    if len(y) > smooth.size//20:
+        peaks = above & (smooth == ndimage.maximum_filter(smooth, size=5))
+        return np.nonzero(peaks)
+    offsets = np.arange(-2, 3)
+    neighbours = smooth[y[:,None,None]+offsets[None,:,None], x[:,None,None]+offsets[None,None,:]]
+    peak = smooth[y, x] >= neighbours.max(axis=(1,2))
+    return y[peak], x[peak]
+
+############################################################################################################
+# Second moment shape of full resolution cutouts, all stars at once. boxes is (n, size, size) with the
+# background taken off. Returns (fwhm, eccentricity) arrays.
+def momentShape(boxes):
+    size = boxes.shape[1]
+    w = np.clip(boxes, 0, None)
+    total = w.sum(axis=(1,2))
+    total[total <= 0] = np.nan
+    grid = np.arange(size, dtype=np.float64)
+    cy = (w*grid[None,:,None]).sum(axis=(1,2))/total
+    cx = (w*grid[None,None,:]).sum(axis=(1,2))/total
+    dy = grid[None,:,None]-cy[:,None,None]
+    dx = grid[None,None,:]-cx[:,None,None]
+    myy = (w*dy*dy).sum(axis=(1,2))/total
+    mxx = (w*dx*dx).sum(axis=(1,2))/total
+    mxy = (w*dx*dy).sum(axis=(1,2))/total
+    half = (mxx+myy)/2
+    root = np.sqrt(((mxx-myy)/2)**2+mxy**2)
+    major, minor = half+root, np.clip(half-root, 0, None)
+    fwhm = SIGMATOFWHM*np.sqrt(half)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        eccentricity = np.sqrt(np.clip(1-minor/major, 0, 1))
+    return fwhm, eccentricity
+
+############################################################################################################
+# Measure a frame held as a 2D array (a memmap is fine), raw values scaled by bscale/bzero. saturation is
+# the scaled level above which a star is not measured, None for no check.
+def measureData(data, bscale=1.0, bzero=0.0, saturation=None, binning=BINNING):
+    image = starAlign.binImage(data, binning)
+    if bscale != 1.0:
+        image *= np.float32(bscale)
+    if bzero:
+        image += np.float32(bzero)
+    tiles, background, noise = tileBackground(image)
+    quality = {"background": background, "noise": noise*binning, "stars": 0, "fwhm": None, "eccentricity": None}
+    if noise <= 0:
+        return quality
+
+    # Detection on the binned image with the background map taken off
+    image -= backgroundMap(tiles, image.shape)
+    smooth = ndimage.gaussian_filter(image, 1.0, truncate=3.0)
+    y, x = localMaxima(smooth, DETECTSIGMA*noise, BOXRADIUS//binning+2)
+    quality["stars"] = int(len(x))
+    if len(x) < MINSTARS:
+        return quality
+
+    # Shape of the brightest stars from full resolution cutouts around each peak
+    order = np.argsort(smooth[y, x])[::-1][:MEASURESTARS*2]
+    y, x = y[order], x[order]
+    offsets = np.arange(-BOXRADIUS, BOXRADIUS+1)
+    cy = y*binning+binning//2
+    cx = x*binning+binning//2
+    boxes = np.asarray(data[cy[:,None,None]+offsets[None,:,None], cx[:,None,None]+offsets[None,None,:]], dtype=np.float64)
+    boxes = boxes*bscale+bzero
+    keep = np.ones(len(boxes), dtype=bool) if saturation is None else boxes.max(axis=(1,2)) < saturation
+    keep &= np.cumsum(keep) <= MEASURESTARS
+    if keep.sum() < MINSTARS:
+        return quality
+    ty = np.minimum(y[keep]*tiles.shape[0]//image.shape[0], tiles.shape[0]-1)
+    tx = np.minimum(x[keep]*tiles.shape[1]//image.shape[1], tiles.shape[1]-1)
+    boxes = boxes[keep]-tiles[ty, tx][:,None,None]
+    fwhm, eccentricity = momentShape(boxes)
+    # Noise in the corners of the box inflates the moments of small stars, so measure again on a box
+    # sized to the stars
+    radius = int(np.clip(np.ceil(1.5*np.nanmedian(fwhm)), 3, BOXRADIUS)) if np.isfinite(fwhm).any() else BOXRADIUS
+    if radius < BOXRADIUS:
+        trim = BOXRADIUS-radius
+        fwhm, eccentricity = momentShape(boxes[:, trim:-trim, trim:-trim])
+    ok = np.isfinite(fwhm) & np.isfinite(eccentricity)
+    if ok.sum() >= MINSTARS:
+        quality["fwhm"] = float(np.median(fwhm[ok]))
+        quality["eccentricity"] = float(np.median(eccentricity[ok]))
+    return quality
+
+############################################################################################################
+# Measure a FITS file (first plane of a colour cube). Worker function, returns None if the frame can't be
+# read or measured, so one bad frame doesn't stop the rest of a batch.
+def measureFrame(fileName, binning=BINNING):
+    try:
+        hdul, data, bscale, bzero = stackEngine.openFrame(fileName)
+    except Exception as e:
+        logging.warning("Unable to measure {0}: {1}".format(fileName, e))
+        return None
+    try:
+        if data is None or data.ndim < 2:
+            return None
+        if data.ndim == 3:
+            data = data[0]
+        saturation = None
+        if data.dtype.kind in "iu":
+            # Integer data, EKOS writes 16 bit frames as int16 with BZERO 32768
+            full = np.iinfo(data.dtype)
+            saturation = SATURATION*((float(full.max)-float(full.min))*bscale)+float(full.min)*bscale+bzero
+        return measureData(data, bscale, bzero, saturation, binning)
+    except Exception as e:
+        logging.warning("Unable to measure {0}: {1}: {2}".format(fileName, type(e).__name__, e))
+        return None
+    finally:
+        del data
+        hdul.close()
+
+############################################################################################################
+# True if a frame's metrics pass the limits given (None for no limit). A frame that was never measured,
+# or whose FWHM couldn't be measured when there is a FWHM/eccentricity limit, doesn't pass.
+def acceptable(quality, maxFwhm=None, maxEccentricity=None, minStars=None):
+    if quality is None:
+        return False
+    if minStars is not None and quality["stars"] < minStars:
+        return False
+    for column, limit in (("fwhm", maxFwhm), ("eccentricity", maxEccentricity)):
+        if limit is not None and (quality[column] is None or quality[column] > limit):
+            return False
+    return True
+
+############################################################################################################
+# Measure indexed files that have no quality metrics yet (indexed before QUALITY was turned on), across a
+# pool of workers, writing the metrics a batch at a time
+def measureIndexed(con, workers=None, frames=None, batchSize=100):
+    sqlStmt = "SELECT f.unid, f.filename FROM fitsFile f JOIN fitsFrame r ON r.unid=f.unid WHERE f.unid NOT IN (SELECT unid FROM fitsQuality)"
+    params = []
+    if frames:
+        sqlStmt += " AND r.frame IN ({0})".format(",".join("?"*len(frames)))
+        params += frames
+    files = [(unid, fileName) for unid, fileName in con.execute(sqlStmt, params) if os.path.isfile(fileName)]
+    measured, batch = 0, []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for (unid, fileName), quality in zip(files, pool.map(measureFrame, [fileName for unid, fileName in files], chunksize=2)):
+            if quality is None:
+                continue
+            batch.append((unid, quality))
+            if len(batch) >= batchSize:
+                obsyDB.recordQuality(con, batch)
+                measured += len(batch)
+                print("Measured {0} of {1} files".format(measured, len(files)))
+                batch = []
+    if batch:
+        obsyDB.recordQuality(con, batch)
+        measured += len(batch)
+    return measured
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure quality metrics of indexed frames that have none yet')
+    parser.add_argument('--db', required=True, type=str, help='obsy.db of the repository')
+    parser.add_argument('--frames', nargs='+', default=None, help='frame types to measure, default all')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, default one per CPU')
+    args = parser.parse_args()
+
+    con = obsyDB.connectDB(args.db)
+    obsyDB.createTables(con)
+    start = time.perf_counter()
+    measured = measureIndexed(con, args.workers, args.frames)
+    print("{0} files measured in {1:.1f}s".format(measured, time.perf_counter()-start))
+    con.close()
+
+
+if __name__ == "__main__":
+    main()
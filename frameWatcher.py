@@ -0,0 +1,308 @@
+############################################################################################################
+#
+# Name        : frameWatcher.py
+# Purpose     : Watch the pictures folder for new FITS frames and hand each one over once it is completely
+#               written
+# Author      : Gord Tulloch
+# Date        : March 10 2024
+# License     : GPL v3
+# Dependencies: astropy (through fitsScan). inotify on Linux, anything else falls back to polling
+# Usage       : watcher=frameWatcher.FrameWatcher(picturesFolder)
+#               watcher.start()
+#               for fileName in watcher.frames():
+#                   ...
+#
+# On Linux the folder tree is watched with inotify (through libc, no extra package), so the kernel tells
+# us about each file as it is closed or renamed into place and the cost does not depend on how many
+# frames are already in the folder. Elsewhere, or if inotify can't be set up, the tree is polled, but only
+# folders whose modification time has changed are listed again.
+#
+# Every candidate waits in a pending list until its size has not changed for settle seconds and it holds
+# the whole image its header describes, so a frame still being written is never picked up. Complete frames
+# go onto a bounded queue; if the consumer falls behind the watcher waits rather than piling up work.
+# Frames already in the folder when the watcher starts (saved while it wasn't running) are queued first,
+# unless existing=False.
+#
+############################################################################################################
+import os
+import time
+import queue
+import select
+import struct
+import logging
+import threading
+import ctypes
+import ctypes.util
+from collections import OrderedDict
+import fitsScan
+
+SETTLE=1.0              # seconds a file's size must be steady before it is considered written
+GIVEUP=600.0            # seconds after which a file that never completes is dropped
+QUEUESIZE=32            # frames waiting for the consumer
+POLLINTERVAL=2.0        # seconds between polls in polling mode
+TICK=0.5                # seconds between checks of the pending list
+REMEMBER=10000          # recently dispatched files remembered so a frame is only handed over once
+
+# inotify event flags (linux/inotify.h)
+IN_CLOSE_WRITE=0x00000008
+IN_MOVED_TO=0x00000080
+IN_CREATE=0x00000100
+IN_Q_OVERFLOW=0x00004000
+IN_IGNORED=0x00008000
+IN_ISDIR=0x40000000
+IN_NONBLOCK=0o4000
+IN_CLOEXEC=0o2000000
+WATCHMASK=IN_CLOSE_WRITE|IN_MOVED_TO|IN_CREATE
+EVENTHEADER=struct.Struct("iIII")
+
+############################################################################################################
+# True if the file holds the whole primary image its header describes
+def frameComplete(fileName):
+    hdr = fitsScan.readPrimaryHeader(fileName)
+    if hdr is None:
+        return False
+    dataBytes = 0
+    if hdr.get("NAXIS", 0) > 0:
+        dataBytes = abs(int(hdr.get("BITPIX", 8)))//8
+        for axis in range(1, int(hdr["NAXIS"])+1):
+            dataBytes *= int(hdr.get("NAXIS{0}".format(axis), 0))
+    try:
+        return os.path.getsize(fileName) >= len(hdr.tostring())+dataBytes
+    except OSError:
+        return False
+
+############################################################################################################
+# InotifyWatch - inotify watches on a folder and every folder below it, including ones created later
+class InotifyWatch():
+    def __init__(self, folder):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {}
+        self.addTree(folder)
+
+    def addFolder(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCHMASK)
+        if wd < 0:
+            logging.warning("Unable to watch {0}: {1}".format(folder, os.strerror(ctypes.get_errno())))
+            return
+        self.folders[wd] = folder
+
+    # Watch a folder tree, returns the files already in it (a new folder may be moved in full of frames)
+    def addTree(self, folder):
+        found = []
+        for root, dirs, files in os.walk(folder):
+            self.addFolder(root)
+            found += [os.path.join(root, file) for file in files]
+        return found
+
+    # Files closed after writing or moved in during the next timeout seconds. Returns None if the kernel
+    # queue overflowed and events were lost.
+    def changes(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buffer = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        changed = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = EVENTHEADER.unpack_from(buffer, offset)
+            name = buffer[offset+EVENTHEADER.size:offset+EVENTHEADER.size+length].rstrip(b"\0")
+            offset += EVENTHEADER.size+length
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify queue overflowed, events lost")
+                return None
+            if mask & IN_IGNORED:
+                self.folders.pop(wd, None)
+                continue
+            if wd not in self.folders:
+                continue
+            path = os.path.join(self.folders[wd], os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE|IN_MOVED_TO):
+                    changed += self.addTree(path)
+            elif mask & (IN_CLOSE_WRITE|IN_MOVED_TO):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+############################################################################################################
+# PollingWatch - remembers the modification time and files of every folder, and lists a folder again only
+# when its modification time changes (a file was created, renamed or removed in it)
+class PollingWatch():
+    def __init__(self, folder, interval=POLLINTERVAL):
+        self.folder = folder
+        self.interval = interval
+        self.folderTimes = {}
+        self.folderFiles = {}
+        self.subFolders = {}
+        self.lastPoll = 0.0
+        self.poll()
+
+    # New files since the last poll
+    def poll(self):
+        changed = []
+        stack = [self.folder]
+        while stack:
+            folder = stack.pop()
+            try:
+                mtime = os.stat(folder).st_mtime_ns
+            except OSError:
+                self.folderTimes.pop(folder, None)
+                self.folderFiles.pop(folder, None)
+                self.subFolders.pop(folder, None)
+                continue
+            if self.folderTimes.get(folder) == mtime:
+                stack += self.subFolders[folder]
+                continue
+            files, subFolders = set(), []
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            subFolders.append(entry.path)
+                        else:
+                            files.add(entry.name)
+            except OSError as e:
+                logging.warning("Unable to list {0}: {1}".format(folder, e))
+                continue
+            if folder in self.folderFiles:
+                changed += [os.path.join(folder, name) for name in files-self.folderFiles[folder]]
+            elif folder != self.folder and self.lastPoll:
+                changed += [os.path.join(folder, name) for name in files]
+            self.folderTimes[folder] = mtime
+            self.folderFiles[folder] = files
+            self.subFolders[folder] = subFolders
+            stack += subFolders
+        self.lastPoll = time.monotonic()
+        return changed
+
+    # Same interface as InotifyWatch.changes
+    def changes(self, timeout):
+        wait = self.lastPoll+self.interval-time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(wait, 0))
+        return self.poll()
+
+    def close(self):
+        return
+
+############################################################################################################
+# FrameWatcher - watches a folder in a background thread and queues each frame once it is complete
+class FrameWatcher():
+    def __init__(self, folder, extensions=fitsScan.FITSEXTENSIONS, settle=SETTLE, queueSize=QUEUESIZE, polling=False, existing=True):
+        self.folder = os.path.abspath(folder)
+        self.extensions = extensions
+        self.existing = existing
+        self.settle = settle
+        self.queue = queue.Queue(queueSize)
+        self.pending = {}               # fileName: (size, time the size last changed)
+        self.dispatched = OrderedDict()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.watch = None
+        if not polling:
+            try:
+                self.watch = InotifyWatch(self.folder)
+            except (OSError, AttributeError) as e:
+                logging.warning("inotify not available ({0}), polling {1}".format(e, self.folder))
+        if self.watch is None:
+            self.watch = PollingWatch(self.folder)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="frameWatcher", daemon=True)
+        self.thread.start()
+        return self
+
+    # Stop watching and end frames(). Nothing may be reading the queue any more (Ctrl-C in the consumer),
+    # so frames still queued are dropped to make room for the end marker rather than waiting for space;
+    # they are still in the folder and are queued again by the next start.
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.watch.close()
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    # Frames as they complete, until stop() is called
+    def frames(self):
+        while True:
+            fileName = self.queue.get()
+            if fileName is None:
+                return
+            yield fileName
+
+    # Put a file on the pending list (or restart its wait if it is already there)
+    def notice(self, fileName):
+        if os.path.splitext(fileName)[1].lower() not in self.extensions:
+            return
+        try:
+            size = os.path.getsize(fileName)
+        except OSError:
+            return
+        self.pending[fileName] = (size, time.monotonic())
+
+    # Queue pending files that have settled and are complete, blocking while the queue is full
+    def checkPending(self):
+        now = time.monotonic()
+        for fileName, (size, since) in sorted(self.pending.items(), key=lambda item: item[1][1]):
+            try:
+                currentSize = os.path.getsize(fileName)
+            except OSError:
+                del self.pending[fileName]
+                continue
+            if currentSize != size:
+                self.pending[fileName] = (currentSize, now)
+                continue
+            if now-since < self.settle:
+                continue
+            if fileName in self.dispatched:
+                del self.pending[fileName]
+                continue
+            if not frameComplete(fileName):
+                if now-since > GIVEUP:
+                    logging.warning("File never completed, not processed: "+fileName)
+                    del self.pending[fileName]
+                continue
+            del self.pending[fileName]
+            self.dispatched[fileName] = now
+            if len(self.dispatched) > REMEMBER:
+                self.dispatched.popitem(last=False)
+            while not self.stopping.is_set():
+                try:
+                    self.queue.put(fileName, timeout=TICK)
+                    break
+                except queue.Full:
+                    continue
+
+    def run(self):
+        # The watch is already set up, so a frame saved during this scan is noticed either way
+        if self.existing:
+            for fileName in fitsScan.findFitsFiles(self.folder, self.extensions):
+                self.notice(fileName)
+        while not self.stopping.is_set():
+            changed = self.watch.changes(TICK)
+            if changed is None:
+                # Events were lost, look at everything in the folder again (already queued frames are skipped)
+                changed = list(fitsScan.findFitsFiles(self.folder, self.extensions))
+            for fileName in changed:
+                self.notice(fileName)
+            self.checkPending()
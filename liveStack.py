@@ -5,76 +5,168 @@
 # Author      : Gord Tulloch
 # Date        : January 25 2024
 # License     : GPL v3
-# Usage       : Called after every image is taken
-# Dependencies: Imagemagick and SIRIL needs to be install for live stacking
-#               Tested with EKOS, don't know if it'll work with other imaging tools 
-# TODO:
-#      - Calibrate image prior to storing and stacking it (master dark/flat/bias)
+# Usage       : Called after every image is taken, or run watchFrames.py to stack frames as they arrive
+# Dependencies: numpy and astropy for stacking (see stackEngine.py), Pillow for the web PNG.
+#               SIRIL only if stackBackend is set to "siril"
+#               Tested with EKOS, don't know if it'll work with other imaging tools
 #
-############################################################################################################ 
-from pysiril.siril   import *
-from pysiril.wrapper import *
+############################################################################################################
+import os
+import glob
+import logging
+from pathlib import Path
+import fitsScan
+import stackEngine
+import starAlign
+import calibration
+import obsyDB
+import previewRender
+import frameQuality
 
 # Variable definitions
 picturesFolder="/home/gtulloch/Pictures/"
+repoFolder="/home/gtulloch/Repository/"     # where postProcess.py files frames, holds obsy.db
+dbName=repoFolder+"obsy.db"
+calibrateFrames=True                 # numpy backend: calibrate lights with masters listed in obsy.db
 workingFolder="/home/gtulloch/SirilWork/"
+stackFolder="/var/www/html/"
+stackBackend="numpy"            # "numpy" stacks in memory, "siril" uses the original pySiril round trip
+stackMode="sigma"               # numpy backend: "sum", "mean" or "sigma" (running sigma clip)
+sigmaKappa=3.0
+stateFolder=workingFolder+"State/"   # numpy backend: persisted accumulator, resumed after a restart
+alignFrames=True                     # numpy backend: register frames on stars before stacking
+starFolder=workingFolder+"Stars/"    # cached reference star lists, one per target
+previewSize=1600                     # longest side of the web image
+previewStretch="mtf"                 # "mtf" (autostretch) or "asinh"
+maxFwhm=None                         # skip frames with a median star FWHM above this (pixels), None for no limit
+maxEccentricity=None                 # skip frames with elongated stars (0 round, 1 a line), None for no limit
+minStars=None                        # skip frames with fewer stars (cloud, dew), None for no limit
+fitsEvery=10                         # write LiveStack.fits every this many frames (and on close or a new target)
+
+############################################################################################################
+# LiveStacker - the live stack with its calibration masters, aligner and web preview, fed one frame at a
+# time by the folder walk below or by watchFrames.py
+class LiveStacker():
+    def __init__(self):
+        # Create working directories if not exist
+        Path(workingFolder).mkdir(parents=True, exist_ok=True)
+        Path(stackFolder+"Previous").mkdir(parents=True, exist_ok=True)
+        self.stackFile=workingFolder+"LiveStack.fits"
+        self.unsaved=0
+
+        self.renderer=previewRender.PreviewRenderer(maxSize=previewSize, mode=previewStretch)
+        self.aligner=starAlign.StarAligner(starFolder) if (alignFrames and stackBackend == "numpy") else None
+        self.con=None
+        self.masterCache=None
+        self.checkQuality=any(limit is not None for limit in (maxFwhm, maxEccentricity, minStars))
+        if calibrateFrames and stackBackend == "numpy" and os.path.isfile(dbName):
+            self.con=obsyDB.connectDB(dbName)
+            obsyDB.createTables(self.con)
+            self.masterCache=calibration.MasterCache(self.con)
+
+        # Pick up where we left off if a saved stack exists
+        self.stack=self.newStack()
+        self.stackObject=None
+        self.liveStackName=None
+        if self.stack.frames > 0:
+            self.stackObject=self.stack.header.get("OBJECT", "Unknown")
+            self.liveStackName=stackFolder+"{0}-LiveStack.png".format(self.stackObject.replace(" ", ""))
+            print("Resuming live stack of {0} with {1} frames".format(self.stackObject, self.stack.frames))
+
+    def newStack(self):
+        if stackBackend == "siril":
+            return stackEngine.SirilStack(workingFolder)
+        return stackEngine.LiveStack(mode=stackMode, kappa=sigmaKappa, stateFolder=stateFolder)
+
+    # Calibrate a light with the matching master dark/flat/bias from the repository, masters stay cached
+    def calibrateImage(self, data, hdr):
+        if self.masterCache is None:
+            return data
+        return self.masterCache.calibrate(data, hdr)
+
+    # Stack one frame and update the web PNG. Returns True if the frame went into the stack. quality is the
+    # frame's frameQuality.py metrics if the caller already has them, otherwise they are measured here when
+    # there are quality limits.
+    def addFile(self, imageFile, quality=None):
+        # Skip frames already in the stack (from before a restart)
+        if imageFile in getattr(self.stack, "stacked", ()):
+            return False
+        hdr = fitsScan.readPrimaryHeader(imageFile)
+        if hdr is None:
+            logging.warning("Invalid FITS file. File not stacked is "+imageFile)
+            return False
+        frameObject = hdr.get("OBJECT", "Unknown")
 
-# Function definitions
-def calibrateImage(imageFile):
-    # Not done yet
-    return imageFile
-
-# Create working directories if not exist
-Path(workingFolder).mkdir(parents=True, exist_ok=True)
-Path(workingFolder+"Light").mkdir(parents=True, exist_ok=True)
-
-# What is the livestack called? If first or we've changed object create a new one
-liveStackName=stackFolder+"{0}-LiveStack.png".format(hdr["OBJECT"])
-
-# Set up pySiril
-app=Siril()
-cmd=Wrapper(app)
-cmd.set16bits()
-cmd.setext('fits')
-cmd.cd(workingFolder+"/Light")
-
-# Detect any new files in the images folder
-for root, dirs, files in os.walk(os.path.abspath(picturesFolder)):
-    for file in files:
-        file_name, file_extension = os.path.splitext(os.path.join(root, file))
-        # Ignore everything not a *fit* file
-        if (file_extension !=".fits") or (file_extension !=".fit"):
-            continue
-        # Calibrate the image - choose masters from repository
-        imageFile = calibrateImage(os.path.join(root, file))
-        # Move original file to the raw folder
-        #os.rename(os.path.join(root, file), picturesFolder+"Raw/"+file)
-        # Has a livestack already been started?
-        if (os.path.isfile(liveStackName)):
-            # Move the new image into the working folder
-            shutil.copy(imageFile, workingFolder+"Light/Main_002.fits")      
-            # Stack this image with the current liveStack
-            try:
-                # Stack it with the current master stack
-                cmd.stack("Main_",type='sum',output_norm=False)
-            except Exception as e :
-                print("\n**** ERROR *** " +  str(e) + "\n" )  
-            # Remove working files
-            os.system("rm {0}Light/Main_001.fits".format(workingFolder))
-            os.system("rm {0}Light/Main_002.fits".format(workingFolder))
-            os.system("rm {0}Light/*.seq".format(workingFolder))
-            os.system("mv {0}Light/Main_stacked.fits {0}Light/Main_001.fits".format(workingFolder))
-            os.system("rm {0}Light/r_Main*.fits".format(workingFolder))
-            # Create PNG on web server
-            os.system("/usr/bin/convert -flatten {0}Light/Main_stacked.fits {1}".format(workingFolder,liveStackName))
-        else:
-            # New livestack, put the first image in the working folder
-            shutil.copy(fitsName, workingFolder+"Light/Main_001.fits")
+        # Leave out frames spoiled by cloud, wind or poor seeing
+        if self.checkQuality:
+            if quality is None:
+                quality = frameQuality.measureFrame(imageFile)
+            if not frameQuality.acceptable(quality, maxFwhm, maxEccentricity, minStars):
+                logging.warning("Frame failed the quality limits, not stacked: {0} {1}".format(imageFile, quality))
+                return False
+
+        # What is the livestack called? If first or we've changed object create a new one
+        if frameObject != self.stackObject:
+            self.writeStack()
+            if stackBackend == "siril":
+                self.stack.close()
+                self.stack=self.newStack()
+            else:
+                self.stack.reset()
             # Move any existing livestacks to a Previous folder
-            os.system("mv {0}*.png {0}Previous".format(stackFolder))
-            # Create a PNG file of the first image
-            print("Converting {0} to {1}\n".format(fitsName,liveStackName))
-            os.system("/usr/bin/convert -flatten {0} {1}".format(fitsName,liveStackName))
-        
-app.Close()
-del app
+            for fileName in glob.glob(stackFolder+"*.png"):
+                os.replace(fileName, os.path.join(stackFolder, "Previous", os.path.basename(fileName)))
+            self.renderer.reset()
+            self.stackObject=frameObject
+            self.liveStackName=stackFolder+"{0}-LiveStack.png".format(self.stackObject.replace(" ", ""))
+
+        # Stack this image with the current liveStack
+        try:
+            # Calibrate the image with masters from the repository, register it and stack it
+            if self.stack.addFile(imageFile, aligner=self.aligner, calibrate=self.calibrateImage if self.masterCache else None) is None:
+                logging.warning("Frame could not be registered, not stacked: "+imageFile)
+                return False
+        except Exception as e:
+            # An unreadable frame, a calibration master of another shape or a failed alignment only
+            # loses this frame
+            logging.error("Unable to stack {0}: {1}: {2}".format(imageFile, type(e).__name__, e))
+            return False
+        # The numpy stack is already saved frame by frame in stateFolder, the full FITS is only for
+        # looking at and is large, so it is written now and then rather than after every frame
+        self.unsaved+=1
+        if self.unsaved >= fitsEvery:
+            self.writeStack()
+
+        # Create PNG on web server straight from the stack in memory
+        print("Rendering {0}\n".format(self.liveStackName))
+        self.renderer.render(self.stack.image(), self.liveStackName)
+        return True
+
+    # Write the stack to LiveStack.fits if it has frames it doesn't have yet
+    def writeStack(self):
+        if self.unsaved and self.stack.frames > 0:
+            self.stack.writeFits(self.stackFile)
+        self.unsaved=0
+
+    def close(self):
+        self.writeStack()
+        if stackBackend == "siril":
+            self.stack.close()
+        if self.con is not None:
+            self.con.close()
+
+if __name__ == "__main__":
+    # Set up logging
+    logging.basicConfig(filename='liveStack.log', filemode='w', format='%(name)s - %(levelname)s - %(message)s')
+    stacker=LiveStacker()
+
+    # Detect any new files in the images folder
+    for root, dirs, files in os.walk(os.path.abspath(picturesFolder)):
+        for file in sorted(files):
+            file_name, file_extension = os.path.splitext(os.path.join(root, file))
+            # Ignore everything not a *fit* file
+            if file_extension not in (".fits", ".fit"):
+                continue
+            stacker.addFile(os.path.join(root, file))
+
+    stacker.close()
@@ -0,0 +1,487 @@
+############################################################################################################
+#
+# Name        : obsyDB.py
+# Purpose     : Shared functions for the OBSY index database (obsy.db) used by postProcess.py and addToDB.py
+# Author      : Gord Tulloch
+# Date        : February 20 2024
+# License     : GPL v3
+# Dependencies: None
+# Usage       : import obsyDB, open the database with obsyDB.connectDB() and add files through a
+#               FitsIngest object so the header cards are written in batches
+#
+# fitsFile/fitsHeader hold every card of every file, fitsFrame holds the commonly queried cards as
+# typed columns. fitsManifest records the stat signature (size, mtime, inode) of every file seen by an
+# incremental scan along with the unid of its fitsFile row (NULL if the file was looked at but not indexed).
+# fitsMaster lists the master dark, flat and bias frames available for calibration and fitsMasterSource
+# the frames each one was combined from. When a scan is run with checksums, fitsFile.checksum holds a hash of
+# each file's content and fitsContent (unique on checksum) the first indexed file with that content, so a
+# copy of a night that is already in the index can be recognized. fileMove is the journal of files postProcess.py is moving into
+# the repository (see fileMover.py). fitsQuality holds the metrics frameQuality.py measured for each file
+# when the scan was run with quality=True, and fitsThumbnail the path of each file's preview in the
+# thumbnail cache (thumbnailCache.py). fitsArchive records the raw and compressed size of files moved into
+# the repository tile compressed (postProcess.py ARCHIVE). skyHistory is the ring buffer of cloud, rain and
+# weather samples MCP.py decides on (skyHistory.py); it isn't part of the file index and is kept when the
+# index tables are dropped.
+#
+############################################################################################################
+import os
+import logging
+import sqlite3
+import uuid
+from urllib.request import pathname2url
+
+# Number of files to accumulate before the batch is written and committed
+BATCHSIZE=250
+
+############################################################################################################
+# Open the database. WAL journaling lets readers (MCP, queries) work while an ingest is running and
+# synchronous=NORMAL only syncs at checkpoints rather than on every commit.
+def connectDB(dbName, journalMode="WAL"):
+    con = sqlite3.connect(dbName)
+    con.execute("PRAGMA journal_mode={0}".format(journalMode))
+    con.execute("PRAGMA synchronous=NORMAL")
+    return con
+
+# Open an existing database for reading only, for tools that query it. Nothing is created or migrated;
+# sqlite3.DatabaseError if it isn't there or postProcess.py hasn't brought it up to the current schema.
+def connectReadOnly(dbName):
+    if not os.path.isfile(dbName):
+        raise sqlite3.DatabaseError("{0} not found".format(dbName))
+    con = sqlite3.connect("file:{0}?mode=ro".format(pathname2url(os.path.abspath(dbName))), uri=True)
+    try:
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+        exists = con.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='fitsFrame'").fetchone()[0]
+    except sqlite3.Error:
+        con.close()
+        raise
+    if not exists or version < SCHEMAVERSION:
+        con.close()
+        found = "is at schema version {0}".format(version) if exists else "has no fitsFrame table"
+        raise sqlite3.DatabaseError("{0} {1}, run postProcess.py or addToDB.py on it to bring it up to version {2}".format(
+                                    dbName, found, SCHEMAVERSION))
+    return con
+
+############################################################################################################
+# Schema. fitsFile and fitsHeader keep the original columns but are typed with primary keys, and fitsHeader
+# is indexed by file and by keyword. fitsFrame is a wide table holding the cards postProcess.py files by,
+# one typed row per file, so calibration matching and target queries are index lookups rather than a
+# self join on fitsHeader per keyword. PRAGMA user_version holds the schema version:
+#   1 - typed tables and fitsFrame
+#   2 - content checksums (fitsFile.checksum and fitsContent)
+SCHEMAVERSION=2
+
+HOTCARDS=[("OBJECT","object","TEXT"),
+          ("FILTER","filter","TEXT"),
+          ("FRAME","frame","TEXT"),
+          ("EXPTIME","exptime","REAL"),
+          ("XBINNING","xbinning","INTEGER"),
+          ("YBINNING","ybinning","INTEGER"),
+          ("CCD-TEMP","ccdtemp","REAL"),
+          ("DATE-OBS","dateobs","TEXT")]
+
+TABLES=["CREATE TABLE if not exists fitsFile(unid TEXT PRIMARY KEY, date TEXT, filename TEXT, checksum TEXT)",
+        "CREATE TABLE if not exists fitsHeader(thisUNID TEXT PRIMARY KEY, parentUNID TEXT NOT NULL, keyword TEXT, value)",
+        "CREATE TABLE if not exists fitsFrame(unid TEXT PRIMARY KEY REFERENCES fitsFile(unid), "+", ".join(column+" "+sqlType for card, column, sqlType in HOTCARDS)+")",
+        "CREATE TABLE if not exists fitsManifest(filename TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, unid TEXT)",
+        "CREATE TABLE if not exists fitsMaster(filename TEXT PRIMARY KEY, frame TEXT, exptime REAL, filter TEXT, xbinning INTEGER, ybinning INTEGER, ccdtemp REAL, nframes INTEGER, created TEXT)",
+        "CREATE TABLE if not exists fitsMasterSource(master TEXT NOT NULL, unid TEXT NOT NULL, PRIMARY KEY (master, unid))",
+        "CREATE TABLE if not exists fitsContent(checksum TEXT PRIMARY KEY, unid TEXT NOT NULL)",
+        "CREATE TABLE if not exists fileMove(source TEXT PRIMARY KEY, destination TEXT NOT NULL, unid TEXT, state TEXT NOT NULL, checksum TEXT, updated TEXT)",
+        "CREATE TABLE if not exists fitsQuality(unid TEXT PRIMARY KEY REFERENCES fitsFile(unid), background REAL, noise REAL, stars INTEGER, fwhm REAL, eccentricity REAL)",
+        "CREATE TABLE if not exists fitsThumbnail(unid TEXT PRIMARY KEY REFERENCES fitsFile(unid), checksum TEXT, path TEXT NOT NULL, created TEXT)",
+        "CREATE TABLE if not exists fitsArchive(unid TEXT PRIMARY KEY REFERENCES fitsFile(unid), rawsize INTEGER, size INTEGER, ratio REAL, compression TEXT, created TEXT)",
+        "CREATE TABLE if not exists skyHistory(slot INTEGER PRIMARY KEY, time REAL NOT NULL, cloud REAL, rain INTEGER, unsafe INTEGER, wind REAL, temperature REAL, humidity REAL)"]
+
+INDEXES=["CREATE INDEX if not exists fitsFileName ON fitsFile(filename)",
+         "CREATE INDEX if not exists fitsFileDate ON fitsFile(date)",
+         "CREATE INDEX if not exists fitsFileChecksum ON fitsFile(checksum)",
+         "CREATE INDEX if not exists fitsContentUnid ON fitsContent(unid)",
+         "CREATE INDEX if not exists fitsHeaderParent ON fitsHeader(parentUNID, keyword)",
+         "CREATE INDEX if not exists fitsHeaderKeyword ON fitsHeader(keyword, value)",
+         "CREATE INDEX if not exists fitsFrameLight ON fitsFrame(frame, object, filter, exptime)",
+         "CREATE INDEX if not exists fitsFrameCalibrate ON fitsFrame(frame, exptime, xbinning, ybinning, ccdtemp)",
+         "CREATE INDEX if not exists fitsFrameFlat ON fitsFrame(frame, filter, xbinning, ybinning)",
+         "CREATE INDEX if not exists fitsFrameDate ON fitsFrame(dateobs)",
+         "CREATE INDEX if not exists fitsManifestUnid ON fitsManifest(unid)",
+         "CREATE INDEX if not exists fitsMasterMatch ON fitsMaster(frame, xbinning, ybinning, exptime, filter, ccdtemp)",
+         "CREATE INDEX if not exists fileMoveState ON fileMove(state)",
+         "CREATE INDEX if not exists fitsQualityShape ON fitsQuality(fwhm, eccentricity, stars)",
+         "CREATE INDEX if not exists fitsThumbnailPath ON fitsThumbnail(path)",
+         "CREATE INDEX if not exists skyHistoryTime ON skyHistory(time)"]
+
+############################################################################################################
+# Create the index tables, optionally dropping what is there first. An existing database from before the
+# typed schema is migrated in place. drop only clears the header index; the fileMove journal, the masters,
+# the quality, thumbnail and archive records and the sky history are kept, they can't be rebuilt by scanning
+# the folder again (and the journal is what lets an interrupted move be finished).
+def createTables(con, drop=False):
+    cur = con.cursor()
+    if drop:
+        cur.execute("DROP TABLE if exists fitsFile")
+        cur.execute("DROP TABLE if exists fitsHeader")
+        cur.execute("DROP TABLE if exists fitsFrame")
+        cur.execute("DROP TABLE if exists fitsManifest")
+        cur.execute("DROP TABLE if exists fitsContent")
+        cur.execute("PRAGMA user_version=0")
+    version = cur.execute("PRAGMA user_version").fetchone()[0]
+    exists = cur.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='fitsFile'").fetchone()[0]
+    if exists and version < 1:
+        migrateDB(con)
+    elif exists and version < 2:
+        with con:
+            con.execute("ALTER TABLE fitsFile ADD COLUMN checksum TEXT")
+    with con:
+        for sqlStmt in TABLES+INDEXES:
+            con.execute(sqlStmt)
+        con.execute("PRAGMA user_version={0}".format(SCHEMAVERSION))
+    return
+
+############################################################################################################
+# Migrate an untyped database to the current schema. The old tables are copied into typed ones (SQLite
+# can't add a primary key to an existing table) and fitsFrame is filled by pivoting fitsHeader once.
+# Duplicate rows left by old runs are dropped by the primary keys.
+def migrateDB(con):
+    logging.info("Migrating obsy.db to schema version {0}".format(SCHEMAVERSION))
+    pivot=", ".join("MAX(CASE WHEN keyword='{0}' THEN CAST(value AS {1}) END)".format(card,sqlType) if sqlType != "TEXT" else
+                    "MAX(CASE WHEN keyword='{0}' THEN value END)".format(card) for card, column, sqlType in HOTCARDS)
+    with con:
+        con.execute("ALTER TABLE fitsFile RENAME TO fitsFileOld")
+        con.execute("ALTER TABLE fitsHeader RENAME TO fitsHeaderOld")
+        con.execute("DROP TABLE if exists fitsFrame")
+        for sqlStmt in TABLES:
+            con.execute(sqlStmt)
+        con.execute("INSERT OR IGNORE INTO fitsFile (unid, date, filename) SELECT CAST(unid AS TEXT), date, filename FROM fitsFileOld")
+        con.execute("INSERT OR IGNORE INTO fitsHeader (thisUNID, parentUNID, keyword, value) SELECT CAST(thisUNID AS TEXT), CAST(parentUNID AS TEXT), keyword, value FROM fitsHeaderOld")
+        con.execute("DROP TABLE fitsFileOld")
+        con.execute("DROP TABLE fitsHeaderOld")
+        for sqlStmt in INDEXES:
+            con.execute(sqlStmt)
+        con.execute("INSERT INTO fitsFrame (unid, {0}) SELECT parentUNID, {1} FROM fitsHeader GROUP BY parentUNID".format(
+                    ", ".join(column for card, column, sqlType in HOTCARDS), pivot))
+        con.execute("PRAGMA user_version={0}".format(SCHEMAVERSION))
+    return
+
+############################################################################################################
+# Stat signature used by the manifest to decide whether a file needs to be parsed again
+def statSignature(fileName):
+    st=os.stat(fileName)
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+# Load the manifest as {filename: ((size, mtime, inode), unid)}
+def loadManifest(con):
+    manifest={}
+    for fileName, size, mtime, inode, unid in con.execute("SELECT filename, size, mtime, inode, unid FROM fitsManifest"):
+        manifest[fileName]=((size, mtime, inode), unid)
+    return manifest
+
+# Delete the rows of a list of unids from every table keyed by file
+def deleteUnids(con, unidRows):
+    con.executemany("DELETE FROM fitsHeader WHERE parentUNID=?", unidRows)
+    con.executemany("DELETE FROM fitsFrame WHERE unid=?", unidRows)
+    con.executemany("DELETE FROM fitsFile WHERE unid=?", unidRows)
+    con.executemany("DELETE FROM fitsContent WHERE unid=?", unidRows)
+    con.executemany("DELETE FROM fitsQuality WHERE unid=?", unidRows)
+    con.executemany("DELETE FROM fitsThumbnail WHERE unid=?", unidRows)
+    con.executemany("DELETE FROM fitsArchive WHERE unid=?", unidRows)
+    return
+
+# Remove files from the index (header cards, file row and manifest entry) in one transaction
+def removeFiles(con, fileNames, unids):
+    unidRows=[(unid,) for unid in unids if unid is not None]
+    try:
+        with con:
+            deleteUnids(con, unidRows)
+            con.executemany("DELETE FROM fitsManifest WHERE filename=?", [(fileName,) for fileName in fileNames])
+    except sqlite3.Error as er:
+        logging.error('SQLite error: %s' % (' '.join(er.args)))
+        return 0
+    return 1
+
+# Remove indexed files below a folder that have no manifest entry, i.e. rows left by a full (non
+# incremental) run. Done once so the first incremental run over an old index does not duplicate them.
+def removeUnmanifested(con, folder):
+    rows=con.execute("SELECT unid FROM fitsFile WHERE filename LIKE ? AND unid NOT IN (SELECT unid FROM fitsManifest WHERE unid IS NOT NULL)", (folder+"%",)).fetchall()
+    if rows:
+        logging.info("Removing {0} unmanifested files below {1}".format(len(rows),folder))
+        removeFiles(con, [], [unid for unid, in rows])
+    return len(rows)
+
+############################################################################################################
+# Convert a header card value to what we store in the value column
+def cardValue(value):
+    if type(value) in [bool,int,float]:
+        return value
+    return str(value)
+
+############################################################################################################
+# Build the fitsFile row and the fitsHeader rows for one file, None if the header has no DATE-OBS
+def headerRows(fileName, hdr, unid=None):
+    if "DATE-OBS" not in hdr:
+        return None
+    if unid is None:
+        unid=str(uuid.uuid4())
+    fileRow=(unid,hdr["DATE-OBS"],fileName)
+    cardRows=[(str(uuid.uuid4()),unid,card,cardValue(hdr[card])) for card in hdr]
+    return fileRow, cardRows
+
+# Build the fitsFrame row for one file, typed to match the column
+def frameRow(unid, hdr):
+    row=[unid]
+    for card, column, sqlType in HOTCARDS:
+        value=hdr.get(card)
+        try:
+            if value is None:
+                row.append(None)
+            elif sqlType=="REAL":
+                row.append(float(value))
+            elif sqlType=="INTEGER":
+                row.append(int(value))
+            else:
+                row.append(str(value))
+        except ValueError:
+            row.append(None)
+    return tuple(row)
+
+# Build the fitsQuality row for one file from a frameQuality.py metrics dict
+def qualityRow(unid, quality):
+    return (unid, quality["background"], quality["noise"], quality["stars"], quality["fwhm"], quality["eccentricity"])
+
+# Write quality metrics for files already indexed, [(unid, metrics dict), ...], replacing earlier ones
+def recordQuality(con, metrics):
+    try:
+        with con:
+            con.executemany("INSERT OR REPLACE INTO fitsQuality (unid, background, noise, stars, fwhm, eccentricity) VALUES (?,?,?,?,?,?)",
+                            [qualityRow(unid, quality) for unid, quality in metrics])
+    except sqlite3.Error as er:
+        logging.error('SQLite error: %s' % (' '.join(er.args)))
+        return 0
+    return 1
+
+# Record thumbnails of files already indexed, [(unid, checksum, path), ...], replacing earlier ones
+def recordThumbnails(con, thumbnails):
+    if not thumbnails:
+        return 1
+    try:
+        with con:
+            con.executemany("INSERT OR REPLACE INTO fitsThumbnail (unid, checksum, path, created) VALUES (?,?,?,datetime('now'))", thumbnails)
+    except sqlite3.Error as er:
+        logging.error('SQLite error: %s' % (' '.join(er.args)))
+        return 0
+    return 1
+
+# Write a sky sample (time, cloud, rain, unsafe, wind, temperature, humidity) into a slot of the ring
+# buffer, replacing the oldest sample there
+def recordSky(con, slot, sample):
+    try:
+        with con:
+            con.execute("INSERT OR REPLACE INTO skyHistory (slot, time, cloud, rain, unsafe, wind, temperature, humidity) VALUES (?,?,?,?,?,?,?,?)",
+                        (slot,)+tuple(sample))
+    except sqlite3.Error as er:
+        logging.error('SQLite error: %s' % (' '.join(er.args)))
+        return 0
+    return 1
+
+# Forget thumbnails removed from the cache
+def forgetThumbnails(con, paths):
+    try:
+        with con:
+            con.executemany("DELETE FROM fitsThumbnail WHERE path=?", [(path,) for path in paths])
+    except sqlite3.Error as er:
+        logging.error('SQLite error: %s' % (' '.join(er.args)))
+        return 0
+    return 1
+
+############################################################################################################
+# Find the unid of an indexed file by the name it was scanned under or the name stored in fitsFile
+# (addToDB.py stores file names with the spaces taken out)
+def findUnid(con, fileName):
+    row=con.execute("SELECT unid FROM fitsManifest WHERE filename=? AND unid IS NOT NULL", (fileName,)).fetchone()
+    if row is None:
+        root, file = os.path.split(fileName)
+        row=con.execute("SELECT unid FROM fitsFile WHERE filename IN (?,?)", (fileName, os.path.join(root, file.replace(" ", "")))).fetchone()
+    return None if row is None else row[0]
+
+############################################################################################################
+# Replace the indexed header of files that were edited on disk, keeping their unid. Takes a list of
+# (fileName, header) and updates fitsFile, fitsHeader, fitsFrame and the manifest signature in one
+# transaction. Returns the number of files that were found in the index.
+def updateHeaders(con, files):
+    updated=0
+    try:
+        with con:
+            for fileName, hdr in files:
+                unid=findUnid(con, fileName)
+                if unid is None:
+                    continue
+                rows=headerRows(fileName, hdr, unid)
+                con.execute("DELETE FROM fitsHeader WHERE parentUNID=?", (unid,))
+                if rows is None:
+                    deleteUnids(con, [(unid,)])
+                    con.execute("UPDATE fitsManifest SET unid=NULL WHERE unid=?", (unid,))
+                    continue
+                fileRow, cardRows = rows
+                # The content has changed, so its checksum no longer holds
+                con.execute("UPDATE fitsFile SET date=?, checksum=NULL WHERE unid=?", (fileRow[1], unid))
+                con.execute("DELETE FROM fitsContent WHERE unid=?", (unid,))
+                con.execute("DELETE FROM fitsThumbnail WHERE unid=?", (unid,))
+                con.executemany("INSERT INTO fitsHeader (thisUNID, parentUNID, keyword, value) VALUES (?,?,?,?)", cardRows)
+                con.execute("INSERT OR REPLACE INTO fitsFrame VALUES ({0})".format(",".join("?"*(len(HOTCARDS)+1))), frameRow(unid, hdr))
+                if os.path.exists(fileName):
+                    con.execute("UPDATE fitsManifest SET size=?, mtime=?, inode=? WHERE filename=?", statSignature(fileName)+(fileName,))
+                updated+=1
+    except sqlite3.Error as er:
+        logging.error('SQLite error: %s' % (' '.join(er.args)))
+        return 0
+    return updated
+
+############################################################################################################
+# Record a master calibration frame and the unids of the frames it was combined from, replacing any
+# earlier record of the same file. master is a dict with the fitsMaster columns.
+def recordMaster(con, fileName, master, sourceUnids):
+    try:
+        with con:
+            con.execute("DELETE FROM fitsMasterSource WHERE master=?", (fileName,))
+            con.execute("INSERT OR REPLACE INTO fitsMaster (filename, frame, exptime, filter, xbinning, ybinning, ccdtemp, nframes, created) VALUES (?,?,?,?,?,?,?,?,datetime('now'))",
+                        (fileName, master["frame"], master["exptime"], master["filter"], master["xbinning"], master["ybinning"], master["ccdtemp"], len(sourceUnids)))
+            con.executemany("INSERT INTO fitsMasterSource (master, unid) VALUES (?,?)", [(fileName, unid) for unid in sourceUnids])
+    except sqlite3.Error as er:
+        logging.error('SQLite error: %s' % (' '.join(er.args)))
+        return 0
+    return 1
+
+############################################################################################################
+# File name of an indexed file with the given content checksum, None if the content is new
+def knownContent(con, checksum):
+    row=con.execute("SELECT f.filename FROM fitsContent c JOIN fitsFile f ON f.unid=c.unid WHERE c.checksum=?", (checksum,)).fetchone()
+    return None if row is None else row[0]
+
+# Indexed files sharing their content with another indexed file: [(checksum, [filename, ...]), ...]
+def duplicateContent(con):
+    duplicates={}
+    for checksum, fileName in con.execute("SELECT checksum, filename FROM fitsFile WHERE checksum IN "
+                                          "(SELECT checksum FROM fitsFile WHERE checksum IS NOT NULL GROUP BY checksum HAVING count(*)>1) "
+                                          "ORDER BY checksum, date"):
+        duplicates.setdefault(checksum, []).append(fileName)
+    return list(duplicates.items())
+
+# Dedupe report: files skipped this run because their content was already indexed, then groups of
+# indexed files with the same content
+def printDuplicates(con, skipped=()):
+    for fileName, checksum, existing in skipped:
+        print("Skipped {0}, same content as {1}".format(fileName, existing))
+    groups = duplicateContent(con)
+    for checksum, fileNames in groups:
+        print("Same content ({0}):".format(checksum))
+        for fileName in fileNames:
+            print("    "+fileName)
+    print("{0} files skipped as duplicates, {1} groups of duplicates in the index".format(len(skipped), len(groups)))
+    return len(groups)
+
+############################################################################################################
+# FitsIngest - queues files and writes them with executemany, one transaction and one commit per batch.
+# An optional onCommit callable is run for each file once its batch is safely committed (postProcess.py
+# uses this to move the file into the repository only after it is in the index). For incremental scans
+# a manifest row (filename, size, mtime, inode) is written in the same transaction, and replaces names
+# the unid of an older version of the file whose rows are deleted as the new ones go in. move is a
+# (source, destination) pair journalled as a pending move in the same transaction, so the index never
+# names a file that a crash could leave unmoved without fileMover.recoverMoves knowing about it.
+# checksum is the file's content hash if the scan computed one; with skipDuplicates a file whose content
+# is already indexed (or earlier in the batch) is not added and is listed in duplicates instead. quality
+# is the frameQuality.py metrics dict, written to fitsQuality with the file, and thumbnail the path of its
+# thumbnail in the cache (thumbnailCache.makeThumbnail, which needs the checksum).
+class FitsIngest():
+    def __init__(self, con, batchSize=BATCHSIZE, skipDuplicates=False):
+        self.con = con
+        self.batchSize = batchSize
+        self.fileRows = []
+        self.cardRows = []
+        self.frameRows = []
+        self.onCommit = []
+        self.manifestRows = []
+        self.replaced = []
+        self.moveRows = []
+        self.contentRows = []
+        self.qualityRows = []
+        self.thumbnailRows = []
+        self.batchContent = {}
+        self.skipDuplicates = skipDuplicates
+        self.duplicates = []            # (fileName, checksum, name of the file already holding the content)
+        self.fileCount = 0
+        self.cardCount = 0
+
+    def submitFile(self, fileName, hdr, onCommit=None, manifest=None, replaces=None, move=None, checksum=None, quality=None, thumbnail=None):
+        if checksum is not None and self.skipDuplicates:
+            existing = self.batchContent.get(checksum) or knownContent(self.con, checksum)
+            # A changed file rescanned with the same content is not a duplicate of itself
+            if existing is not None and existing != fileName:
+                self.duplicates.append((fileName, checksum, existing))
+                self.recordFile(manifest, replaces=replaces)
+                return 0
+        rows = headerRows(fileName, hdr)
+        if rows is None:
+            logging.error("Error: File not added to repo due to missing date is "+fileName)
+            self.recordFile(manifest, replaces=replaces)
+            return 0
+        fileRow, cardRows = rows
+        self.fileRows.append(fileRow+(checksum,))
+        if checksum is not None:
+            self.contentRows.append((checksum, fileRow[0]))
+            self.batchContent.setdefault(checksum, fileName)
+        self.cardRows.extend(cardRows)
+        self.frameRows.append(frameRow(fileRow[0], hdr))
+        if quality is not None:
+            self.qualityRows.append(qualityRow(fileRow[0], quality))
+        if thumbnail is not None:
+            self.thumbnailRows.append((fileRow[0], checksum, thumbnail))
+        if onCommit is not None:
+            self.onCommit.append(onCommit)
+        if move is not None:
+            self.moveRows.append((move[0], move[1], fileRow[0]))
+        self.recordFile(manifest, fileRow[0], replaces)
+        if len(self.fileRows) >= self.batchSize:
+            self.flush()
+        return 1
+
+    # Record a manifest entry on its own, for files that were looked at but are not indexed
+    def recordFile(self, manifest, unid=None, replaces=None):
+        if manifest is not None:
+            self.manifestRows.append(tuple(manifest)+(unid,))
+        if replaces is not None:
+            self.replaced.append((replaces,))
+        return
+
+    def flush(self):
+        if not (self.fileRows or self.manifestRows or self.replaced):
+            return 1
+        try:
+            with self.con:
+                deleteUnids(self.con, self.replaced)
+                self.con.executemany("INSERT INTO fitsFile (unid, date, filename, checksum) VALUES (?,?,?,?)", self.fileRows)
+                self.con.executemany("INSERT INTO fitsHeader (thisUNID, parentUNID, keyword, value) VALUES (?,?,?,?)", self.cardRows)
+                self.con.executemany("INSERT INTO fitsFrame VALUES ({0})".format(",".join("?"*(len(HOTCARDS)+1))), self.frameRows)
+                self.con.executemany("INSERT OR REPLACE INTO fitsManifest (filename, size, mtime, inode, unid) VALUES (?,?,?,?,?)", self.manifestRows)
+                self.con.executemany("INSERT OR IGNORE INTO fitsContent (checksum, unid) VALUES (?,?)", self.contentRows)
+                self.con.executemany("INSERT INTO fitsQuality (unid, background, noise, stars, fwhm, eccentricity) VALUES (?,?,?,?,?,?)", self.qualityRows)
+                self.con.executemany("INSERT INTO fitsThumbnail (unid, checksum, path, created) VALUES (?,?,?,datetime('now'))", self.thumbnailRows)
+                self.con.executemany("INSERT OR REPLACE INTO fileMove (source, destination, unid, state, updated) VALUES (?,?,?,'pending',datetime('now'))", self.moveRows)
+        except sqlite3.Error as er:
+            logging.error('SQLite error: %s' % (' '.join(er.args)))
+            logging.error("Batch of {0} files not added to the database".format(len(self.fileRows)))
+            self.clear()
+            return 0
+
+        self.fileCount += len(self.fileRows)
+        self.cardCount += len(self.cardRows)
+        onCommit = self.onCommit
+        self.clear()
+        for action in onCommit:
+            action()
+        return 1
+
+    def clear(self):
+        self.fileRows, self.cardRows, self.frameRows, self.onCommit = [], [], [], []
+        self.manifestRows, self.replaced, self.moveRows = [], [], []
+        self.contentRows, self.qualityRows, self.thumbnailRows, self.batchContent = [], [], [], {}
+
+    def close(self):
+        return self.flush()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+############################################################################################################
+#
+# Name        : obsyQuery.py
+# Purpose     : Session planning queries over obsy.db, as a module and from the command line
+# Author      : Gord Tulloch
+# Date        : March 16 2024
+# License     : GPL v3
+# Dependencies: numpy
+# Usage       : python obsyQuery.py --db "E:/00 Data Repository/obsy.db" integration --object NGC7635 --filter Ha
+#               python obsyQuery.py --db ... calibration "E:/00 Data Repository/Light/NGC7635/.../frame.fits"
+#               python obsyQuery.py --db ... frames --start 2024-01-01 --end 2024-02-01 --frame Light
+#               python obsyQuery.py --db ... quality --object NGC7635 --max_fwhm 4.5 --min_stars 50
+#
+#               import obsyQuery
+#               result=obsyQuery.integrationTime(con, "NGC7635", "Ha")   # {"object": array, "hours": array, ...}
+#
+# Every query runs against the typed fitsFrame table through one of its indexes, never the fitsHeader
+# cards, and the SQL is fixed text with ? parameters so sqlite3's statement cache prepares each one once
+# per connection. Results come back as a dict of column name to NumPy array (REAL columns as float64 with
+# NaN for missing values), which pandas.DataFrame() or pyarrow.table() take as they are. The command line
+# opens obsy.db read only and never creates or migrates tables, that is left to postProcess.py.
+#
+############################################################################################################
+import argparse
+import time
+import logging
+import sqlite3
+import numpy as np
+
+import obsyDB
+import calibration
+
+FRAMECOLUMNS="f.filename, r.frame, r.object, r.filter, r.exptime, r.xbinning, r.ybinning, r.ccdtemp, r.dateobs"
+FLOATCOLUMNS=("exptime","ccdtemp","seconds","hours","background","noise","fwhm","eccentricity")
+
+INTEGRATIONSQL=("SELECT object, filter, count(*) AS frames, sum(exptime) AS seconds, sum(exptime)/3600.0 AS hours, "
+                "min(dateobs) AS first, max(dateobs) AS last FROM fitsFrame WHERE frame='Light' {0} "
+                "GROUP BY object, filter ORDER BY object, filter")
+LIGHTSQL="SELECT "+FRAMECOLUMNS+", r.unid FROM fitsFrame r JOIN fitsFile f ON f.unid=r.unid WHERE f.filename=?"
+DARKSQL=("SELECT "+FRAMECOLUMNS+" FROM fitsFrame r JOIN fitsFile f ON f.unid=r.unid "
+         "WHERE r.frame='Dark' AND r.exptime=? AND r.xbinning=? AND r.ybinning=? AND r.ccdtemp BETWEEN ? AND ? ORDER BY r.dateobs")
+FLATSQL=("SELECT "+FRAMECOLUMNS+" FROM fitsFrame r JOIN fitsFile f ON f.unid=r.unid "
+         "WHERE r.frame='Flat' AND r.filter=? AND r.xbinning=? AND r.ybinning=? ORDER BY r.dateobs")
+BIASSQL=("SELECT "+FRAMECOLUMNS+" FROM fitsFrame r JOIN fitsFile f ON f.unid=r.unid "
+         "WHERE r.frame='Bias' AND r.xbinning=? AND r.ybinning=? AND r.ccdtemp BETWEEN ? AND ? ORDER BY r.dateobs")
+DATESQL=("SELECT "+FRAMECOLUMNS+" FROM fitsFrame r JOIN fitsFile f ON f.unid=r.unid "
+         "WHERE r.dateobs>=? AND r.dateobs<? {0} ORDER BY r.dateobs")
+QUALITYSQL=("SELECT "+FRAMECOLUMNS+", q.background, q.noise, q.stars, q.fwhm, q.eccentricity FROM fitsFrame r "
+            "JOIN fitsQuality q ON q.unid=r.unid JOIN fitsFile f ON f.unid=r.unid "
+            "WHERE r.frame=? {0} ORDER BY r.dateobs")
+
+############################################################################################################
+# Turn a cursor into {column: NumPy array}
+def columnar(cursor):
+    names = [column[0] for column in cursor.description]
+    rows = cursor.fetchall()
+    columns = list(zip(*rows)) if rows else [()]*len(names)
+    result = {}
+    for name, values in zip(names, columns):
+        if name in FLOATCOLUMNS:
+            result[name] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+        elif name in ("frames","xbinning","ybinning","stars"):
+            result[name] = np.array([-1 if value is None else value for value in values], dtype=np.int64)
+        else:
+            result[name] = np.array(["" if value is None else str(value) for value in values], dtype=str)
+    return result
+
+# Join columnar results from several queries
+def concatenate(results):
+    return {name: np.concatenate([result[name] for result in results]) for name in results[0]}
+
+############################################################################################################
+# OBJECT values in the index that match a name ignoring case and spaces ("ngc7635" finds "NGC 7635").
+# The distinct list comes straight off the fitsFrameLight index.
+def matchObjects(con, objectName):
+    wanted = objectName.replace(" ", "").lower()
+    return [row[0] for row in con.execute("SELECT DISTINCT object FROM fitsFrame WHERE frame='Light'")
+            if row[0] is not None and row[0].replace(" ", "").lower() == wanted]
+
+############################################################################################################
+# Light frames and integration time per object and filter, optionally for one object and/or filter
+def integrationTime(con, objectName=None, filterName=None):
+    where, params = "", []
+    if objectName is not None:
+        objects = matchObjects(con, objectName) or [objectName]
+        where += " AND object IN ({0})".format(",".join("?"*len(objects)))
+        params += objects
+    if filterName is not None:
+        where += " AND filter=?"
+        params.append(filterName)
+    return columnar(con.execute(INTEGRATIONSQL.format(where), params))
+
+############################################################################################################
+# Calibration frames (and masters) that match a light: darks of the same exposure and binning within
+# tolerance degrees, flats of the same filter and binning, biases of the same binning within tolerance.
+# The light is given by its file name as indexed.
+def calibrationFrames(con, lightFile, tolerance=calibration.TEMPTOLERANCE):
+    light = con.execute(LIGHTSQL, (lightFile,)).fetchone()
+    if light is None:
+        raise ValueError("{0} is not in the index".format(lightFile))
+    fileName, frame, objectName, filterName, exptime, xbinning, ybinning, ccdtemp, dateobs, unid = light
+    low, high = (-1e9, 1e9) if ccdtemp is None else (ccdtemp-tolerance, ccdtemp+tolerance)
+    results = [columnar(con.execute(DARKSQL, (exptime, xbinning, ybinning, low, high))),
+               columnar(con.execute(FLATSQL, (filterName, xbinning, ybinning))),
+               columnar(con.execute(BIASSQL, (xbinning, ybinning, low, high)))]
+    return concatenate(results)
+
+# Best master of each type for a light, {frame: filename or None}, as calibration.py would pick them
+def calibrationMasters(con, lightFile):
+    light = con.execute(LIGHTSQL, (lightFile,)).fetchone()
+    if light is None:
+        raise ValueError("{0} is not in the index".format(lightFile))
+    fileName, frame, objectName, filterName, exptime, xbinning, ybinning, ccdtemp, dateobs, unid = light
+    hdr = {"EXPTIME": exptime or 0, "FILTER": filterName or "", "XBINNING": xbinning or 1,
+           "YBINNING": ybinning or 1, "CCD-TEMP": ccdtemp}
+    return {frame: calibration.findMaster(con, calibration.masterKey(frame, hdr)) for frame in ("Dark","Flat","Bias")}
+
+############################################################################################################
+# Frames with DATE-OBS in [start, end), optionally of one frame type and/or object. Dates are ISO strings,
+# "2024-01-01" or "2024-01-01T22:00:00".
+def framesByDate(con, start, end, frame=None, objectName=None):
+    where, params = "", [start, end]
+    if frame is not None:
+        where += " AND r.frame=?"
+        params.append(frame)
+    if objectName is not None:
+        objects = matchObjects(con, objectName) or [objectName]
+        where += " AND r.object IN ({0})".format(",".join("?"*len(objects)))
+        params += objects
+    return columnar(con.execute(DATESQL.format(where), params))
+
+############################################################################################################
+# Frames that pass quality limits (frameQuality.py metrics in fitsQuality), optionally of one object and/or
+# filter, as frameQuality.acceptable would pick them. A limit of None doesn't filter; frames never measured
+# are left out. The fitsQualityShape index covers the FWHM range.
+def qualityFrames(con, objectName=None, filterName=None, maxFwhm=None, maxEccentricity=None, minStars=None, frame="Light"):
+    where, params = "", [frame]
+    for condition, limit in (("q.fwhm<=?", maxFwhm), ("q.eccentricity<=?", maxEccentricity), ("q.stars>=?", minStars)):
+        if limit is not None:
+            where += " AND "+condition
+            params.append(limit)
+    if objectName is not None:
+        objects = matchObjects(con, objectName) or [objectName]
+        where += " AND r.object IN ({0})".format(",".join("?"*len(objects)))
+        params += objects
+    if filterName is not None:
+        where += " AND r.filter=?"
+        params.append(filterName)
+    return columnar(con.execute(QUALITYSQL.format(where), params))
+
+############################################################################################################
+# Print a columnar result as a table
+def printColumns(result, limit=None):
+    names = list(result)
+    rows = len(result[names[0]]) if names else 0
+    shown = rows if limit is None else min(rows, limit)
+    cells = [[("{0:.2f}".format(value) if name in FLOATCOLUMNS else str(value)) for value in result[name][:shown]] for name in names]
+    widths = [max([len(name)]+[len(cell) for cell in column]) for name, column in zip(names, cells)]
+    print("  ".join(name.ljust(width) for name, width in zip(names, widths)))
+    for i in range(shown):
+        print("  ".join(column[i].ljust(width) for column, width in zip(cells, widths)))
+    if shown < rows:
+        print("... {0} more rows".format(rows-shown))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the obsy.db index')
+    parser.add_argument('--db', required=True, type=str, help='obsy.db to query')
+    parser.add_argument('--limit', type=int, default=None, help='rows to print')
+    parser.add_argument('--timing', action='store_true', help='print how long the query took')
+    commands = parser.add_subparsers(dest='command', required=True)
+    integration = commands.add_parser('integration', help='integration time per object and filter')
+    integration.add_argument('--object', type=str, default=None, help='object, case and spaces ignored')
+    integration.add_argument('--filter', type=str, default=None, help='filter')
+    calibrate = commands.add_parser('calibration', help='calibration frames and masters matching a light')
+    calibrate.add_argument('light', type=str, help='file name of the light as indexed')
+    calibrate.add_argument('--tolerance', type=float, default=calibration.TEMPTOLERANCE, help='CCD-TEMP tolerance in degrees')
+    frames = commands.add_parser('frames', help='frames by DATE-OBS range')
+    frames.add_argument('--start', required=True, type=str, help='first date, fi 2024-01-01')
+    frames.add_argument('--end', required=True, type=str, help='date after the last, fi 2024-02-01')
+    frames.add_argument('--frame', type=str, default=None, help='Light, Dark, Flat or Bias')
+    frames.add_argument('--object', type=str, default=None, help='object, case and spaces ignored')
+    quality = commands.add_parser('quality', help='light frames passing quality limits')
+    quality.add_argument('--object', type=str, default=None, help='object, case and spaces ignored')
+    quality.add_argument('--filter', type=str, default=None, help='filter')
+    quality.add_argument('--max_fwhm', type=float, default=None, help='largest median star FWHM in pixels')
+    quality.add_argument('--max_eccentricity', type=float, default=None, help='largest median star eccentricity')
+    quality.add_argument('--min_stars', type=int, default=None, help='fewest stars detected')
+    args = parser.parse_args()
+
+    try:
+        con = obsyDB.connectReadOnly(args.db)
+    except sqlite3.Error as er:
+        logging.error('SQLite error: %s' % (' '.join(er.args)))
+        return
+    start = time.perf_counter()
+    try:
+        if args.command == 'integration':
+            result = integrationTime(con, args.object, args.filter)
+        elif args.command == 'calibration':
+            result = calibrationFrames(con, args.light, args.tolerance)
+            masters = calibrationMasters(con, args.light)
+        elif args.command == 'quality':
+            result = qualityFrames(con, args.object, args.filter, args.max_fwhm, args.max_eccentricity, args.min_stars)
+        else:
+            result = framesByDate(con, args.start, args.end, args.frame, args.object)
+    except sqlite3.Error as er:
+        logging.error('SQLite error: %s' % (' '.join(er.args)))
+        con.close()
+        return
+    elapsed = time.perf_counter()-start
+
+    printColumns(result, args.limit)
+    if args.command == 'integration' and len(result["hours"]):
+        print("Total {0:.2f} hours in {1} frames".format(result["hours"].sum(), result["frames"].sum()))
+    if args.command == 'calibration':
+        for frame, master in masters.items():
+            print("Master {0}: {1}".format(frame, master or "none"))
+    if args.timing:
+        print("Query took {0:.1f} ms".format(elapsed*1000))
+    con.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -14,141 +14,122 @@
 #      - Calibrate image prior to storing and stacking it (master dark/flat/bias)
 #
 ############################################################################################################ 
-import os
-from astropy.io import fits
 import logging
-import sqlite3
-import shutil
-import uuid
+from functools import partial
+import obsyDB
+import fitsScan
+import fileMover
+import thumbnailCache
 from pathlib import Path
 from datetime import datetime
 
-DEBUG=True
-
-# Function definitions
-def submitFile(fileName, hdr):
-    if "DATE-OBS" in hdr:
-        uuidStr=uuid.uuid4()
-        sqlStmt="INSERT INTO fitsFile (unid, date, filename) VALUES ('{0}','{1}','{2}')".format(uuidStr,hdr["DATE-OBS"],fileName)
-
-        try:
-            cur.execute(sqlStmt)
-            con.commit()
-        except sqlite3.Error as er:
-            logging.error('SQLite error: %s' % (' '.join(er.args)))
-            logging.error("Exception class is: ", er.__class__)
-            logging.error('SQLite traceback: ')
-            exc_type, exc_value, exc_tb = sys.exc_info()
-            logging.error(traceback.format_exception(exc_type, exc_value, exc_tb))
-            
-        for card in hdr:
-            if type(hdr[card]) not in [bool,int,float]:
-                keywordValue=str(hdr[card]).replace('\'',' ')
-            else:
-                keywordValue = hdr[card]
-            sqlStmt="INSERT INTO fitsHeader (thisUNID, parentUNID, keyword, value) VALUES ('{0}','{1}','{2}','{3}')".format(uuid.uuid4(),uuidStr,card,keywordValue)
-
-            try:
-                cur.execute(sqlStmt)
-                con.commit()
-            except sqlite3.Error as er:
-                logging.error('SQLite error: %s' % (' '.join(er.args)))
-                logging.error("Exception class is: ", er.__class__)
-                logging.error('SQLite traceback: ')
-                exc_type, exc_value, exc_tb = sys.exc_info()
-                logging.error(traceback.format_exception(exc_type, exc_value, exc_tb))
-    else:
-        logging.error("Error: File not added to repo due to missing date is "+fileName)
-        return 0
-    
-    return 1
-
-def createTables():
-    if DEBUG:
-        cur.execute("DROP TABLE if exists fitsFile")
-        cur.execute("DROP TABLE if exists fitsHeader")
-    cur.execute("CREATE TABLE if not exists fitsFile(unid, date, filename)")
-    cur.execute("CREATE TABLE if not exists fitsHeader(thisUNID, parentUNID, keyword, value)")
-    return
+DEBUG=False                     # Print every move and start the header index over on every run
 
 # Variable Declarations
 sourceFolder="E:/00 Data Repository New/"
 repoFolder="E:/00 Data Repository/"
 dbName = repoFolder+"obsy.db"
+batchSize = obsyDB.BATCHSIZE
+scanWorkers = None              # Header scanning processes, None for one per CPU
+CHECKSUMS = False               # Hash the content of every file as it is scanned (reads whole files, slower)
+SKIPDUPLICATES = False          # With CHECKSUMS, leave files whose content is already indexed where they are
+QUALITY = False                 # Measure background, noise, stars, FWHM and eccentricity of every frame (frameQuality.py)
+THUMBNAILS = False              # Make a small preview of every frame in thumbnailFolder (thumbnailCache.py, hashes every file)
+thumbnailFolder = repoFolder+"Thumbnails/"
+thumbnailMB = thumbnailCache.CACHEMB    # Size cap of thumbnailFolder, least recently used thumbnails go first
+moveWorkers = fileMover.MOVEWORKERS     # Files copied (or compressed) at once when the repository is on another disk/NAS
+ARCHIVE = False                 # Store frames tile compressed (.fits.fz, Rice) in the repository, verified lossless
+
+# Function definitions
+# Name, index and file one frame. fitsIngest and mover default to the ones of the mainline below,
+# watchFrames.py passes its own.
+def processFile(fileName, hdr, fitsIngest=None, mover=None, checksum=None, quality=None, thumbnail=None):
+    if fitsIngest is None:
+        fitsIngest = ingest
+    if mover is None:
+        mover = repoMover
+    if "FRAME" in hdr:
+        print(fileName)
+
+        # Create an os-friendly date
+        try:
+            datestr=hdr["DATE-OBS"].replace("T", " ")
+            datestr=datestr[0:datestr.find('.')]
+            dateobj=datetime.strptime(datestr, '%Y-%m-%d %H:%M:%S')
+            fitsDate=dateobj.strftime("%Y%m%d%H%M%S")
+        except (KeyError, ValueError) as e:
+            logging.warning("Invalid date format in header. File not processed is "+str(fileName))
+            return
 
-# Set up Database
-con = sqlite3.connect(dbName)
-cur = con.cursor()
-createTables()
+        # Create a new standard name for the file based on what it is
+        if (hdr["FRAME"]=="Light"):
+            if ("OBJECT" in hdr):
+                newName=newName="{0}-{1}-{2}-{3}s-{4}x{5}-t{6}.fits".format(hdr["OBJECT"].replace(" ", ""),hdr["FILTER"],fitsDate,hdr["EXPTIME"],hdr["XBINNING"],hdr["YBINNING"],hdr["CCD-TEMP"])
+            else:
+                logging.warning("Invalid object name in header. File not processed is "+str(fileName))
+                return
+        elif hdr["FRAME"]=="Dark" or hdr["FRAME"]=="Flat" or hdr["FRAME"]=="Bias":
+            newName="{0}-{1}-{2}s-{3}x{4}-t{5}.fits".format(hdr["FRAME"],fitsDate,hdr["EXPTIME"],hdr["XBINNING"],hdr["YBINNING"],hdr["CCD-TEMP"])
+        else:
+            logging.warning("File not processed as FRAME not recognized: "+str(fileName))
+            return
 
-# Set up logging
-logging.basicConfig(filename='batchRename.log', filemode='w', format='%(name)s - %(levelname)s - %(message)s')
+        # Work out the folder structure, the mover creates it if needed
+        fitsDate=dateobj.strftime("%Y%m%d")
+        if (hdr["FRAME"]=="Light"):
+            newPath=repoFolder+"Light/{0}/{1}/".format(hdr["OBJECT"].replace(" ", ""),fitsDate)
+        elif hdr["FRAME"]=="Dark":
+            newPath=repoFolder+"Calibrate/{0}/{1}/{2}/".format(hdr["FRAME"],hdr["EXPTIME"],fitsDate)
+        elif hdr["FRAME"]=="Flat":
+            newPath=repoFolder+"Calibrate/{0}/{1}/{2}/".format(hdr["FRAME"],hdr["FILTER"],fitsDate)
+        elif hdr["FRAME"]=="Bias":
+            newPath=repoFolder+"Calibrate/{0}/{1}/".format(hdr["FRAME"],fitsDate)
 
-# Scan the pictures folder
-for root, dirs, files in os.walk(os.path.abspath(sourceFolder)):
-    for file in files:
-        file_name, file_extension = os.path.splitext(os.path.join(root, file))
+        newFile=newPath+newName.replace(" ", "")
+        if ARCHIVE:
+            newFile+=fileMover.COMPRESSEDSUFFIX
 
-        # Ignore everything not a *fit* file
-        if (file_extension !=".fits") or (file_extension !=".fit"):
-            continue
-        if (file_extension ==".db"):
-            continue
-        try:
-            hdul = fits.open(os.path.join(root, file))
-        except ValueError as e:
-            logging.warning("Invalid FITS file. File not processed is "+str(os.path.join(root, file)))
-            continue   
-        
-        hdr = hdul[0].header
-        if "FRAME" in hdr:
-            print(os.path.join(root, file))
+        # If we can add the file to the database move it to the repo
+        # The move is journalled with the batch holding this file and started once that is committed
+        if DEBUG:
+            moveInfo="Moving {0} to {1}\n".format(fileName,newFile)
+            print(moveInfo)
+        if not fitsIngest.submitFile(newFile,hdr,onCommit=partial(mover.submit,fileName,newFile),move=(fileName,newFile),checksum=checksum,quality=quality,thumbnail=thumbnail):
+            logging.warning("Warning: File not added to repo is "+str(fileName))
+    else:
+        logging.warning("File not added to repo - no FRAME card - "+str(fileName))
+    return
 
-            # Create an os-friendly date
-            try:
-                datestr=hdr["DATE-OBS"].replace("T", " ")
-                datestr=datestr[0:datestr.find('.')]
-                dateobj=datetime.strptime(datestr, '%Y-%m-%d %H:%M:%S')
-                fitsDate=dateobj.strftime("%Y%m%d%H%M%S")
-            except ValueError as e:
-                logging.warning("Invalid date format in header. File not processed is "+str(os.path.join(root, file)))
-                continue
+if __name__ == "__main__":
+    # Set up Database
+    con = obsyDB.connectDB(dbName)
+    obsyDB.createTables(con)
+    repoMover = fileMover.FileMover(con, moveWorkers, processes=ARCHIVE)
 
-            # Create a new standard name for the file based on what it is
-            if (hdr["FRAME"]=="Light"):
-                if ("OBJECT" in hdr):
-                    newName=newName="{0}-{1}-{2}-{3}s-{4}x{5}-t{6}.fits".format(hdr["OBJECT"].replace(" ", ""),hdr["FILTER"],fitsDate,hdr["EXPTIME"],hdr["XBINNING"],hdr["YBINNING"],hdr["CCD-TEMP"])
-                else:
-                    logging.warning("Invalid object name in header. File not processed is "+str(os.path.join(root, file)))
-                    continue
-            elif hdr["FRAME"]=="Dark" or hdr["FRAME"]=="Flat" or hdr["FRAME"]=="Bias":
-                newName="{0}-{1}-{2}s-{3}x{4}-t{5}.fits".format(hdr["FRAME"],fitsDate,hdr["EXPTIME"],hdr["XBINNING"],hdr["YBINNING"],hdr["CCD-TEMP"])
-            else:
-                logging.warning("File not processed as FRAME not recognized: "+str(os.path.join(root, file)))
-            hdul.close()
+    # Set up logging
+    logging.basicConfig(filename='batchRename.log', filemode='w', format='%(name)s - %(levelname)s - %(message)s')
 
-            # Create the folder structure (if needed)
-            fitsDate=dateobj.strftime("%Y%m%d")
-            if (hdr["FRAME"]=="Light"):
-                newPath=repoFolder+"Light/{0}/{1}/".format(hdr["OBJECT"].replace(" ", ""),fitsDate)
-            elif hdr["FRAME"]=="Dark":
-                newPath=repoFolder+"Calibrate/{0}/{1}/{2}/".format(hdr["FRAME"],hdr["EXPTIME"],fitsDate)
-            elif hdr["FRAME"]=="Flat":
-                newPath=repoFolder+"Calibrate/{0}/{1}/{2}/".format(hdr["FRAME"],hdr["FILTER"],fitsDate)
-            elif hdr["FRAME"]=="Bias":
-                newPath=repoFolder+"Calibrate/{0}/{1}/".format(hdr["FRAME"],fitsDate)
+    # Finish any moves a crash of the last run left half done, before anything is dropped
+    fileMover.recoverMoves(con, repoMover)
+    if DEBUG:
+        obsyDB.createTables(con, drop=True)
+    ingest = obsyDB.FitsIngest(con, batchSize, skipDuplicates=SKIPDUPLICATES)
 
-            if not os.path.isdir(newPath):
-                os.makedirs (newPath)
+    # Scan the pictures folder, headers are read in parallel and written to the database here
+    for result in fitsScan.scanFolder(sourceFolder, scanWorkers, checksum=CHECKSUMS, quality=QUALITY,
+                                      thumbnails=thumbnailFolder if THUMBNAILS else None):
+        fileName, hdr = result[:2]
+        if hdr is None:
+            logging.warning("Invalid FITS file. File not processed is "+str(fileName))
+            continue
+        checksum, quality, thumbnail = result[2:] if len(result) > 2 else (None, None, None)
+        processFile(fileName, hdr, checksum=checksum, quality=quality, thumbnail=thumbnail)
 
-            # If we can add the file to the database move it to the repo
-            if (submitFile(newPath+newName.replace(" ", ""),hdr)):
-                if DEBUG:
-                    moveInfo="Moving {0} to {1}\n".format(os.path.join(root, file),newPath+newName)
-                    print(moveInfo)
-                shutil.move(os.path.join(root, file),newPath+newName)
-            else:
-                logging.warning("Warning: File not added to repo is "+str(os.path.join(root, file)))
-        else:
-            logging.warning("File not added to repo - no FRAME card - "+str(os.path.join(root, file)))
-            
\ No newline at end of file
+    # Write the last partial batch and move its files
+    ingest.close()
+    repoMover.close()
+    if CHECKSUMS:
+        obsyDB.printDuplicates(con, ingest.duplicates)
+    if THUMBNAILS:
+        thumbnailCache.pruneCache(con, thumbnailFolder, thumbnailMB)
+    con.close()
@@ -0,0 +1,175 @@
+############################################################################################################
+#
+# Name        : previewRender.py
+# Purpose     : Render the live stack to a stretched PNG/JPEG for the web server, in process
+# Author      : Gord Tulloch
+# Date        : March 8 2024
+# License     : GPL v3
+# Dependencies: numpy, Pillow
+# Usage       : renderer=previewRender.PreviewRenderer(maxSize=1600)
+#               renderer.render(stack.image(), "/var/www/html/M31-LiveStack.png")
+#
+# The image is binned down to the web size first (an integer block mean, so it is also a little smoother)
+# and only the small copy is stretched. The stretch is either a midtones transfer function like Siril and
+# PixInsight's autostretch or an asinh curve, with the black point at a low percentile of a subsample and
+# the midtone chosen so the sky background lands at targetBackground. Both become a 16 bit lookup table, so
+# applying the stretch is one index per pixel.
+#
+# Stretch parameters only change slowly as frames are added, so the normalized histogram of the subsample
+# the parameters were worked out from is kept. Each update compares the new subsample's histogram with it
+# and only works the parameters (percentiles, midtone, lookup table) out again when they have drifted.
+# The output is written to a temporary file and renamed so the web server never serves half a PNG.
+#
+############################################################################################################
+import os
+import logging
+import numpy as np
+from PIL import Image
+
+STRETCHMODES=("mtf","asinh")
+WEBSIZE=1600                # longest side of the web image in pixels
+SAMPLEPIXELS=250000         # pixels in the subsample used for the statistics
+BLACKPERCENTILE=0.5         # black point, percent of pixels clipped to black
+WHITEPERCENTILE=99.98       # white point
+TARGETBACKGROUND=0.25       # where the median (sky background) ends up after the stretch
+HISTBINS=256
+DRIFT=0.05                  # largest change in the cumulative histogram before the stretch is redone
+LUTSIZE=65536
+
+############################################################################################################
+# Bin an image down by an integer factor so its longest side is at most maxSize. Colour cubes stored
+# planes first (3, rows, cols) as in FITS come back as (rows, cols, 3) ready for Pillow. Always a new
+# array, even when no binning is needed: the stretch works on it in place and data may be the live stack.
+def downsample(data, maxSize=WEBSIZE):
+    if data.ndim == 3 and data.shape[0] in (1, 3) and data.shape[-1] not in (1, 3):
+        data = np.moveaxis(data, 0, -1)
+    rows, cols = data.shape[0], data.shape[1]
+    factor = max(1, -(-max(rows, cols)//maxSize))
+    if factor == 1:
+        return np.array(data, dtype=np.float32, copy=True)
+    rows, cols = rows//factor*factor, cols//factor*factor
+    # Sum the factor x factor strided views, much faster than a reshape and mean over two axes
+    binned = np.zeros((rows//factor, cols//factor)+data.shape[2:], dtype=np.float32)
+    for i in range(factor):
+        for j in range(factor):
+            binned += data[i:rows:factor, j:cols:factor]
+    binned *= np.float32(1.0/(factor*factor))
+    return binned
+
+# Regular subsample of about nPixels pixels
+def subsample(data, nPixels=SAMPLEPIXELS):
+    step = max(1, int(np.sqrt(data.shape[0]*data.shape[1]/nPixels)))
+    sample = data[::step,::step].ravel()
+    return sample[np.isfinite(sample)]
+
+############################################################################################################
+# Midtones transfer function: 0 to 0, 1 to 1 and m to 0.5
+def mtf(m, x):
+    return (m-1)*x/((2*m-1)*x-m)
+
+# asinh strength that puts x at target, by bisection on log(beta)
+def asinhBeta(x, target, iterations=40):
+    low, high = -5.0, 12.0
+    for i in range(iterations):
+        beta = np.exp((low+high)/2)
+        if np.arcsinh(beta*x)/np.arcsinh(beta) < target:
+            low = np.log(beta)
+        else:
+            high = np.log(beta)
+    return float(np.exp((low+high)/2))
+
+############################################################################################################
+# Stretch parameters from a subsample: black and white points and the midtone (mtf) or strength (asinh)
+def stretchParams(sample, mode="mtf", target=TARGETBACKGROUND, blackPercentile=BLACKPERCENTILE, whitePercentile=WHITEPERCENTILE):
+    black, median, white = np.percentile(sample, (blackPercentile, 50, whitePercentile))
+    if white <= black:
+        white = black+1.0
+    x = min(max((median-black)/(white-black), 1e-6), 0.999)
+    if mode == "mtf":
+        shape = float(mtf(target, x)) if x < target else 0.5
+    else:
+        shape = asinhBeta(x, target) if x < target else 1e-3
+    return {"mode": mode, "black": float(black), "white": float(white), "shape": shape}
+
+# Lookup table from LUTSIZE levels between black and white to 8 bit output
+def stretchTable(params):
+    x = np.linspace(0.0, 1.0, LUTSIZE)
+    if params["mode"] == "mtf":
+        y = mtf(params["shape"], x)
+    else:
+        y = np.arcsinh(params["shape"]*x)/np.arcsinh(params["shape"])
+    return np.clip(np.round(y*255), 0, 255).astype(np.uint8)
+
+# Map values to lookup table indexes, in place on a float32 array
+def tableIndex(data, params):
+    data -= np.float32(params["black"])
+    data *= np.float32((LUTSIZE-1)/(params["white"]-params["black"]))
+    np.clip(data, 0, LUTSIZE-1, out=data)
+    np.nan_to_num(data, copy=False)
+    return data.astype(np.uint16)
+
+# Cumulative normalized histogram of a sample as it comes out of the stretch, so a drift is measured in
+# what the preview actually shows
+def cumulativeHistogram(sample, params, table, bins=HISTBINS):
+    counts = np.bincount(table[tableIndex(sample.astype(np.float32), params)], minlength=bins)
+    return np.cumsum(counts)/max(len(sample), 1)
+
+############################################################################################################
+# Write an image atomically: to a temporary name in the same folder, then rename over the target
+def saveImage(pixels, fileName, quality=90):
+    root, extension = os.path.splitext(fileName)
+    tempName = root+".tmp"+extension
+    image = Image.fromarray(pixels)
+    if extension.lower() in (".jpg", ".jpeg"):
+        image.save(tempName, quality=quality)
+    else:
+        image.save(tempName, compress_level=1)
+    os.replace(tempName, fileName)
+    return fileName
+
+############################################################################################################
+# PreviewRenderer - keeps the stretch (and the histogram it came from) between updates of the live stack
+class PreviewRenderer():
+    def __init__(self, maxSize=WEBSIZE, mode="mtf", target=TARGETBACKGROUND, drift=DRIFT, quality=90):
+        if mode not in STRETCHMODES:
+            raise ValueError("Unknown stretch mode "+str(mode))
+        self.maxSize = maxSize
+        self.mode = mode
+        self.target = target
+        self.drift = drift
+        self.quality = quality
+        self.params = None
+        self.histogram = None
+        self.table = None
+        self.recomputed = 0
+        self.reused = 0
+
+    # Forget the stretch, for a new target
+    def reset(self):
+        self.params = self.histogram = self.table = None
+
+    # Work the stretch out again if there is none yet or the histogram has moved more than drift
+    def updateStretch(self, sample):
+        if self.params is not None:
+            histogram = cumulativeHistogram(sample, self.params, self.table)
+            if np.abs(histogram-self.histogram).max() <= self.drift:
+                self.reused += 1
+                return False
+        self.params = stretchParams(sample, self.mode, self.target)
+        self.table = stretchTable(self.params)
+        self.histogram = cumulativeHistogram(sample, self.params, self.table)
+        self.recomputed += 1
+        logging.info("Preview stretch recomputed: {0}".format(self.params))
+        return True
+
+    # Stretched 8 bit preview of an image (mono or colour), binned to the web size
+    def preview(self, data):
+        small = downsample(np.asarray(data), self.maxSize)
+        self.updateStretch(subsample(small))
+        return self.table[tableIndex(small, self.params)]
+
+    def render(self, data, fileName):
+        pixels = self.preview(data)
+        if pixels.ndim == 3 and pixels.shape[-1] == 1:
+            pixels = pixels[...,0]
+        return saveImage(pixels, fileName, self.quality)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+############################################################################################################
+#
+# Name        : skyHistory.py
+# Purpose     : Rolling history of cloud, rain and weather samples in obsy.db, with rolling window trends
+#               (mean, slope, fraction clear) that MCP.py bases its open and close decisions on
+# Author      : Gord Tulloch
+# Date        : March 26 2024
+# License     : GPL v3
+# Dependencies: numpy
+# Usage       : history = skyHistory.SkyHistory(con)
+#               history.add(cloud=0.12, rain=False, unsafe=False, weather={"wind": 8.2})
+#               history.window(20)                      # {"mean":..., "slope":..., "clear":..., ...}
+#               obsyState = history.decide(obsyState)   # "Open" or "Closed"
+#               python skyHistory.py --db obsy.db --minutes 10 20 60
+#
+# MCP.py used to count consecutive bad or good minutes, so one misclassified allsky image in the middle of
+# a clear spell started the count again and a ragged night cycled the roof. Each minute's sample is now
+# kept: the cloud probability from cloudModel.py (one minus the probability of the clear classes), the rain
+# sensor, whether getWeather() found conditions unsafe and its wind, temperature and humidity. A sample is
+# clear if its cloud probability is below CLEARCLOUD with no rain and safe weather.
+#
+# Samples go into the skyHistory table as a ring buffer of HISTORYSLOTS rows (a month at one a minute),
+# each new sample overwriting the oldest, so the table never grows. Recent samples are also held in memory
+# by RollingWindow objects that keep running sums as samples arrive and leave, so the mean, least squares
+# slope and clear fraction over N minutes cost the same however long the window is. A restarted MCP.py
+# fills its windows from the table and carries on where it left off.
+#
+# decide() has hysteresis: the roof opens only after OPENMINUTES of mostly clear samples with cloud not
+# rising, and closes when the shorter CLOSEMINUTES window is mostly cloudy or cloud is building quickly
+# (rising and already well above clear on average), so a single bad or good image changes nothing.
+#
+############################################################################################################
+import argparse
+import time
+import logging
+import sqlite3
+from collections import deque
+import numpy as np
+
+import obsyDB
+
+HISTORYSLOTS=43200      # ring buffer rows, 30 days at one sample a minute
+CLEARCLOUD=0.5          # a sample is clear below this cloud probability (with no rain and safe weather)
+OPENMINUTES=20          # window the open decision looks at
+OPENCLEAR=0.9           # fraction of its samples that must be clear to open
+MAXOPENSLOPE=0.01       # and cloud must not be rising faster than this per minute
+MINCOVERAGE=0.8         # fraction of the open window the samples must span, so a restart doesn't open early
+CLOSEMINUTES=10         # window the close decision looks at
+CLOSECLEAR=0.5          # close when fewer of its samples than this are clear
+CLOSESLOPE=0.02         # or cloud is rising faster than this per minute
+CLOSEMEAN=0.3           # with the mean cloud of the window already above this
+REBASEMINUTES=1440      # window times are minutes from an origin moved up to the oldest sample this often
+
+############################################################################################################
+# Running statistics over the samples of the last N minutes. Samples without a cloud probability (the
+# model wasn't available) count towards the clear fraction, as not clear, but not the mean or slope.
+class RollingWindow:
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self.samples = deque()      # (time, minutes from origin, cloud, clear)
+        self.origin = None
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.clearCount = 0
+        self.n = 0
+        self.sumT = 0.0
+        self.sumTT = 0.0
+        self.sumY = 0.0
+        self.sumTY = 0.0
+
+    def accumulate(self, t, cloud, clear, sign):
+        self.count += sign
+        self.clearCount += sign*int(clear)
+        if cloud is not None:
+            self.n += sign
+            self.sumT += sign*t
+            self.sumTT += sign*t*t
+            self.sumY += sign*cloud
+            self.sumTY += sign*t*cloud
+
+    def add(self, when, cloud, clear):
+        if self.origin is None:
+            self.origin = when
+        t = (when-self.origin)/60
+        self.samples.append((when, t, cloud, clear))
+        self.accumulate(t, cloud, clear, 1)
+        while when-self.samples[0][0] > self.minutes*60:
+            old, oldT, oldCloud, oldClear = self.samples.popleft()
+            self.accumulate(oldT, oldCloud, oldClear, -1)
+        if self.samples[0][1] > REBASEMINUTES:
+            self.rebase()
+
+    # Measure times from the oldest sample again and recompute the sums, so subtracting samples that
+    # leave doesn't lose precision as the times grow. add() does this once the origin is REBASEMINUTES
+    # behind the oldest sample, so it is done once every REBASEMINUTES of samples whatever the window length.
+    def rebase(self):
+        self.origin = self.samples[0][0]
+        self.samples = deque((when, (when-self.origin)/60, cloud, clear) for when, t, cloud, clear in self.samples)
+        self.reset()
+        for when, t, cloud, clear in self.samples:
+            self.accumulate(t, cloud, clear, 1)
+
+    # samples, span (minutes from the first sample to the last), mean cloud, slope of cloud per minute,
+    # fraction of samples clear, and the latest cloud value. mean and slope are None without enough samples.
+    def stats(self):
+        mean = self.sumY/self.n if self.n else None
+        denominator = self.n*self.sumTT-self.sumT*self.sumT
+        slope = (self.n*self.sumTY-self.sumT*self.sumY)/denominator if self.n > 1 and denominator > 1e-9 else None
+        return {"samples": self.count,
+                "span": (self.samples[-1][0]-self.samples[0][0])/60 if self.samples else 0.0,
+                "mean": mean, "slope": slope,
+                "clear": self.clearCount/self.count if self.count else 0.0,
+                "latest": self.samples[-1][2] if self.samples else None}
+
+############################################################################################################
+class SkyHistory:
+    def __init__(self, con, windows=(CLOSEMINUTES, OPENMINUTES), slots=HISTORYSLOTS):
+        self.con = con
+        self.slots = slots
+        row = con.execute("SELECT slot FROM skyHistory ORDER BY time DESC LIMIT 1").fetchone()
+        self.slot = (row[0]+1) % slots if row is not None else 0
+        self.windows = {}
+        for minutes in windows:
+            self.window(minutes)
+
+    # Statistics of the last minutes, the window made (and filled from the table) the first time it is asked for
+    def window(self, minutes):
+        if minutes not in self.windows:
+            window = RollingWindow(minutes)
+            for when, cloud, rain, unsafe in self.con.execute("SELECT time, cloud, rain, unsafe FROM skyHistory WHERE time>=? ORDER BY time",
+                                                              (time.time()-minutes*60,)):
+                window.add(when, cloud, isClear(cloud, rain, unsafe))
+            self.windows[minutes] = window
+        return self.windows[minutes].stats()
+
+    # Record a sample. weather is the dict of readings from getWeather, wind, temperature and humidity kept.
+    def add(self, cloud=None, rain=False, unsafe=False, weather=None, when=None):
+        when = time.time() if when is None else when
+        weather = weather or {}
+        obsyDB.recordSky(self.con, self.slot, (when, cloud, int(bool(rain)), int(bool(unsafe)),
+                         weather.get("wind"), weather.get("temperature"), weather.get("humidity")))
+        self.slot = (self.slot+1) % self.slots
+        clear = isClear(cloud, rain, unsafe)
+        for window in self.windows.values():
+            window.add(when, cloud, clear)
+
+    # "Open" or "Closed" from the trends, given the current state
+    def decide(self, state):
+        if state == "Open":
+            recent = self.window(CLOSEMINUTES)
+            if recent["clear"] < CLOSECLEAR:
+                return "Closed"
+            if recent["slope"] is not None and recent["slope"] > CLOSESLOPE and recent["mean"] > CLOSEMEAN:
+                return "Closed"
+            return "Open"
+        trend = self.window(OPENMINUTES)
+        if (trend["span"] >= MINCOVERAGE*OPENMINUTES and trend["clear"] >= OPENCLEAR
+                and (trend["slope"] is None or trend["slope"] <= MAXOPENSLOPE)):
+            return "Open"
+        return "Closed"
+
+def isClear(cloud, rain, unsafe):
+    return cloud is not None and cloud < CLEARCLOUD and not rain and not unsafe
+
+############################################################################################################
+# The samples of the last minutes as NumPy arrays (time, cloud, rain, unsafe, wind, temperature, humidity),
+# oldest first, cloud and weather readings NaN where they weren't available
+def readHistory(con, minutes):
+    rows = con.execute("SELECT time, cloud, rain, unsafe, wind, temperature, humidity FROM skyHistory WHERE time>=? ORDER BY time",
+                       (time.time()-minutes*60,)).fetchall()
+    columns = ["time", "cloud", "rain", "unsafe", "wind", "temperature", "humidity"]
+    if not rows:
+        return {column: np.empty(0) for column in columns}
+    data = np.array(rows, dtype=np.float64)
+    return {column: data[:,i] for i, column in enumerate(columns)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Rolling cloud, rain and weather trends from obsy.db')
+    parser.add_argument('--db', required=True, type=str, help='obsy.db written by MCP.py')
+    parser.add_argument('--minutes', type=int, nargs='+', default=[CLOSEMINUTES, OPENMINUTES, 60], help='window lengths')
+    args = parser.parse_args()
+
+    con = obsyDB.connectDB(args.db)
+    try:
+        obsyDB.createTables(con)
+        history = SkyHistory(con, args.minutes)
+    except sqlite3.Error as er:
+        logging.error('SQLite error: %s' % (' '.join(er.args)))
+        return
+    for minutes in args.minutes:
+        stats = history.window(minutes)
+        print("{0:4d} min: {1:3d} samples, cloud mean {2}, slope {3}/min, {4:.0%} clear".format(minutes, stats["samples"],
+              "-" if stats["mean"] is None else "{0:.2f}".format(stats["mean"]),
+              "-" if stats["slope"] is None else "{0:+.3f}".format(stats["slope"]), stats["clear"]))
+    print("Decision if closed: {0}, if open: {1}".format(history.decide("Closed"), history.decide("Open")))
+    con.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+############################################################################################################
+#
+# Name        : stackEngine.py
+# Purpose     : In-process live stacking engine for liveStack.py
+# Author      : Gord Tulloch
+# Date        : February 26 2024
+# License     : GPL v3
+# Dependencies: numpy, astropy. pysiril only for the optional Siril backend
+# Usage       : stack=stackEngine.LiveStack(mode="sigma", stateFolder=workingFolder+"State/")
+#               stack.addFile(fileName)          # or stack.addFrame(numpyArray)
+#               stack.writeFits(outputFile)
+#
+# The stack is kept as a running float32 mean (Welford's method) so each frame is one O(pixels) update
+# and the accumulator never grows out of range the way a float32 sum would. Modes:
+#   sum   - the mean times the number of frames, like Siril's sum stack
+#   mean  - the running mean
+#   sigma - running mean with per-pixel sigma clipping: once minFrames frames are in, a pixel more than
+#           kappa standard deviations (from the running Welford variance) from the mean is not added
+#
+############################################################################################################
+import os
+import json
+import shutil
+import logging
+import numpy as np
+from astropy.io import fits
+
+STACKMODES=("sum","mean","sigma")
+CHUNKROWS=256                   # rows updated at a time, bounds the scratch memory of an update
+STATEFILE="state.json"
+STACKEDFILE="stacked.txt"
+
+############################################################################################################
+# The HDU holding a frame's image: the primary HDU, or for a tile compressed file (fpack, .fz, the
+# repository's archival mode) the compressed image extension behind its empty primary HDU
+def imageHDU(hdul):
+    if hdul[0].header.get("NAXIS", 0) == 0 and len(hdul) > 1 and isinstance(hdul[1], fits.CompImageHDU):
+        return hdul[1]
+    return hdul[0]
+
+# Read the image of a FITS file as float32
+def readFrame(fileName):
+    with fits.open(fileName) as hdul:
+        hdu = imageHDU(hdul)
+        return hdu.data.astype(np.float32), hdu.header.copy()
+
+############################################################################################################
+# Open the image of a FITS file as a memmap of the raw values without scaling, so no copy of the frame is
+# made. Returns (hdul, data, bscale, bzero), the caller closes hdul when finished with data. A compressed
+# image can't be memory mapped: data is the decompressed array, or with section its .section, which only
+# decompresses the tiles a slice touches (for reading a band of rows at a time).
+def openFrame(fileName, section=False):
+    hdul = fits.open(fileName, memmap=True, do_not_scale_image_data=True)
+    hdu = imageHDU(hdul)
+    header = hdu.header
+    data = hdu.section if (section and isinstance(hdu, fits.CompImageHDU)) else hdu.data
+    return hdul, data, float(header.get("BSCALE", 1.0)), float(header.get("BZERO", 0.0))
+
+############################################################################################################
+# LiveStack - NumPy running accumulator. With a stateFolder the accumulators are memory-mapped files in
+# that folder and the frame count, mode and header are saved alongside after every frame, so a restarted
+# liveStack.py resumes the stack instead of starting over and the OS can page the accumulators out
+# instead of swapping. A crash in the middle of an update can leave that one frame partly added.
+class LiveStack():
+    def __init__(self, mode="mean", kappa=3.0, minFrames=5, stateFolder=None):
+        if mode not in STACKMODES:
+            raise ValueError("Unknown stack mode "+str(mode))
+        self.mode = mode
+        self.kappa = kappa
+        self.minFrames = minFrames
+        self.stateFolder = stateFolder
+        self.frames = 0
+        self.header = None
+        self.mean = None
+        self.m2 = None          # sum of squared differences from the mean, sigma mode only
+        self.count = None       # per-pixel count of frames accepted, sigma mode only
+        self.stacked = set()    # files already in the stack
+        if stateFolder is not None:
+            self.resume()
+
+    def arrays(self):
+        return ["mean","m2","count"] if self.mode == "sigma" else ["mean"]
+
+    def allocate(self, shape, resume=False):
+        for name in self.arrays():
+            if self.stateFolder is None:
+                setattr(self, name, np.zeros(shape, dtype=np.float32))
+            else:
+                fileName = os.path.join(self.stateFolder, name+".f32")
+                setattr(self, name, np.memmap(fileName, dtype=np.float32, mode="r+" if resume else "w+", shape=shape))
+        return
+
+    # Pick up a saved stack from the state folder, if there is one for the same mode
+    def resume(self):
+        os.makedirs(self.stateFolder, exist_ok=True)
+        stateName = os.path.join(self.stateFolder, STATEFILE)
+        if not os.path.isfile(stateName):
+            return False
+        with open(stateName) as f:
+            state = json.load(f)
+        if state["mode"] != self.mode:
+            logging.warning("Saved live stack is mode {0} not {1}, starting a new stack".format(state["mode"], self.mode))
+            self.reset()
+            return False
+        self.frames = state["frames"]
+        self.header = fits.Header.fromstring(state["header"]) if state["header"] else None
+        self.allocate(tuple(state["shape"]), resume=True)
+        stackedName = os.path.join(self.stateFolder, STACKEDFILE)
+        if os.path.isfile(stackedName):
+            with open(stackedName) as f:
+                self.stacked = set(line.rstrip("\n") for line in f)
+        logging.info("Resumed live stack of {0} frames".format(self.frames))
+        return True
+
+    # Flush the accumulators and write the state file (atomically, through a rename)
+    def save(self, fileName=None):
+        if self.stateFolder is None or self.mean is None:
+            return
+        for name in self.arrays():
+            getattr(self, name).flush()
+        state = {"mode": self.mode, "frames": self.frames, "shape": list(self.mean.shape),
+                 "header": self.header.tostring() if self.header is not None else ""}
+        stateName = os.path.join(self.stateFolder, STATEFILE)
+        with open(stateName+".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(stateName+".tmp", stateName)
+        if fileName is not None:
+            with open(os.path.join(self.stateFolder, STACKEDFILE), "a") as f:
+                f.write(fileName+"\n")
+        return
+
+    # Throw the stack away, including anything saved in the state folder
+    def reset(self):
+        self.frames = 0
+        self.header = None
+        self.mean = self.m2 = self.count = None
+        self.stacked = set()
+        if self.stateFolder is not None:
+            for name in self.arrays()+[STATEFILE, STACKEDFILE]:
+                fileName = os.path.join(self.stateFolder, name+".f32" if name in self.arrays() else name)
+                if os.path.isfile(fileName):
+                    os.remove(fileName)
+        return
+
+    # Add a frame. data can be any numeric array including a raw memmap, bscale/bzero are applied on the
+    # fly a chunk of rows at a time so no full size float copy of the frame is ever made.
+    def addFrame(self, data, header=None, bscale=1.0, bzero=0.0):
+        if self.mean is None:
+            self.allocate(data.shape)
+        elif data.shape != self.mean.shape:
+            raise ValueError("Frame shape {0} does not match stack shape {1}".format(data.shape, self.mean.shape))
+        if header is not None and self.header is None:
+            self.header = header
+
+        self.frames += 1
+        rows = data.reshape(-1, data.shape[-1])
+        for start in range(0, rows.shape[0], CHUNKROWS):
+            chunk = slice(start, start+CHUNKROWS)
+            self.updateChunk(rows[chunk], chunk, np.float32(bscale), np.float32(bzero))
+        return self.frames
+
+    def updateChunk(self, data, chunk, bscale, bzero):
+        mean = self.mean.reshape(-1, self.mean.shape[-1])[chunk]
+        delta = np.multiply(data, bscale, dtype=np.float32)
+        if bzero:
+            delta += bzero
+        delta -= mean
+        if self.mode != "sigma":
+            # Same update for every pixel, the count is a scalar
+            delta /= np.float32(self.frames)
+            mean += delta
+            return
+
+        # Sigma clipping against the running statistics, accepted pixels get a Welford update
+        m2 = self.m2.reshape(-1, self.m2.shape[-1])[chunk]
+        count = self.count.reshape(-1, self.count.shape[-1])[chunk]
+        if self.frames > self.minFrames:
+            limit = m2 / np.maximum(count - 1, 1)
+            np.sqrt(limit, out=limit)
+            limit *= np.float32(self.kappa)
+            accept = np.abs(delta) <= limit
+            # No spread yet (identical values so far) means nothing to clip against
+            accept |= (m2 == 0)
+            delta *= accept
+            count += accept
+        else:
+            count += 1
+        step = delta / np.maximum(count, 1)
+        mean += step
+        # m2 += (data - oldMean) * (data - newMean), and data - newMean is delta - step
+        step -= delta
+        step *= delta
+        m2 -= step
+        return
+
+    # Add a FITS file read through a memmap. sourceName is the name recorded as stacked, if it differs
+    # from the file actually read (a calibrated copy for example). calibrate is an optional function taking
+    # (float32 data, header) and returning the calibrated frame. With an aligner (starAlign.StarAligner)
+    # the frame is registered onto the reference for its OBJECT first, and is left out of the stack
+    # (returning None) if that fails.
+    def addFile(self, fileName, sourceName=None, aligner=None, calibrate=None):
+        hdul, data, bscale, bzero = openFrame(fileName)
+        try:
+            header = imageHDU(hdul).header.copy()
+            frames = None
+            if calibrate is not None:
+                scaled = np.multiply(data, np.float32(bscale), dtype=np.float32)
+                if bzero:
+                    scaled += np.float32(bzero)
+                data, bscale, bzero = calibrate(scaled, header), 1.0, 0.0
+            if aligner is not None:
+                data = aligner.align(data, header.get("OBJECT", "Unknown"))
+            if data is not None:
+                frames = self.addFrame(data, header, bscale, bzero)
+        finally:
+            del data
+            hdul.close()
+        sourceName = fileName if sourceName is None else sourceName
+        self.stacked.add(sourceName)
+        self.save(sourceName)
+        return frames
+
+    # The stacked image for the current mode
+    def image(self):
+        if self.mean is None:
+            return None
+        if self.mode == "sum":
+            return self.mean * np.float32(self.frames)
+        return np.asarray(self.mean)
+
+    # Per-pixel standard deviation of the accepted frames (sigma mode only)
+    def sigma(self):
+        if self.m2 is None:
+            return None
+        return np.sqrt(self.m2 / np.maximum(self.count - 1, 1))
+
+    def writeFits(self, fileName):
+        header = fits.Header() if self.header is None else self.header.copy()
+        for keyword in ("BZERO","BSCALE"):
+            header.remove(keyword, ignore_missing=True)
+        header["STACKCNT"] = (self.frames, "Number of frames in live stack")
+        header["STACKMOD"] = (self.mode, "Live stack combine mode")
+        fits.writeto(fileName, self.image(), header, overwrite=True)
+        return fileName
+
+############################################################################################################
+# SirilStack - the original pySiril round trip, each frame is copied into the working folder and summed
+# with the previous result. Kept as an optional backend with the same interface as LiveStack.
+class SirilStack():
+    def __init__(self, workingFolder):
+        from pysiril.siril   import Siril
+        from pysiril.wrapper import Wrapper
+        self.workingFolder = workingFolder
+        self.lightFolder = os.path.join(workingFolder, "Light")
+        os.makedirs(self.lightFolder, exist_ok=True)
+        self.frames = 0
+        self.app = Siril()
+        self.cmd = Wrapper(self.app)
+        self.cmd.set16bits()
+        self.cmd.setext('fits')
+        self.cmd.cd(self.lightFolder)
+
+    def addFile(self, fileName, sourceName=None, aligner=None, calibrate=None):
+        first = os.path.join(self.lightFolder, "Main_001.fits")
+        if self.frames == 0:
+            shutil.copy(fileName, first)
+            self.frames = 1
+            return self.frames
+        shutil.copy(fileName, os.path.join(self.lightFolder, "Main_002.fits"))
+        try:
+            self.cmd.stack("Main_", type='sum', output_norm=False)
+        except Exception as e:
+            logging.error("Siril stack failed: "+str(e))
+            return self.frames
+        for file in os.listdir(self.lightFolder):
+            if file.endswith(".seq") or file.startswith("r_Main") or file == "Main_002.fits":
+                os.remove(os.path.join(self.lightFolder, file))
+        os.replace(os.path.join(self.lightFolder, "Main_stacked.fits"), first)
+        self.frames += 1
+        return self.frames
+
+    def image(self):
+        if self.frames == 0:
+            return None
+        return readFrame(os.path.join(self.lightFolder, "Main_001.fits"))[0]
+
+    def writeFits(self, fileName):
+        shutil.copy(os.path.join(self.lightFolder, "Main_001.fits"), fileName)
+        return fileName
+
+    def close(self):
+        self.app.Close()
+        del self.app
@@ -0,0 +1,222 @@
+############################################################################################################
+#
+# Name        : starAlign.py
+# Purpose     : Star based frame registration for the live stack
+# Author      : Gord Tulloch
+# Date        : March 1 2024
+# License     : GPL v3
+# Dependencies: numpy, scipy
+# Usage       : aligner=starAlign.StarAligner(cacheFolder)
+#               aligned=aligner.align(data, "NGC7635")     # None if the frame could not be registered
+#
+# Stars are found on a binned copy of the frame (smooth, local maxima above a noise threshold, flux
+# weighted centroid) and the brightest are turned into triangles described by their side ratios, which
+# don't change with shift, rotation (meridian flip) or scale. Triangles are matched against the reference
+# for the target with a KD-tree, matched triangles vote for star pairs and an affine transform is fitted to
+# the pairs with outlier rejection. The frame is then resampled onto the reference grid.
+#
+# The reference stars and their triangle tree are worked out once per target and cached (in memory and as
+# an .npz in cacheFolder), so every new frame only pays for its own detection and match.
+#
+############################################################################################################
+import os
+import logging
+from itertools import combinations
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+MAXSTARS=40             # brightest stars used for matching
+TRIANGLESTARS=15        # brightest stars used to build triangles (455 triangles)
+DETECTSIGMA=5.0         # detection threshold in noise sigma
+DETECTBIN=2             # binning of the detection image
+MINMATCHES=6            # star pairs needed to accept a registration
+
+############################################################################################################
+# Bin an image by an integer factor (trimming the edges) so detection works on fewer pixels
+def binImage(data, factor):
+    if factor <= 1:
+        return np.asarray(data, dtype=np.float32)
+    h = data.shape[0]//factor*factor
+    w = data.shape[1]//factor*factor
+    # Sum the strided views, faster than a reshape and mean over two axes and no float copy of the frame
+    binned = np.zeros((h//factor, w//factor), dtype=np.float32)
+    for i in range(factor):
+        for j in range(factor):
+            binned += data[i:h:factor, j:w:factor]
+    binned *= np.float32(1.0/(factor*factor))
+    return binned
+
+############################################################################################################
+# Detect stars. Returns an array of (x, y, flux) in full resolution pixel coordinates, brightest first.
+def detectStars(data, maxStars=MAXSTARS, threshold=DETECTSIGMA, binning=DETECTBIN):
+    if data.ndim == 3:
+        data = data[0] if data.shape[0] < data.shape[-1] else data[...,0]
+    image = binImage(data, binning)
+    sample = image[::4,::4]
+    background = np.median(sample)
+    noise = 1.4826*np.median(np.abs(sample-background))
+    if noise <= 0:
+        noise = max(float(np.std(sample)), 1e-6)
+    smooth = ndimage.gaussian_filter(image-background, 1.0)
+    peaks = (smooth == ndimage.maximum_filter(smooth, size=5)) & (smooth > threshold*noise)
+    peaks[:3,:] = peaks[-3:,:] = peaks[:,:3] = peaks[:,-3:] = False
+    y, x = np.nonzero(peaks)
+    if len(x) == 0:
+        return np.zeros((0,3))
+    flux = smooth[y, x]
+    order = np.argsort(flux)[::-1][:maxStars*3]
+    y, x = y[order], x[order]
+
+    # Flux weighted centroid over a 5x5 box, all stars at once
+    offsets = np.arange(-2, 3)
+    boxY = y[:,None,None]+offsets[None,:,None]
+    boxX = x[:,None,None]+offsets[None,None,:]
+    box = np.clip(smooth[boxY, boxX], 0, None)
+    total = box.sum(axis=(1,2))
+    ok = total > 0
+    cy = y[ok]+(box[ok]*offsets[None,:,None]).sum(axis=(1,2))/total[ok]
+    cx = x[ok]+(box[ok]*offsets[None,None,:]).sum(axis=(1,2))/total[ok]
+
+    stars = np.column_stack(((cx+0.5)*binning-0.5, (cy+0.5)*binning-0.5, total[ok]))
+    return stars[:maxStars]
+
+############################################################################################################
+# Triangles of the brightest stars. Returns the star index triples and their invariants: the two shorter
+# sides divided by the longest, with the vertices ordered by the opposite side so they correspond.
+def triangleInvariants(stars, nStars=TRIANGLESTARS):
+    n = min(len(stars), nStars)
+    if n < 3:
+        return np.zeros((0,3), dtype=int), np.zeros((0,2))
+    triples = np.array(list(combinations(range(n), 3)))
+    p = stars[triples][:,:,:2]
+    # side opposite each vertex
+    sides = np.stack((np.linalg.norm(p[:,1]-p[:,2], axis=1),
+                      np.linalg.norm(p[:,0]-p[:,2], axis=1),
+                      np.linalg.norm(p[:,0]-p[:,1], axis=1)), axis=1)
+    order = np.argsort(sides, axis=1)
+    sides = np.take_along_axis(sides, order, axis=1)
+    triples = np.take_along_axis(triples, order, axis=1)
+    keep = sides[:,0] > 0
+    return triples[keep], sides[keep,:2]/sides[keep,2:3]
+
+############################################################################################################
+# Least squares affine fit dst = A @ src + t, with iterative rejection of pairs that don't fit
+def fitAffine(src, dst, rejectPixels=2.0, iterations=3):
+    keep = np.ones(len(src), dtype=bool)
+    for i in range(iterations):
+        if keep.sum() < 3:
+            return None, keep
+        design = np.column_stack((src[keep], np.ones(keep.sum())))
+        coeffs, *_ = np.linalg.lstsq(design, dst[keep], rcond=None)
+        residual = np.linalg.norm(np.column_stack((src, np.ones(len(src)))) @ coeffs - dst, axis=1)
+        newKeep = residual < max(rejectPixels, 3*np.median(residual[keep]))
+        if (newKeep == keep).all():
+            break
+        keep = newKeep
+    return coeffs, keep
+
+############################################################################################################
+# Reference star list for one target, with its triangle KD-tree built once
+class StarReference():
+    def __init__(self, stars):
+        self.stars = stars
+        self.triples, self.invariants = triangleInvariants(stars)
+        self.tree = cKDTree(self.invariants) if len(self.invariants) else None
+
+    # Match a frame's stars to the reference. Returns (frameIndex, referenceIndex) pairs.
+    def match(self, stars, tolerance=0.01):
+        triples, invariants = triangleInvariants(stars)
+        if self.tree is None or len(invariants) == 0:
+            return np.zeros((0,2), dtype=int)
+        distance, nearest = self.tree.query(invariants, distance_upper_bound=tolerance)
+        found = np.isfinite(distance)
+        if not found.any():
+            return np.zeros((0,2), dtype=int)
+        # Each matched triangle votes for its three vertex pairs
+        votes = np.zeros((len(stars), len(self.stars)), dtype=np.int32)
+        np.add.at(votes, (triples[found].ravel(), self.triples[nearest[found]].ravel()), 1)
+        best = votes.argmax(axis=1)
+        strength = votes[np.arange(len(stars)), best]
+        pairs = np.column_stack((np.nonzero(strength >= 2)[0], best[strength >= 2]))
+        # One frame star per reference star, the one with the most votes
+        if len(pairs):
+            order = np.argsort(-strength[pairs[:,0]])
+            pairs = pairs[order]
+            pairs = pairs[np.unique(pairs[:,1], return_index=True)[1]]
+        return pairs
+
+############################################################################################################
+# StarAligner - registers frames of each target onto the first frame seen (or the cached reference)
+class StarAligner():
+    def __init__(self, cacheFolder=None, order=1):
+        self.cacheFolder = cacheFolder
+        self.order = order
+        self.references = {}
+        if cacheFolder is not None:
+            os.makedirs(cacheFolder, exist_ok=True)
+
+    def cacheName(self, target):
+        return os.path.join(self.cacheFolder, "".join(c for c in target if c.isalnum() or c in "-_")+"-stars.npz")
+
+    def reference(self, target):
+        if target in self.references:
+            return self.references[target]
+        if self.cacheFolder is not None and os.path.isfile(self.cacheName(target)):
+            self.references[target] = StarReference(np.load(self.cacheName(target))["stars"])
+            return self.references[target]
+        return None
+
+    def setReference(self, target, stars):
+        self.references[target] = StarReference(stars)
+        if self.cacheFolder is not None:
+            np.savez(self.cacheName(target), stars=stars)
+        return self.references[target]
+
+    def resetReference(self, target):
+        self.references.pop(target, None)
+        if self.cacheFolder is not None and os.path.isfile(self.cacheName(target)):
+            os.remove(self.cacheName(target))
+
+    # Affine transform mapping reference (x, y) to frame (x, y) as a 2x3 array [A | t], None if no match.
+    # The first frame of a target becomes its reference and gets the identity.
+    def solve(self, data, target):
+        stars = detectStars(data)
+        reference = self.reference(target)
+        if reference is None:
+            if len(stars) < MINMATCHES:
+                logging.warning("Only {0} stars found, not using this frame as the reference".format(len(stars)))
+                return None
+            self.setReference(target, stars)
+            return np.array([[1.0,0.0,0.0],[0.0,1.0,0.0]])
+        pairs = reference.match(stars)
+        if len(pairs) < MINMATCHES:
+            logging.warning("Registration failed, {0} star matches".format(len(pairs)))
+            return None
+        coeffs, keep = fitAffine(reference.stars[pairs[:,1],:2], stars[pairs[:,0],:2])
+        if coeffs is None or keep.sum() < MINMATCHES:
+            logging.warning("Registration failed, affine fit rejected too many stars")
+            return None
+        return coeffs.T
+
+    # Resample a frame onto the reference grid. Works plane by plane for colour cubes.
+    def warp(self, data, transform, output=None):
+        # ndimage works in (row, col) = (y, x), so swap the axes of the transform
+        matrix = np.array([[transform[1,1], transform[1,0]], [transform[0,1], transform[0,0]]])
+        offset = np.array([transform[1,2], transform[0,2]])
+        if output is None:
+            output = np.empty(data.shape, dtype=np.float32)
+        if data.ndim == 2:
+            ndimage.affine_transform(data, matrix, offset, output=output, order=self.order, mode="nearest")
+        else:
+            for plane in range(data.shape[0]):
+                ndimage.affine_transform(data[plane], matrix, offset, output=output[plane], order=self.order, mode="nearest")
+        return output
+
+    def align(self, data, target):
+        transform = self.solve(data, target)
+        if transform is None:
+            return None
+        if np.allclose(transform, [[1,0,0],[0,1,0]], atol=1e-3):
+            return np.asarray(data, dtype=np.float32)
+        return self.warp(data, transform)
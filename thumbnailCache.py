@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+############################################################################################################
+#
+# Name        : thumbnailCache.py
+# Purpose     : Small stretched JPEG/WebP previews of the frames in the repository, made as frames are
+#               indexed and kept in a content addressed cache folder with a size cap
+# Author      : Gord Tulloch
+# Date        : March 22 2024
+# License     : GPL v3
+# Dependencies: numpy, astropy, Pillow (with WebP support for THUMBFORMAT="webp")
+# Usage       : scan with fitsScan.scanFolder(folder, thumbnails=cacheFolder) and pass the result to
+#               obsyDB.FitsIngest.submitFile(..., thumbnail=...), then thumbnailCache.pruneCache(con, cacheFolder)
+#               thumbnailCache.thumbnail(con, unid, cacheFolder)     # path of a frame's thumbnail
+#               python thumbnailCache.py --db "E:/00 Data Repository/obsy.db" --cache "E:/00 Data Repository/Thumbnails/"
+#
+# A thumbnail is named by the content checksum of its frame (fitsScan.fileChecksum) and the size, stretch
+# and format it was made with, in a subfolder per first two hex digits: ab/abcdef...-256-mtf.jpg. Frames
+# with the same content share a thumbnail, and one whose checksum hasn't changed is never rendered again:
+# the worker finds the file already there, marks it used and returns its path. The frame is read through a
+# memmap and binned straight down to the thumbnail size (previewRender.downsample), only the small copy is
+# stretched. BSCALE/BZERO don't change a stretch that works from percentiles, so the raw values are used.
+#
+# The cache is kept under maxMB by removing the least recently used thumbnails (by mtime, which is touched
+# on every use) and the fitsThumbnail rows pointing at them. thumbnail() makes a pruned thumbnail again
+# when it is asked for.
+#
+############################################################################################################
+import argparse
+import os
+import time
+import logging
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+import obsyDB
+import fitsScan
+import stackEngine
+import previewRender
+
+THUMBSIZE=256           # longest side in pixels
+THUMBFORMAT="jpeg"      # "jpeg" or "webp"
+THUMBEXTENSIONS={"jpeg": ".jpg", "webp": ".webp"}
+THUMBSTRETCH="mtf"      # previewRender stretch mode
+THUMBQUALITY=80
+CACHEMB=2048            # size cap of the cache folder
+PRUNETO=0.9             # prune down to this fraction of the cap so every run doesn't prune again
+
+############################################################################################################
+# Cache path of the thumbnail of content with this checksum ("hashname:hexdigest")
+def thumbnailPath(cacheFolder, checksum, size=THUMBSIZE, fileFormat=THUMBFORMAT, mode=THUMBSTRETCH):
+    digest = checksum.split(":")[-1]
+    return os.path.join(cacheFolder, digest[:2], "{0}-{1}-{2}{3}".format(digest, size, mode, THUMBEXTENSIONS[fileFormat]))
+
+# Stretched 8 bit thumbnail pixels of a FITS file, read through a memmap
+def renderThumbnail(fileName, size=THUMBSIZE, mode=THUMBSTRETCH):
+    hdul, data, bscale, bzero = stackEngine.openFrame(fileName)
+    try:
+        if data is None or data.ndim < 2:
+            raise ValueError("no image in the primary HDU")
+        pixels = previewRender.PreviewRenderer(maxSize=size, mode=mode).preview(data)
+    finally:
+        del data
+        hdul.close()
+    return pixels[...,0] if pixels.ndim == 3 and pixels.shape[-1] == 1 else pixels
+
+# Write a thumbnail atomically. The temporary name is unique to the process so two workers making the
+# thumbnail of the same content don't trip over each other.
+def saveThumbnail(pixels, thumbName, fileFormat=THUMBFORMAT, quality=THUMBQUALITY):
+    os.makedirs(os.path.dirname(thumbName), exist_ok=True)
+    tempName = "{0}.{1}.tmp".format(thumbName, os.getpid())
+    Image.fromarray(pixels).save(tempName, format=fileFormat.upper(), quality=quality)
+    os.replace(tempName, thumbName)
+    return thumbName
+
+############################################################################################################
+# Worker function: the thumbnail of a frame, made only if the cache doesn't hold one for its content.
+# checksum is worked out here if the caller doesn't have it. Returns (checksum, thumbnail path), the path
+# None if the frame couldn't be rendered for any reason.
+def makeThumbnail(fileName, cacheFolder, checksum=None, size=THUMBSIZE, fileFormat=THUMBFORMAT, mode=THUMBSTRETCH):
+    if checksum is None:
+        checksum = fitsScan.fileChecksum(fileName)
+        if checksum is None:
+            return None, None
+    thumbName = thumbnailPath(cacheFolder, checksum, size, fileFormat, mode)
+    try:
+        # Unchanged content, mark it used for the LRU and keep it
+        os.utime(thumbName)
+        return checksum, thumbName
+    except OSError:
+        pass
+    try:
+        saveThumbnail(renderThumbnail(fileName, size, mode), thumbName, fileFormat)
+    except Exception as e:
+        # Whatever went wrong with this frame, the rest of the batch carries on
+        logging.warning("Unable to make a thumbnail of {0}: {1}: {2}".format(fileName, type(e).__name__, e))
+        return checksum, None
+    return checksum, thumbName
+
+############################################################################################################
+# Remove the least recently used thumbnails until the cache is under maxMB (down to PRUNETO of it), and
+# the index rows of those removed. Returns the number removed.
+def pruneCache(con, cacheFolder, maxMB=CACHEMB):
+    entries = []
+    for root, dirs, files in os.walk(cacheFolder):
+        for file in files:
+            path = os.path.join(root, file)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for mtime, size, path in entries)
+    if total <= maxMB*1024*1024:
+        return 0
+    removed = []
+    for mtime, size, path in sorted(entries):
+        if total <= PRUNETO*maxMB*1024*1024:
+            break
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.warning("Unable to remove thumbnail {0}: {1}".format(path, e))
+            continue
+        total -= size
+        removed.append(path)
+    obsyDB.forgetThumbnails(con, removed)
+    logging.info("Removed {0} thumbnails from {1}".format(len(removed), cacheFolder))
+    return len(removed)
+
+############################################################################################################
+# Path of the thumbnail of an indexed frame, made (and recorded) if the frame has none or it was pruned.
+# None if the frame isn't indexed or can't be read.
+def thumbnail(con, unid, cacheFolder, size=THUMBSIZE, fileFormat=THUMBFORMAT, mode=THUMBSTRETCH):
+    row = con.execute("SELECT f.filename, f.checksum, t.path FROM fitsFile f LEFT JOIN fitsThumbnail t ON t.unid=f.unid "
+                      "WHERE f.unid=?", (unid,)).fetchone()
+    if row is None:
+        return None
+    fileName, checksum, thumbName = row
+    if thumbName is not None and os.path.isfile(thumbName):
+        os.utime(thumbName)
+        return thumbName
+    checksum, thumbName = makeThumbnail(fileName, cacheFolder, checksum, size, fileFormat, mode)
+    if thumbName is not None:
+        obsyDB.recordThumbnails(con, [(unid, checksum, thumbName)])
+    return thumbName
+
+# Worker function for makeThumbnails, the thumbnail of one (unid, filename, checksum) row
+def thumbnailRow(row, cacheFolder, size, fileFormat, mode):
+    unid, fileName, checksum = row
+    checksum, thumbName = makeThumbnail(fileName, cacheFolder, checksum, size, fileFormat, mode)
+    return unid, checksum, thumbName
+
+# Make the thumbnails of indexed frames that have none (indexed before thumbnails were turned on, or
+# pruned), across a pool of workers. Frames whose checksum is indexed and whose thumbnail is still in the
+# cache are only recorded, not read.
+def makeThumbnails(con, cacheFolder, workers=None, size=THUMBSIZE, fileFormat=THUMBFORMAT, mode=THUMBSTRETCH, batchSize=250):
+    rows, cached = [], []
+    for unid, fileName, checksum in con.execute("SELECT f.unid, f.filename, f.checksum FROM fitsFile f WHERE f.unid NOT IN "
+                                                "(SELECT unid FROM fitsThumbnail)"):
+        if checksum is not None and os.path.isfile(thumbnailPath(cacheFolder, checksum, size, fileFormat, mode)):
+            cached.append((unid, checksum, thumbnailPath(cacheFolder, checksum, size, fileFormat, mode)))
+        elif os.path.isfile(fileName):
+            rows.append((unid, fileName, checksum))
+    obsyDB.recordThumbnails(con, cached)
+    made, batch = 0, []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        worker = partial(thumbnailRow, cacheFolder=cacheFolder, size=size, fileFormat=fileFormat, mode=mode)
+        for unid, checksum, thumbName in pool.map(worker, rows, chunksize=4):
+            if thumbName is None:
+                continue
+            batch.append((unid, checksum, thumbName))
+            if len(batch) >= batchSize:
+                obsyDB.recordThumbnails(con, batch)
+                made += len(batch)
+                print("Made {0} of {1} thumbnails".format(made, len(rows)))
+                batch = []
+    obsyDB.recordThumbnails(con, batch)
+    return made+len(batch), len(cached)
+
+def main():
+    parser = argparse.ArgumentParser(description='Make thumbnails of the indexed frames that have none')
+    parser.add_argument('--db', required=True, type=str, help='obsy.db of the repository')
+    parser.add_argument('--cache', required=True, type=str, help='thumbnail cache folder')
+    parser.add_argument('--size', type=int, default=THUMBSIZE, help='longest side in pixels')
+    parser.add_argument('--format', choices=list(THUMBEXTENSIONS), default=THUMBFORMAT, help='image format')
+    parser.add_argument('--stretch', choices=previewRender.STRETCHMODES, default=THUMBSTRETCH, help='stretch')
+    parser.add_argument('--max_mb', type=int, default=CACHEMB, help='size cap of the cache')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, default one per CPU')
+    args = parser.parse_args()
+
+    con = obsyDB.connectDB(args.db)
+    obsyDB.createTables(con)
+    start = time.perf_counter()
+    made, cached = makeThumbnails(con, args.cache, args.workers, args.size, args.format, args.stretch)
+    removed = pruneCache(con, args.cache, args.max_mb)
+    print("{0} thumbnails made, {1} already cached, {2} pruned in {3:.1f}s".format(made, cached, removed, time.perf_counter()-start))
+    con.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+############################################################################################################
+#
+# Name        : watchFrames.py
+# Purpose     : Long running daemon that live stacks and files each new frame as soon as EKOS has saved it
+# Author      : Gord Tulloch
+# Date        : March 10 2024
+# License     : GPL v3
+# Dependencies: as liveStack.py and postProcess.py
+# Usage       : python watchFrames.py      (leave it running for the night, Ctrl-C to stop)
+#
+# Replaces running liveStack.py and postProcess.py after every frame. frameWatcher.py queues each frame
+# once it is completely written and this script takes them off the queue one at a time: the frame is
+# added to the live stack first (while it is still in the pictures folder) and then named, indexed and
+# moved into the repository by postProcess.processFile, committed straight away rather than in batches.
+# Quality metrics are measured once per frame, when either the stack limits or postProcess.QUALITY need
+# them, and used for both.
+#
+############################################################################################################
+import os
+import time
+import logging
+import obsyDB
+import fitsScan
+import frameQuality
+import thumbnailCache
+import fileMover
+import frameWatcher
+import liveStack
+import postProcess
+
+# Variable definitions
+watchFolder=liveStack.picturesFolder
+liveStacking=True               # add each frame to the live stack (liveStack.py settings)
+postProcessing=True             # name, index and move each frame into the repository (postProcess.py settings)
+settleSeconds=frameWatcher.SETTLE
+queueSize=frameWatcher.QUEUESIZE
+usePolling=False                # poll the folder instead of using inotify
+
+if __name__ == "__main__":
+    logging.basicConfig(filename='watchFrames.log', filemode='w', level=logging.INFO, format='%(asctime)s %(name)s - %(levelname)s - %(message)s')
+
+    stacker=liveStack.LiveStacker() if liveStacking else None
+    con=None
+    ingest=None
+    if postProcessing:
+        con=obsyDB.connectDB(postProcess.dbName)
+        obsyDB.createTables(con)
+        ingest=obsyDB.FitsIngest(con, skipDuplicates=postProcess.SKIPDUPLICATES)
+        mover=fileMover.FileMover(con, postProcess.moveWorkers, processes=postProcess.ARCHIVE)
+        fileMover.recoverMoves(con, mover)
+
+    # Frames left in the folder by an earlier run are picked up when they are filed into the repository.
+    # Without postprocessing nothing moves them out, they would be stacked again every time.
+    watcher=frameWatcher.FrameWatcher(watchFolder, settle=settleSeconds, queueSize=queueSize, polling=usePolling,
+                                      existing=postProcessing).start()
+    print("Watching {0} ({1}), Ctrl-C to stop".format(watchFolder, type(watcher.watch).__name__))
+    try:
+        for fileName in watcher.frames():
+            try:
+                try:
+                    saved=os.path.getmtime(fileName)
+                except OSError:
+                    continue
+                quality=None
+                if (stacker is not None and stacker.checkQuality) or (ingest is not None and postProcess.QUALITY):
+                    quality=frameQuality.measureFrame(fileName)
+                if stacker is not None:
+                    stacker.addFile(fileName, quality)
+                if ingest is not None:
+                    hdr=fitsScan.readPrimaryHeader(fileName)
+                    if hdr is None:
+                        logging.warning("Invalid FITS file. File not processed is "+str(fileName))
+                    else:
+                        checksum=fitsScan.fileChecksum(fileName) if (postProcess.CHECKSUMS or postProcess.THUMBNAILS) else None
+                        thumbnail=None
+                        if postProcess.THUMBNAILS and checksum is not None:
+                            checksum, thumbnail=thumbnailCache.makeThumbnail(fileName, postProcess.thumbnailFolder, checksum)
+                        postProcess.processFile(fileName, hdr, ingest, mover, checksum, quality if postProcess.QUALITY else None, thumbnail)
+                        ingest.flush()
+                        mover.drain()
+                logging.info("{0} done {1:.1f}s after it was saved".format(fileName, time.time()-saved))
+            except Exception as e:
+                # One bad frame mustn't stop the watcher, it is logged and left where it is
+                logging.exception("Unable to process {0}: {1}".format(fileName, e))
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        watcher.stop()
+        if stacker is not None:
+            stacker.close()
+        if ingest is not None:
+            ingest.close()
+            mover.close()
+            if postProcess.THUMBNAILS:
+                thumbnailCache.pruneCache(con, postProcess.thumbnailFolder, postProcess.thumbnailMB)
+            con.close()